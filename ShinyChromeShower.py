@@ -1,9 +1,458 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 from __future__ import print_function
-from PIL import Image, ImageDraw, ImageFont, ImageFile
-import time, praw, urllib2, math, os
-import argparse, ConfigParser
+import time, json, math, os, io
+import ConfigParser, collections, contextlib, threading, hashlib, shutil
+import concurrency
+#PIL, urllib/urllib2 (which load ssl), sqlite3 and the thread pool are
+#imported by the functions using them, so that importing this module, or
+#running it only to write its config, stays fast.
+
+REDDIT_URL = "https://www.reddit.com"
+USER_AGENT = "ChromecastBackdrop"
+LISTING_PAGE_SIZE = 100 #Maximum Reddit API allows.
+MAX_LISTING_PAGES = 5 #Follow the 'after' cursor this many pages deep at most.
+REQUEST_TIMEOUT = 30 #seconds
+LEDGER_EXPIRY_DAYS = 30 #Forget seen posts after this many days.
+HASH_MAX_DISTANCE = 5 #Image hashes this many bits apart or closer are duplicates.
+RENDER_CACHE_MB = 512 #Byte budget of the render cache.
+PART_SUFFIX = '.part' #Added to files until they are complete; uploadr skips them.
+BORDER_RADIUS = 6 #Of the black border drawn around the text.
+BORDER_RESOLUTION = 20
+#Encoder settings of generate_image's output.
+JPEG_PROFILE = {'quality': 100, 'optimize': True, 'progressive': True}
+
+#The only fields of a reddit post this script reads.
+#thumbnail is the url of reddit's small preview, None if it has none.
+#width and height are the image's size from reddit's preview metadata,
+#None when the listing does not have them.
+RedditPost = collections.namedtuple('RedditPost', ['id', 'url', 'title', 'thumbnail',
+                                                   'width', 'height'])
+
+#An output variant of generate_image: images are scaled to fit in size and
+#saved with the JPEG encoder profile into a subdirectory called name.
+RenderTarget = collections.namedtuple('RenderTarget', ['name', 'size', 'profile'])
+
+class RunStats(object):
+    """
+    Timers and counters of one run, summarized as JSON at its end.
+    Stages that run on several threads at once add up their own time, so
+    stage times may exceed the wall time.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Clears all timers and counters and restarts the wall clock.
+        """
+        with self.lock:
+            self.start = time.time()
+            self.timers = {}
+            self.counters = collections.Counter()
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """
+        Context manager adding the time spent in its block to a stage.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                total, calls = self.timers.get(stage, (0.0, 0))
+                self.timers[stage] = (total + elapsed, calls + 1)
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def summary(self):
+        """
+        Returns:
+            dict of the run's wall time, bytes in and out, images per second
+            and every stage timer and counter.
+        """
+        with self.lock:
+            wallTime = time.time() - self.start
+            images = self.counters['images_created']
+            return {
+                'started': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.start)),
+                'wall_time': round(wallTime, 3),
+                'bytes_in': self.counters['bytes_in'],
+                'bytes_out': self.counters['bytes_out'],
+                'images': images,
+                'images_per_second': round(images/wallTime, 4) if wallTime else 0.0,
+                'stages': dict((stage, {'seconds': round(total, 3), 'calls': calls})
+                               for stage, (total, calls) in self.timers.items()),
+                'counters': dict(self.counters),
+            }
+
+    def write(self, filePath):
+        """
+        Appends the summary as one JSON line to filePath.
+        """
+        with open(filePath, 'a') as statsFile:
+            statsFile.write(json.dumps(self.summary(), sort_keys=True) + '\n')
+
+#Statistics of the current run.
+stats = RunStats()
+
+#How many image size probes and downloads run at once, adapted to how the
+#image hosts respond, see concurrency.
+probeConcurrency = concurrency.ConcurrencyController('probe',initial=4,maximum=16)
+downloadConcurrency = concurrency.ConcurrencyController('download',initial=2,maximum=8)
+
+class PostLedger(object):
+    """
+    Persistent record of the reddit posts (images and texts) already handled,
+    keyed by post ID, so later runs go straight to fresh candidates.
+    Every post is either 'accepted' by its filter, 'rejected' with a reason,
+    'queued' in a render job or 'rendered' to a file. Rejected, queued and
+    rendered posts are skipped; accepted ones were never turned into a
+    wallpaper (e.g. the run died) and stay candidates. Entries older than
+    the expiry are dropped on open, which keeps the ledger bounded.
+    """
+    def __init__(self,dbPath,expiryDays=LEDGER_EXPIRY_DAYS):
+        """
+        Args:
+            dbPath (string): path of the SQLite ledger file, created if missing.
+            expiryDays (float): forget entries last seen longer ago than this.
+        """
+        import sqlite3
+        self.con = sqlite3.connect(dbPath)
+        self.con.execute('create table if not exists posts (id text primary key, '
+                         'outcome text, reason text, path text, seen_at real)')
+        self.con.execute('delete from posts where seen_at < ?',
+                         (time.time()-expiryDays*24*3600,))
+        self.con.commit()
+        #Kept in memory: lookups are dict hits, not queries.
+        self.outcomes = dict(self.con.execute('select id, outcome from posts'))
+
+    def is_known(self,postId):
+        """
+        True if the post was rejected, queued or rendered before.
+        """
+        return self.outcomes.get(postId) in ('rejected','queued','rendered')
+
+    def _record(self,postId,outcome,reason=None,path=None):
+        self.outcomes[postId] = outcome
+        self.con.execute('insert or replace into posts (id, outcome, reason, path, seen_at) '
+                         'values (?, ?, ?, ?, ?)',(postId,outcome,reason,path,time.time()))
+
+    def accept(self,postId):
+        self._record(postId,'accepted')
+
+    def reject(self,postId,reason):
+        self._record(postId,'rejected',reason)
+
+    def queued(self,postId):
+        self._record(postId,'queued')
+
+    def release(self,postId):
+        """
+        Makes a queued post whose job failed a candidate again.
+        """
+        if self.outcomes.get(postId) == 'queued':
+            self._record(postId,'accepted')
+
+    def rendered(self,postId,path):
+        self._record(postId,'rendered',path=path)
+
+    def close(self):
+        self.con.commit()
+        self.con.close()
+
+#Ledger of the current run, None when disabled.
+ledger = None
+
+class RunJournal(object):
+    """
+    Crash-safe record of the progress of one run, so that a run that died
+    can be resumed without repeating the work it already did.
+    The selected posts are kept with the settings of the run, and every
+    background image and caption has a stage:
+        selected    chosen from reddit (with its file name, for images).
+        downloaded  background image saved (images only).
+        rendered    wallpaper written under a temporary name (captions).
+        finalized   wallpaper renamed to its final name, or background
+                    deleted once all of its captions are done.
+        skipped     background found to be a duplicate (images only).
+    The journal is saved after every change, by writing a new file and
+    renaming it over the old one, so it is never left half written.
+    """
+    def __init__(self,filePath=None):
+        """
+        Args:
+            filePath (string) optional, JSON file of the journal. None keeps
+                the journal in memory only.
+        """
+        self.filePath = filePath
+        self.state = {'started': time.strftime("%Y-%m-%dT%H:%M:%S"), 'finished': False,
+                      'settings': None, 'posts': None, 'items': {}}
+
+    def load(self,settings=None):
+        """
+        Reads the journal file, if there is one.
+
+        Args:
+            settings (dict) optional, the settings of the current run.
+
+        Returns:
+            True if it holds an unfinished run with the same settings,
+            which can be resumed.
+        """
+        try:
+            with open(self.filePath) as journalFile:
+                self.state = json.load(journalFile)
+        except (IOError, ValueError):
+            return False
+        return not self.state['finished'] and self.state['posts'] is not None \
+            and self.state['settings'] == settings
+
+    def save(self):
+        if self.filePath is None:
+            return
+        tempPath = self.filePath+'.tmp'
+        with open(tempPath,'w') as journalFile:
+            json.dump(self.state,journalFile,sort_keys=True)
+            journalFile.flush()
+            os.fsync(journalFile.fileno())
+        os.rename(tempPath,self.filePath)
+
+    def select(self,imagePosts,textPosts,settings=None):
+        """
+        Starts the journal of a new run with the posts it will use.
+        """
+        self.state['settings'] = settings
+        self.state['posts'] = {'images': [list(post) for post in imagePosts],
+                               'texts': [list(post) for post in textPosts]}
+        self.save()
+
+    def posts(self):
+        """
+        Returns:
+            tuple of lists of RedditPosts: the selected (images, texts).
+        """
+        posts = self.state['posts']
+        return [RedditPost(*post) for post in posts['images']], \
+               [RedditPost(*post) for post in posts['texts']]
+
+    def item(self,key):
+        """
+        The journal entry of an image or caption, an empty dict if it has
+        none yet.
+        """
+        return self.state['items'].get(key,{})
+
+    def mark(self,key,stage,**fields):
+        """
+        Records that an item reached a stage, with optional fields such as
+        the paths of its files.
+        """
+        item = dict(self.item(key),**fields)
+        item['stage'] = stage
+        self.state['items'][key] = item
+        self.save()
+
+    def finish(self):
+        self.state['finished'] = True
+        self.save()
+
+    def clean(self,destDir):
+        """
+        Deletes the downloads and temporary files an unfinished run left in
+        destDir, for when it is not resumed.
+        """
+        paths = []
+        for key,item in self.state['items'].items():
+            if item.get('stage') == 'finalized':
+                continue
+            if 'name' in item:
+                background = os.path.join(destDir,item['name']+'.background')
+                paths.extend([background,background+PART_SUFFIX])
+            paths.extend(item.get('parts',[]))
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+#Journal of the current run, None when disabled.
+journal = None
+
+def dhash(img):
+    """
+    Difference hash of an image: 64 bits, one per pair of horizontally
+    adjacent pixels of a 9x8 grayscale thumbnail, set where the left pixel
+    is brighter. Rescaling and recompression barely change it, so copies
+    of a photo hash within a few bits of each other.
+
+    Args:
+        img (Image): an opened image that was not loaded yet. JPEGs are
+            decoded straight to a thumbnail at up to 1/8 scale (draft).
+
+    Returns:
+        int: the 64 bit hash.
+    """
+    from PIL import Image
+    img.draft('L',(72,64))
+    pixels = list(img.convert('L').resize((9,8),Image.ANTIALIAS).getdata())
+    value = 0
+    for row in range(0,72,9):
+        for i in range(row,row+8):
+            value = value<<1 | (pixels[i] > pixels[i+1])
+    return value
+
+def hash_url(url):
+    """
+    dhash of a web image, meant for small ones such as reddit thumbnails.
+    """
+    import urllib2
+    from PIL import Image
+    data = urllib2.urlopen(url, timeout=REQUEST_TIMEOUT).read()
+    stats.count('bytes_in',len(data))
+    return dhash(Image.open(io.BytesIO(data)))
+
+def hash_file(path):
+    """
+    dhash of a local image file.
+    """
+    from PIL import Image
+    return dhash(Image.open(path))
+
+class ImageHashIndex(object):
+    """
+    Persistent multi-index hash table of the dhashes of the images used,
+    finding a stored hash at most maxDistance bits away from a query.
+    Every hash is cut into maxDistance+1 chunks. Two hashes that differ in
+    no more than maxDistance bits must agree on at least one whole chunk,
+    so a lookup only compares the hashes that share a chunk with the query
+    instead of all of them. The tables are kept in memory and the hashes
+    in SQLite, expiring like the post ledger.
+    """
+    def __init__(self,con,maxDistance=HASH_MAX_DISTANCE,expiryDays=LEDGER_EXPIRY_DAYS):
+        """
+        Args:
+            con (sqlite3.Connection): database to keep the hashes in,
+                usually the post ledger's. Committed by close().
+            maxDistance (int): the largest number of differing bits
+                still considered a duplicate.
+            expiryDays (float): forget hashes stored longer ago than this.
+        """
+        self.maxDistance = maxDistance
+        chunks = maxDistance+1
+        self.chunks = []
+        shift = 0
+        for i in range(chunks):
+            bits = 64//chunks + (1 if i < 64%chunks else 0)
+            self.chunks.append((shift,(1<<bits)-1))
+            shift += bits
+        self.tables = [collections.defaultdict(list) for i in range(chunks)]
+        self.owners = {}
+        self.hashes = {}
+        self.con = con
+        self.con.execute('create table if not exists image_hashes (hash integer primary key, '
+                         'post_id text, seen_at real)')
+        self.con.execute('delete from image_hashes where seen_at < ?',
+                         (time.time()-expiryDays*24*3600,))
+        self.con.commit()
+        for value,postId in self.con.execute('select hash, post_id from image_hashes'):
+            self._insert(value % (1<<64),postId)
+
+    def _insert(self,value,postId):
+        if value in self.owners:
+            return False
+        self.owners[value] = postId
+        self.hashes[postId] = value
+        for table,(shift,mask) in zip(self.tables,self.chunks):
+            table[(value>>shift) & mask].append(value)
+        return True
+
+    def __len__(self):
+        return len(self.owners)
+
+    def has_post(self,postId):
+        return postId in self.hashes
+
+    def find(self,value,excludeId=None):
+        """
+        Looks up the closest stored hash within maxDistance bits.
+
+        Args:
+            value (int): the hash to look up.
+            excludeId (string) optional, ignore the hash of this post.
+
+        Returns:
+            tuple(string, int): the post ID of the match and the number of
+            differing bits. None if there is no match.
+        """
+        candidates = set()
+        for table,(shift,mask) in zip(self.tables,self.chunks):
+            candidates.update(table.get((value>>shift) & mask,()))
+        best = None
+        for candidate in candidates:
+            distance = bin(candidate ^ value).count('1')
+            if distance <= self.maxDistance and (best is None or distance < best[1]) \
+                    and self.owners[candidate] != excludeId:
+                best = (self.owners[candidate],distance)
+        return best
+
+    def add(self,value,postId):
+        """
+        Stores the hash of a post's image.
+        """
+        if self._insert(value,postId):
+            #SQLite integers are signed 64 bit.
+            self.con.execute('insert or ignore into image_hashes (hash, post_id, seen_at) '
+                             'values (?, ?, ?)',(value - (1<<64) if value >= 1<<63 else value,
+                                                 postId,time.time()))
+
+    def close(self):
+        self.con.commit()
+
+#Image hash index of the current run, None when disabled.
+imageHashes = None
+
+def find_duplicate(post,hashFunc,source):
+    """
+    Hashes a post's image and looks it up in the image hash index.
+    An image that is not a duplicate is added to the index.
+
+    Args:
+        post: a single RedditPost.
+        hashFunc (function): hash_url or hash_file.
+        source (string): what to pass to hashFunc.
+
+    Returns:
+        tuple(string, int): as ImageHashIndex.find, None if the image is
+        new or could not be hashed.
+    """
+    try:
+        with stats.timer('phash'):
+            value = hashFunc(source)
+    except Exception as e:
+        print("could not hash %s: %s. " %(source,e),end='')
+        return None
+    stats.count('hashed')
+    match = imageHashes.find(value,post.id)
+    if match:
+        stats.count('duplicates')
+        return match
+    imageHashes.add(value,post.id)
+    return None
+
+def reject_post(post,reason):
+    """
+    Records a post rejected by a filter in the ledger.
+
+    Returns:
+        False, so filters can return reject_post(...).
+    """
+    if ledger is not None:
+        ledger.reject(post.id,reason)
+    return False
 
 def get_resource_path(relPath):
     """
@@ -52,9 +501,45 @@ def get_image_size(url):
         tuple(float, float): (image width, image height). 
         on failure: (None, None).
     """
+    with stats.timer('probe'):
+        return _get_image_size(url)
+
+def probe_ahead(pages):
+    """
+    Yields the posts of listing pages in order, while the sizes of the
+    images whose listing has none are probed ahead of them, as many at once
+    as probeConcurrency allows. Probing stops at the end of a page, so no
+    page is fetched before its posts are needed.
+
+    Args:
+        pages (iterable of lists of RedditPosts): such as iter_listing_pages'.
+
+    Returns:
+        Generator of tuple(RedditPost, tuple): every post with its probed
+        size, as get_image_size returns it, or None if it was not probed.
+    """
+    def known(post):
+        return bool(post.width and post.height) or \
+            (ledger is not None and ledger.is_known(post.id))
+    def probe(post):
+        return post,get_image_size(fix_image_url(post.url))
+    def failed(result):
+        return result[1][0] is None
+    for posts in pages:
+        for result in probeConcurrency.imap(probe,posts,isError=failed,skip=known):
+            #The posts skipped come as they are.
+            if isinstance(result,RedditPost):
+                yield result,None
+            else:
+                yield result
+
+def _get_image_size(url):
+    import urllib2
+    from PIL import ImageFile
     width = height = None
+    stats.count('probes')
     try:
-        file = urllib2.urlopen(url)
+        file = urllib2.urlopen(url, timeout=REQUEST_TIMEOUT)
     except: 
         print("urllib2.urlopen failed.",end='')
         return width,height
@@ -69,6 +554,7 @@ def get_image_size(url):
         if not data:
             print('EOF reached.',end ='')
             break
+        stats.count('bytes_in',len(data))
         p.feed(data)
         if p.image:
             w,h = p.image.size
@@ -78,14 +564,16 @@ def get_image_size(url):
     file.close()
     return width,height
 
-def filter_image(post):
+def filter_image(post,size=None):
     """
     Decide if the image fits this scripts requirements.
         *Resolution above 1080p
         *Aspect ratio between 0.47 to 0.64 (seems to work well)
     
     Args:
-        post: a single praw post object
+        post: a single RedditPost
+        size (tuple) optional, the image's size already probed, as
+            get_image_size returns it.
     
     Returns:
         Boolean of validity
@@ -96,19 +584,35 @@ def filter_image(post):
     MIN_ASPECT_RATIO = 0.47
     MAX_ASPECT_RATIO = 0.67
     url = fix_image_url(post.url)
-    W, H = get_image_size(url)
+    if post.width and post.height:
+        #Size known from the listing, no need to fetch the image's header.
+        W, H = float(post.width), float(post.height)
+        stats.count('probes_avoided')
+    elif size is not None:
+        W, H = size
+    else:
+        W, H = get_image_size(url)
     if W is None:
+        #Possibly a network hiccup, so not recorded in the ledger.
         print("bad: could not read dimensions. url: %s\n" %url,end='')
         return False
 
     if not(MIN_ASPECT_RATIO < H/W < MAX_ASPECT_RATIO):
        print("bad: aspect ratio incompatible (%dx%d) %s.\turl: %s\n"  \
             %(W,H,str(round(H/W,2)),url),end='')
-       return False
+       return reject_post(post,"aspect ratio %dx%d" %(W,H))
     
     if H*W < MIN_RESOLUTION:
        print("bad: resolution too low (%dx%d).\turl: %s\n"  %(W,H,url),end='')
-       return False
+       return reject_post(post,"resolution %dx%d" %(W,H))
+
+    #Posts without a thumbnail are checked after their download instead.
+    if imageHashes is not None and post.thumbnail:
+        duplicate = find_duplicate(post,hash_url,post.thumbnail)
+        if duplicate:
+            print("bad: duplicate of post %s (%d bits apart).\turl: %s\n" \
+                %(duplicate[0],duplicate[1],url),end='')
+            return reject_post(post,"duplicate of %s" %duplicate[0])
        
     print("good. (%dx%d).\turl: %s\n"  %(W,H,url),end='')
     return True
@@ -119,20 +623,111 @@ def filter_text(post):
        * All text posts must be shorter than 140 charecters.
     
     Args:
-        post: a single praw post object
+        post: a single RedditPost
     
     Returns:
         Boolean of validity
     """
     if len(post.title) > 140: #tweet length, for tl;dr reasons.
         print('bad: too long.')
-        return False
+        return reject_post(post,"too long")
     print('good.')
     return True 
 
-def get_valid_posts(reddit,subName,outputSize,filterFunc,index):
+def fetch_listing(subName,after=None):
+    """
+    Fetch one page of a subreddit's hot listing, keeping only the
+    fields used by this script.
+
+    Args:
+        subName (string): Name of the subreddit.
+        after (string) optional, the listing's 'after' cursor from the
+            previous page.
+
+    Returns:
+        tuple(list of RedditPost, string): the posts and the cursor to the
+        next page (None on the last page).
+    """
+    import urllib, urllib2
+    params = {'limit': LISTING_PAGE_SIZE, 'raw_json': 1}
+    if after:
+        params['after'] = after
+    url = "%s/r/%s/hot.json?%s" %(REDDIT_URL,subName,urllib.urlencode(params))
+    request = urllib2.Request(url, headers={'User-Agent': USER_AGENT})
+    with stats.timer('reddit_listing'):
+        data = urllib2.urlopen(request, timeout=REQUEST_TIMEOUT).read()
+    stats.count('bytes_in',len(data))
+    stats.count('listing_pages')
+    listing = json.loads(data)['data']
+    posts = []
+    for child in listing['children']:
+        if child['kind'] != 't3':
+            continue
+        data = child['data']
+        #'self', 'default', 'nsfw' and the like stand for no thumbnail.
+        thumbnail = data.get('thumbnail') or ''
+        #The size of the linked image, as reddit saw it for its preview.
+        try:
+            source = data['preview']['images'][0]['source']
+            width, height = source['width'], source['height']
+        except (KeyError, IndexError, TypeError):
+            width = height = None
+        posts.append(RedditPost(data['id'],data['url'],data['title'],
+                                thumbnail if thumbnail.startswith('http') else None,
+                                width,height))
+    return posts,listing['after']
+
+def fetch_first_page(subName):
+    """
+    fetch_listing for the first page, on failure an empty page.
+    """
+    try:
+        return fetch_listing(subName)
+    except Exception as e:
+        print("%s: could not fetch listing: %s" %(subName,e))
+        return [],None
+
+def iter_listing(subName,firstPage=None):
+    """
+    Iterate over a subreddit's hot posts, fetching further pages with the
+    'after' cursor only when the previous ones have been consumed.
+
+    Args:
+        subName (string): Name of the subreddit.
+        firstPage (tuple) optional, an already fetched first page, as
+            returned by fetch_listing.
+
+    Yields:
+        RedditPost objects, up to MAX_LISTING_PAGES pages of them.
+    """
+    for posts in iter_listing_pages(subName,firstPage):
+        for post in posts:
+            yield post
+
+def iter_listing_pages(subName,firstPage=None):
+    """
+    Like iter_listing, page by page.
+
+    Yields:
+        lists of RedditPost objects.
+    """
+    posts, after = firstPage or fetch_first_page(subName)
+    pages = 1
+    while True:
+        yield posts
+        if not after or pages >= MAX_LISTING_PAGES:
+            return
+        try:
+            posts, after = fetch_listing(subName,after)
+        except Exception as e:
+            print("%s: could not fetch listing page %d: %s" %(subName,pages+1,e))
+            return
+        pages += 1
+
+def get_valid_posts(subName,outputSize,filterFunc,index,firstPage=None):
     """
     Get the top N posts that qualify by filter (or as close as possible to it)
+    Posts the ledger already knows are skipped without being checked.
 
     Args:
         subName (string): Name of the subreddit.
@@ -140,38 +735,45 @@ def get_valid_posts(reddit,subName,outputSize,filterFunc,index):
             (not promised, best effort only)
         filterFunc (function): function that recieves a post object and returns
             a boolean of its validity.
-        maxTries (int): only check this ammount of posts before stopping.
+        index (int): number of posts already collected, for display.
+        firstPage (tuple) optional, an already fetched first listing page.
     
     Returns:
         An array of valid posts.
     """
-    maxTries = 100 #Maximum Reddit API allows.
     result =[]
-    postArr = reddit.get_subreddit(subName).get_hot(limit=maxTries)
     i = 1
-    try:
-        for post in postArr:
-            print(subName+": Try",(i)," got", index+len(result) ," checking ... ",end='')
-            post = next(postArr)
-            if filterFunc(post):
-                result.append(post)
-            if len(result)==outputSize:
-                print("got",index+len(result),". done.")
-                return result
-            i+=1
-    except StopIteration:
-        pass
+    if filterFunc is filter_image:
+        posts = probe_ahead(iter_listing_pages(subName,firstPage))
+    else:
+        posts = ((post,None) for post in iter_listing(subName,firstPage))
+    for post,size in posts:
+        if ledger is not None and ledger.is_known(post.id):
+            stats.count('ledger_skipped')
+            continue
+        print(subName+": Try",(i)," got", index+len(result) ," checking ... ",end='')
+        #A size probed ahead is handed to filter_image.
+        valid = filterFunc(post) if size is None else filterFunc(post,size)
+        if valid:
+            result.append(post)
+            if ledger is not None:
+                ledger.accept(post.id)
+        if len(result)==outputSize:
+            print("got",index+len(result),". done.")
+            return result
+        i+=1
     print("tries limit reached. continuing with",len(result))
     return result
 
-def get_posts(reddit,subreddits,limit,filterFunc):
+def get_posts(subreddits,limit,filterFunc):
     """
     Get up to <limit> posts that are approved by <filterFunc>
     from all <subreddits>, by order.
-    All valid posts are taken from subreddit i, before moving to i+1
+    All valid posts are taken from subreddit i, before moving to i+1.
+    The first listing page of every subreddit is fetched concurrently up
+    front, so moving on to the next subreddit does not wait on reddit.
     
     Args:
-        reddit (praw.Reddit): reddit object
         subreddits (array of strings): All the subreddits names (no r/), 
             by priority. ["FisrtPrioritySub","SecondPrioritySub",...]
         limit (int): Get up to this ammount of posts.
@@ -181,62 +783,71 @@ def get_posts(reddit,subreddits,limit,filterFunc):
     Returns:
         A list of post objects
     """
+    from multiprocessing.pool import ThreadPool
     result =[]
-    for subreddit in subreddits:
+    if not subreddits or limit <= 0:
+        return result
+    pool = ThreadPool(len(subreddits))
+    try:
+        firstPages = pool.map(fetch_first_page,subreddits)
+    finally:
+        pool.close()
+    for subreddit,firstPage in zip(subreddits,firstPages):
         if len(result) >= limit:
             break
         print(subreddit,":")
         found = len(result)
         required = limit-found
-        result.extend(get_valid_posts(reddit,subreddit,required, filterFunc,found))
+        result.extend(get_valid_posts(subreddit,required,filterFunc,found,firstPage))
         print("total of %d posts acquired."%len(result))
     return result
     
-def get_reddit_content(image_subreddits,text_subreddits,limit):
+def get_reddit_posts(image_subreddits,text_subreddits,limit,captionsPerImage=1):
     """
-    Get an array of reddit posts to be used 
+    Get the image and text posts to be used 
     
     Args:
-        subName (string): Name of the subreddit.
-        outputSize (int): The size of the array to return
-            (not promised, best effort only)
-        filterFunc (function): recieves a post object and returns  
-            a boolean of its validity.
-        maxTries (int): only check this ammount of posts before stopping.
+        image_subreddits (list of strings): subreddits to take images from,
+            by priority.
+        text_subreddits (list of strings): subreddits to take text from,
+            by priority.
+        limit (int): the maximum number of images.
+        captionsPerImage (int) optional, text posts wanted per image.
     
     Returns:
-        A tuple of arrays: ([array of image urls], [array of text strings])
+        A tuple of arrays: ([image RedditPosts], [text RedditPosts])
     """
-    print("connectig to reddit.com")
-    reddit = praw.Reddit(user_agent="ChromecastBackdrop")
     print("getting image posts")
-    imagePosts = get_posts(reddit,image_subreddits,limit,filter_image)
+    imagePosts = get_posts(image_subreddits,limit,filter_image)
 
     if len(imagePosts)==0:
         print("No images found.")
         return [],[]
     
     print("getting text posts")
-    textLimit = len(imagePosts)
-    textPosts= get_posts(reddit,text_subreddits,textLimit,filter_text)
-    images = [fix_image_url(post.url) for post in imagePosts]
-    texts = [post.title for post in textPosts]
-    
-    return images,texts
+    textLimit = len(imagePosts)*captionsPerImage
+    textPosts= get_posts(text_subreddits,textLimit,filter_text)
+    return imagePosts,textPosts
 
 def download_image(url, path):
     """
     Download an image by URL.
+    The file only appears at path once it is complete.
     
     Args:
         path (string): destination file path. 
         name (string): name of the destination file.
     """
+    import urllib2
     #Label image using current date and image in sequence.
-    resource = urllib2.urlopen(url)
-    output = open(path,"wb")
-    output.write(resource.read())
+    with stats.timer('download'):
+        resource = urllib2.urlopen(url, timeout=REQUEST_TIMEOUT)
+        data = resource.read()
+    stats.count('bytes_in',len(data))
+    output = open(path+PART_SUFFIX,"wb")
+    output.write(data)
     output.close()
+    os.rename(path+PART_SUFFIX,path)
 
 def multiline_text(text, image_width, image_height, font):
     """
@@ -296,7 +907,7 @@ def draw_border(draw,w,h,text,font,color,borderRadius,borderResolusion):
         draw.multiline_text((w + x, h + y), text, font=font,
                             align='center', spacing=5, fill=color)
 
-def draw_text(image, text,font, borderRadius = 6, borderResolusion = 20):
+def draw_text(image, text,font, borderRadius = BORDER_RADIUS, borderResolusion = BORDER_RESOLUTION):
     """
     Draws the text over the given image object.
 
@@ -312,6 +923,7 @@ def draw_text(image, text,font, borderRadius = 6, borderResolusion = 20):
         borderRadius (int) optional, radius of border for the text.
         borderResolusion (int) optional, how many times the 
     """
+    from PIL import ImageDraw
     draw = ImageDraw.Draw(image)
     h = (image.size[1] - ((text.count('\n')+1) *\
                           (font.getsize(text)[1] + 5)))/2
@@ -325,10 +937,144 @@ def draw_text(image, text,font, borderRadius = 6, borderResolusion = 20):
     draw.multiline_text((w, h), text, font=font,
                         align='center', spacing=5, fill="white")
 
-def generate_image(backgroundImagePath,text, fontPath, destFilePath = None):
+def font_size(imageHeight):
+    """
+    Size of the caption font on an image of the given height.
+    """
+    return int(imageHeight*.04)
+
+def file_digest(filePath):
+    """
+    Returns the SHA-1 hex digest of a file's contents.
+    """
+    digest = hashlib.sha1()
+    with open(filePath,'rb') as f:
+        for block in iter(lambda: f.read(1<<20),b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class RenderCache(object):
+    """
+    Content addressed store of the images generate_image encoded, keyed by
+    everything the output depends on, so a rerun over the same background,
+    caption, font and settings copies the earlier result instead of
+    rendering it again. The least recently used entries are evicted to stay
+    within a byte budget. Entries are files named after their key, indexed
+    in a SQLite file in the same directory.
+    """
+    def __init__(self,cacheDir,maxBytes=RENDER_CACHE_MB*1024*1024):
+        """
+        Args:
+            cacheDir (string): directory of the cache, created if missing.
+            maxBytes (int): the most bytes of images kept.
+        """
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        import sqlite3
+        self.con = sqlite3.connect(os.path.join(cacheDir,'index.db'))
+        self.con.execute('create table if not exists entries (key text primary key, '
+                         'size integer, used_at real)')
+        self.size = self.con.execute('select coalesce(sum(size), 0) from entries').fetchone()[0]
+
+    @staticmethod
+    def key(*parts):
+        """
+        Returns the digest of the given values, the key of their output.
+        """
+        digest = hashlib.sha1()
+        for part in parts:
+            digest.update(repr(part))
+            digest.update('\0')
+        return digest.hexdigest()
+
+    def _path(self,key):
+        return os.path.join(self.cacheDir,key+'.jpg')
+
+    def _remove(self,key,size):
+        self.con.execute('delete from entries where key = ?',(key,))
+        self.size -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def get(self,key,destFilePath):
+        """
+        Copies the image cached under key to destFilePath.
+
+        Returns:
+            True on a hit, False if the key is not cached.
+        """
+        row = self.con.execute('select size from entries where key = ?',(key,)).fetchone()
+        if row is None:
+            return False
+        try:
+            shutil.copyfile(self._path(key),destFilePath)
+        except IOError:
+            self._remove(key,row[0])
+            return False
+        self.con.execute('update entries set used_at = ? where key = ?',(time.time(),key))
+        return True
+
+    def put(self,key,filePath):
+        """
+        Stores a copy of filePath under key, then evicts the least recently
+        used entries while the cache is over its budget.
+        """
+        size = os.path.getsize(filePath)
+        if size > self.maxBytes:
+            return
+        row = self.con.execute('select size from entries where key = ?',(key,)).fetchone()
+        if row is not None:
+            self._remove(key,row[0])
+        #Copied under a temporary name so a crash never leaves a partial entry.
+        tempPath = self._path(key)+'.tmp'
+        shutil.copyfile(filePath,tempPath)
+        os.rename(tempPath,self._path(key))
+        self.con.execute('insert into entries (key, size, used_at) values (?, ?, ?)',
+                         (key,size,time.time()))
+        self.size += size
+        if self.size > self.maxBytes:
+            for oldKey,oldSize in self.con.execute('select key, size from entries '
+                                                   'order by used_at').fetchall():
+                if self.size <= self.maxBytes:
+                    break
+                self._remove(oldKey,oldSize)
+        self.con.commit()
+
+    def close(self):
+        self.con.commit()
+        self.con.close()
+
+#Render cache of the current run, None when disabled.
+renderCache = None
+
+def render_key(backgroundDigest,text,fontPath,height,maxSize=None,profile=None):
+    """
+    Render cache key of an image generated with the current settings.
+
+    Args:
+        backgroundDigest (string): file_digest of the background.
+        text (string): the caption.
+        fontPath (string): path to the font file.
+        height (int): height of the output image.
+        maxSize (tuple) optional, the size the background was fit into.
+        profile (dict) optional, JPEG encoder settings, default JPEG_PROFILE.
+    """
+    parts = [backgroundDigest,text,fontPath,font_size(height),BORDER_RADIUS,
+             BORDER_RESOLUTION,sorted((profile or JPEG_PROFILE).items())]
+    if maxSize:
+        parts.append(('max_size',tuple(maxSize)))
+    return RenderCache.key(*parts)
+
+def generate_image(backgroundImagePath,text, fontPath, destFilePath = None, targets = None):
     """
     Creates an image file with text written over a background image.
     Overwrites the image in backgroundImagePath.
+    With the render cache open, an image rendered before from the same
+    background, text, font and settings is copied from the cache.
     
     Args:
         backgroundImagePath (string): Path to the image file. 
@@ -337,64 +1083,895 @@ def generate_image(backgroundImagePath,text, fontPath, destFilePath = None):
         fontPath (string): path to the font file to be used.
         destFilePath (string) optional, where to save the result
             default is to overwrite the file in backgroundImagePath.
+        targets (list of RenderTargets) optional, create one image per
+            target instead, see generate_targets.
+
+    Returns:
+        True if the image (every image, with targets) came from the
+        render cache.
     """
+    from PIL import Image, ImageFont
     if destFilePath == None:
         destFilePath = backgroundImagePath
-    img = Image.open(backgroundImagePath)
+    if targets:
+        return all(fromCache for path,fromCache in
+                   generate_targets(backgroundImagePath,text,fontPath,destFilePath,targets))
+    cacheKey = None
+    if renderCache is not None:
+        with stats.timer('render_cache'):
+            #Opening only reads the header, enough for the font size.
+            height = Image.open(backgroundImagePath).size[1]
+            cacheKey = render_key(file_digest(backgroundImagePath),text,fontPath,height)
+            hit = renderCache.get(cacheKey,destFilePath)
+        if hit:
+            stats.count('render_cache_hits')
+            stats.count('bytes_out',os.path.getsize(destFilePath))
+            stats.count('images_created')
+            return True
+    with stats.timer('decode'):
+        img = Image.open(backgroundImagePath)
+        img.load()
     width, height = img.size
-    font = ImageFont.truetype(fontPath, int(height*.04))
-    textMultiLine = multiline_text(text, width, height,font)
-    draw_text(img, textMultiLine,font)
-    img.save(destFilePath, "JPEG", quality=100, \
-        optimize=True, progressive=True)
+    with stats.timer('layout'):
+        font = ImageFont.truetype(fontPath, font_size(height))
+        textMultiLine = multiline_text(text, width, height,font)
+    with stats.timer('draw'):
+        draw_text(img, textMultiLine,font)
+    with stats.timer('encode'):
+        img.save(destFilePath, "JPEG", **JPEG_PROFILE)
+    stats.count('bytes_out',os.path.getsize(destFilePath))
+    stats.count('images_created')
+    if cacheKey is not None:
+        with stats.timer('render_cache'):
+            renderCache.put(cacheKey,destFilePath)
+    return False
+
+def target_path(destFilePath,target):
+    """
+    Where the variant of destFilePath for a target is saved: in the target's
+    subdirectory, which uploadr turns into a set of its own.
+    """
+    return os.path.join(os.path.dirname(destFilePath),target.name,
+                        os.path.basename(destFilePath))
+
+def generate_targets(backgroundImagePath,text,fontPath,destFilePath,targets):
+    """
+    Creates one image per target from a single decode of the background.
+    The targets are produced largest first, each one scaled down from the
+    previous, smaller, background rather than from the original, and the
+    text is laid out for each target's own size.
+
+    Args:
+        backgroundImagePath (string): Path to the image file. Not modified.
+        text (string): The text to draw over the image.
+        fontPath (string): path to the font file to be used.
+        destFilePath (string): file name of the images, each saved in its
+            target's subdirectory of this file's directory.
+        targets (list of RenderTargets): the variants to create.
+
+    Returns:
+        list of tuple(string, bool), largest target first: the path of
+        each image and True if it came from the render cache.
+    """
+    from PIL import Image, ImageFont
+    targets = sorted(targets,key=lambda target: target.size[0]*target.size[1],reverse=True)
+    size = Image.open(backgroundImagePath).size
+    sizes = []
+    for target in targets:
+        size = fit_size(size,target.size)
+        sizes.append(size)
+    paths = [target_path(destFilePath,target) for target in targets]
+    for path in paths:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+    keys = [None]*len(targets)
+    hits = [False]*len(targets)
+    if renderCache is not None:
+        with stats.timer('render_cache'):
+            digest = file_digest(backgroundImagePath)
+            for i,(target,size,path) in enumerate(zip(targets,sizes,paths)):
+                keys[i] = render_key(digest,text,fontPath,size[1],size,target.profile)
+                hits[i] = renderCache.get(keys[i],path)
+                if hits[i]:
+                    stats.count('render_cache_hits')
+                    stats.count('bytes_out',os.path.getsize(path))
+                    stats.count('images_created')
+    if all(hits):
+        return zip(paths,hits)
+
+    with stats.timer('decode'):
+        img = Image.open(backgroundImagePath)
+        if img.size != sizes[0]:
+            img.draft(img.mode,sizes[0])
+        img.load()
+    for target,size,path,key,hit in zip(targets,sizes,paths,keys,hits):
+        if img.size != size:
+            with stats.timer('resize'):
+                img = img.resize(size,Image.ANTIALIAS)
+        if hit:
+            continue
+        width, height = size
+        with stats.timer('layout'):
+            font = ImageFont.truetype(fontPath, font_size(height))
+            textMultiLine = multiline_text(text, width, height,font)
+        with stats.timer('draw'):
+            out = img.copy()
+            draw_text(out, textMultiLine,font)
+        with stats.timer('encode'):
+            out.save(path, "JPEG", **target.profile)
+        stats.count('bytes_out',os.path.getsize(path))
+        stats.count('images_created')
+        if key is not None:
+            with stats.timer('render_cache'):
+                renderCache.put(key,path)
+    return zip(paths,hits)
+
+def parse_targets(value):
+    """
+    Parses output targets written as NAME=WIDTHxHEIGHT[@QUALITY], separated
+    by spaces, such as "4k=3840x2160@90 1080p=1920x1080".
+
+    Returns:
+        list of RenderTargets, empty for an empty value.
+    """
+    targets = []
+    for spec in (value or '').split():
+        name, size = spec.split('=')
+        profile = dict(JPEG_PROFILE)
+        if '@' in size:
+            size, quality = size.split('@')
+            profile['quality'] = int(quality)
+        targets.append(RenderTarget(name,parse_size(size),profile))
+    return targets
+
+def parse_size(value):
+    """
+    Parses a size written as WIDTHxHEIGHT, such as 1920x1080.
+
+    Returns:
+        tuple(int, int), or None for an empty value.
+    """
+    if not value:
+        return None
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+def fit_size(size,maxSize):
+    """
+    Scales a size down to fit within maxSize, keeping its aspect ratio.
+    Sizes that already fit are returned unchanged.
+    """
+    width, height = size
+    scale = min(1.0, float(maxSize[0])/width, float(maxSize[1])/height)
+    return max(1,int(round(width*scale))), max(1,int(round(height*scale)))
+
+#Background and font shared by the processes of generate_images.
+_batch = {}
+
+def _start_batch_worker(img,fontPath,fontSize):
+    from PIL import ImageFont
+    _batch['image'] = img
+    _batch['font'] = ImageFont.truetype(fontPath,fontSize)
+
+#Worker pool and shared image buffers of generate_images, kept from one
+#background to the next until close_render_workers.
+_renderWorkers = {}
+
+def render_workers():
+    """
+    Returns:
+        tuple(multiprocessing.Pool, imagebuffers.ImageBufferPool): the
+        processes drawing and encoding batches, one per CPU, and the
+        buffers the backgrounds are shared with them through. Started on
+        first use.
+    """
+    if not _renderWorkers:
+        import multiprocessing, imagebuffers
+        _renderWorkers['pool'] = multiprocessing.Pool(multiprocessing.cpu_count())
+        _renderWorkers['buffers'] = imagebuffers.ImageBufferPool()
+    return _renderWorkers['pool'], _renderWorkers['buffers']
+
+def close_render_workers():
+    """
+    Stops the render worker processes and deletes the shared buffers.
+    """
+    if _renderWorkers:
+        pool = _renderWorkers.pop('pool')
+        pool.close()
+        pool.join()
+        buffers = _renderWorkers.pop('buffers')
+        stats.count('shared_image_bytes',buffers.bytesCopied)
+        buffers.close()
+
+def _render_shared_caption(job):
+    """
+    Draws one laid out caption onto a copy of a background in a shared
+    buffer and saves it, in a render worker.
+
+    Args:
+        job (tuple): (imagebuffers.ImageHandle, fontPath, fontSize, text
+            with its line breaks, destFilePath).
+
+    Returns:
+        tuple(string, string): destFilePath and an error message or None.
+    """
+    import imagebuffers
+    from PIL import ImageFont
+    handle, fontPath, fontSize, textMultiLine, destFilePath = job
+    try:
+        #Every caption of a background uses the same font.
+        if _batch.get('fontKey') != (fontPath,fontSize):
+            _batch['font'] = ImageFont.truetype(fontPath,fontSize)
+            _batch['fontKey'] = (fontPath,fontSize)
+        img = imagebuffers.image_copy(handle)
+        draw_text(img, textMultiLine, _batch['font'])
+        img.save(destFilePath, "JPEG", **JPEG_PROFILE)
+        return destFilePath, None
+    except Exception as e:
+        return destFilePath, str(e)
+
+def _render_caption(job):
+    """
+    Draws one laid out caption onto a copy of the shared background and
+    saves it.
 
-def create_images(images,texts,destDir,fontPath):
+    Args:
+        job (tuple): (text with its line breaks, destFilePath).
+
+    Returns:
+        tuple(string, string): destFilePath and an error message or None.
+    """
+    textMultiLine, destFilePath = job
+    try:
+        img = _batch['image'].copy()
+        draw_text(img, textMultiLine, _batch['font'])
+        img.save(destFilePath, "JPEG", **JPEG_PROFILE)
+        return destFilePath, None
+    except Exception as e:
+        return destFilePath, str(e)
+
+def generate_images(backgroundImagePath,texts,fontPath,destFilePaths,maxSize=None,processes=None):
+    """
+    Creates one image per text, all over the same background.
+    The background is decoded once, the font loaded once and every text
+    laid out once; the images are then drawn and encoded in parallel by
+    the render worker processes, see render_workers, which the decoded
+    background is handed to through a shared memory buffer rather than
+    pickled. Images found in the render cache are copied and the
+    background is not decoded at all if every one of them is.
+
+    Args:
+        backgroundImagePath (string): Path to the image file. Not modified.
+        texts (list of strings): the texts to draw, one image each.
+        fontPath (string): path to the font file to be used.
+        destFilePaths (list of strings): where to save each image.
+        maxSize (tuple) optional, (width, height) to scale the background
+            down to fit in before drawing. JPEGs are then decoded at a
+            reduced scale already.
+        processes (int) optional, number of processes drawing and
+            encoding, forked for this background. default is to use the
+            render workers, one per CPU.
+
+    Returns:
+        list of tuple(bool, string), per text: True if the image came from
+        the render cache, and an error message or None.
+    """
+    from PIL import Image
+    import multiprocessing
+    size = Image.open(backgroundImagePath).size
+    if maxSize:
+        size = fit_size(size,maxSize)
+    results = [(False,None)]*len(texts)
+    keys = [None]*len(texts)
+    if renderCache is not None:
+        with stats.timer('render_cache'):
+            digest = file_digest(backgroundImagePath)
+            for i,(text,dest) in enumerate(zip(texts,destFilePaths)):
+                keys[i] = render_key(digest,text,fontPath,size[1],maxSize)
+                if renderCache.get(keys[i],dest):
+                    results[i] = (True,None)
+                    stats.count('render_cache_hits')
+                    stats.count('bytes_out',os.path.getsize(dest))
+                    stats.count('images_created')
+    pending = [i for i in range(len(texts)) if not results[i][0]]
+    if not pending:
+        return results
+
+    with stats.timer('decode'):
+        img = Image.open(backgroundImagePath)
+        if img.size != size:
+            img.draft(img.mode,size)
+            img = img.resize(size,Image.ANTIALIAS)
+        else:
+            img.load()
+    width, height = size
+    with stats.timer('layout'):
+        _start_batch_worker(img,fontPath,font_size(height))
+        layouts = {}
+        for i in pending:
+            if texts[i] not in layouts:
+                layouts[texts[i]] = multiline_text(texts[i],width,height,_batch['font'])
+    jobs = [(layouts[texts[i]],destFilePaths[i]) for i in pending]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+        shared = True
+    else:
+        shared = False
+    processes = min(processes,len(jobs))
+    with stats.timer('render_batch'):
+        if processes > 1 and shared:
+            pool, buffers = render_workers()
+            handle = buffers.put(img)
+            try:
+                rendered = pool.map(_render_shared_caption,
+                                    [(handle,fontPath,font_size(height),layout,dest)
+                                     for layout,dest in jobs],chunksize=1)
+            finally:
+                buffers.release(handle)
+        elif processes > 1:
+            #Forked workers get the decoded background without copying it.
+            pool = multiprocessing.Pool(processes,initializer=_start_batch_worker,
+                                        initargs=(img,fontPath,font_size(height)))
+            try:
+                rendered = pool.map(_render_caption,jobs,chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            rendered = [_render_caption(job) for job in jobs]
+    _batch.clear()
+    for i,(dest,error) in zip(pending,rendered):
+        results[i] = (False,error)
+        if error:
+            continue
+        stats.count('bytes_out',os.path.getsize(dest))
+        stats.count('images_created')
+        if keys[i] is not None:
+            with stats.timer('render_cache'):
+                renderCache.put(keys[i],dest)
+    return results
+
+def finalize_image(key,partPaths,runJournal):
+    """
+    Renames the files rendered for a caption to their final names, where
+    uploadr picks them up, and records it in the run journal.
+
+    Args:
+        key (string): the caption's journal key.
+        partPaths (list of strings): the temporary paths of its files.
+        runJournal (RunJournal): the journal of the run.
+
+    Returns:
+        string, the final path of the first file.
+    """
+    paths = [partPath[:-len(PART_SUFFIX)] for partPath in partPaths]
+    for partPath,path in zip(partPaths,paths):
+        #Files renamed before a crash are already in place.
+        if os.path.exists(partPath):
+            os.rename(partPath,path)
+    runJournal.mark(key,'finalized',path=paths[0])
+    return paths[0]
+
+def is_rendered(item):
+    """
+    True if a caption's journal entry says its files were rendered and they
+    are all still there, under their temporary or their final name.
+    """
+    return item.get('stage') == 'rendered' and \
+        all(os.path.exists(partPath) or os.path.exists(partPath[:-len(PART_SUFFIX)])
+            for partPath in item['parts'])
+
+def create_images(images,texts,destDir,fontPath,renderer='pil',imageIds=None,
+                  captionsPerImage=1,maxSize=None,targets=None):
     """
     create image files with text from texts and background from images 
-    in destDir.
+    in destDir. Every image is used for captionsPerImage texts, in order.
+    Images are written under a temporary name and renamed once complete,
+    so uploadr never sees a partial one. With the run journal open, the
+    downloads and images an earlier attempt of the run completed are
+    reused, see RunJournal.
     
     Args:
         images (array of strings): urls of images. Assumes the images exist.
         texts (array of strings): texts to insert to images.
         destDir (string): local path where the files will be saved.        
         fontPath (string): path to the font file to be used.        
+        renderer (string) optional, 'pil' to draw the text with PIL or
+            'html' to render templates/template.html with wkhtmltoimage.
+        imageIds (array of strings) optional, the reddit post ID of each
+            image. With the image hash index open, downloaded images whose
+            post was not hashed yet are checked for duplicates and skipped.
+        captionsPerImage (int) optional, how many images to create from
+            each background, see generate_images.
+        maxSize (tuple) optional, (width, height) to scale the backgrounds
+            down to fit in. Not supported by the 'html' renderer.
+        targets (list of RenderTargets) optional, create every image in
+            each of these variants, in the targets' subdirectories of
+            destDir. Takes the place of maxSize. Not supported by the
+            'html' renderer.
     
     Returns:
-        An array of valid posts.
+        list of the created file paths, one per text (None if it failed).
+        With targets, the path of the largest variant.
     """    
+    #Several captions per background, a downscaled one or several targets
+    #render from a single download.
+    batch = captionsPerImage > 1 or bool(maxSize) or bool(targets)
+    runJournal = journal if journal is not None else RunJournal()
     i = 1
-    for image,text in zip(images,texts):
-        print("%d: downloading %s ..." %(i,image),end='')
-            
-        imageName = time.strftime("%Y-%m-%d.%H-%M-%S")+"-"+str(i)+'.jpg'
-        localImagePath = os.path.join(destDir,imageName)
-        download_image(image,localImagePath)
-        print("creating image %s" %localImagePath)
-        generate_image(localImagePath,text,fontPath)
+    created = []
+    htmlJobs = []
+    htmlCaptions = []
+    backgrounds = []
+    #Counted through the run stats, as images may come in several sizes.
+    cacheHits = stats.counters['render_cache_hits']
+    imagesCreated = stats.counters['images_created']
+    #Names the backgrounds up front, so the downloads still needed can run
+    #ahead of the rendering below, as many at once as downloadConcurrency
+    #allows. The loop takes them in the same order.
+    toDownload = []
+    for n,image in enumerate(images):
+        first = n*captionsPerImage
+        group = texts[first:(n+1)*captionsPerImage]
+        if not group:
+            break
+        imageKey = 'image-%d' %(n+1)
+        imageItem = runJournal.item(imageKey)
+        if imageItem.get('stage') == 'skipped':
+            continue
+        imageName = imageItem.get('name')
+        if imageName is None:
+            imageName = time.strftime("%Y-%m-%d.%H-%M-%S")+"-"+str(n+1)
+            runJournal.mark(imageKey,'selected',name=imageName)
+        textItems = [runJournal.item('text-%d' %j) for j in range(first,first+len(group))]
+        if all(item.get('stage') == 'finalized' or is_rendered(item) for item in textItems):
+            continue
+        localImagePath = os.path.join(destDir,imageName+'.background')
+        if not (imageItem.get('stage') == 'downloaded' and os.path.exists(localImagePath)):
+            toDownload.append((image,localImagePath))
+    downloading = set(path for image,path in toDownload)
+    downloads = downloadConcurrency.imap(lambda download: download_image(*download),toDownload)
+    for image in images:
+        first = (i-1)*captionsPerImage
+        group = texts[first:i*captionsPerImage]
+        if not group:
+            break
+        imageKey = 'image-%d' %i
+        textKeys = ['text-%d' %j for j in range(first,first+len(group))]
+        imageItem = runJournal.item(imageKey)
+        if imageItem.get('stage') == 'skipped':
+            print("%d: %s was skipped before." %(i,image))
+            created.extend([None]*len(group))
+            i+=1
+            continue
+        imageName = imageItem.get('name')
+        if imageName is None:
+            imageName = time.strftime("%Y-%m-%d.%H-%M-%S")+"-"+str(i)
+            runJournal.mark(imageKey,'selected',name=imageName)
+        #The download has an extension uploadr ignores, and is deleted once
+        #rendered.
+        localImagePath = os.path.join(destDir,imageName+'.background')
+        if batch:
+            destPaths = [os.path.join(destDir,"%s-%d.jpg" %(imageName,k+1))
+                         for k in range(len(group))]
+        else:
+            destPaths = [os.path.join(destDir,imageName+'.jpg')]
+        paths = [None]*len(group)
+        pending = []
+        for k,key in enumerate(textKeys):
+            item = runJournal.item(key)
+            if item.get('stage') == 'finalized':
+                paths[k] = item['path']
+            elif is_rendered(item):
+                paths[k] = finalize_image(key,item['parts'],runJournal)
+            else:
+                pending.append(k)
+        if not pending:
+            print("%d: images of %s were created before." %(i,image))
+            if os.path.exists(localImagePath):
+                os.remove(localImagePath)
+            runJournal.mark(imageKey,'finalized')
+            created.extend(paths)
+            i+=1
+            continue
+        if localImagePath not in downloading:
+            print("%d: reusing the download of %s ..." %(i,image),end='')
+        else:
+            print("%d: downloading %s ..." %(i,image),end='')
+            next(downloads)
+            runJournal.mark(imageKey,'downloaded')
+        if imageHashes is not None and imageIds and not imageHashes.has_post(imageIds[i-1]):
+            post = RedditPost(imageIds[i-1],image,None,None,None,None)
+            duplicate = find_duplicate(post,hash_file,localImagePath)
+            if duplicate:
+                print("skipped, duplicate of post %s." %duplicate[0])
+                reject_post(post,"duplicate of %s" %duplicate[0])
+                os.remove(localImagePath)
+                runJournal.mark(imageKey,'skipped')
+                created.extend([None]*len(group))
+                i+=1
+                continue
+        partPaths = [destPath+PART_SUFFIX for destPath in destPaths]
+        if renderer == 'html':
+            print("queued for rendering.")
+            for k in pending:
+                htmlJobs.append((localImagePath,group[k],fontPath,partPaths[k]))
+                htmlCaptions.append((len(created)+k,textKeys[k]))
+                paths[k] = destPaths[k]
+            backgrounds.append((imageKey,localImagePath))
+        elif targets:
+            print("creating %d images in %d sizes" %(len(pending),len(targets)))
+            for k in pending:
+                try:
+                    variants = generate_targets(localImagePath,group[k],fontPath,
+                                                partPaths[k],targets)
+                except Exception as e:
+                    print("failed to create %s: %s" %(destPaths[k],e))
+                    continue
+                variantParts = [path for path,fromCache in variants]
+                runJournal.mark(textKeys[k],'rendered',parts=variantParts)
+                paths[k] = finalize_image(textKeys[k],variantParts,runJournal)
+                for path,fromCache in variants:
+                    print("created image %s%s" %(path[:-len(PART_SUFFIX)],
+                                                 " (from render cache)" if fromCache else ""))
+        elif batch:
+            print("creating %d images" %len(pending))
+            results = generate_images(localImagePath,[group[k] for k in pending],fontPath,
+                                      [partPaths[k] for k in pending],maxSize)
+            for k,(fromCache,error) in zip(pending,results):
+                if error:
+                    print("failed to create %s: %s" %(destPaths[k],error))
+                    continue
+                runJournal.mark(textKeys[k],'rendered',parts=[partPaths[k]])
+                paths[k] = finalize_image(textKeys[k],[partPaths[k]],runJournal)
+                print("created image %s%s" %(paths[k]," (from render cache)" if fromCache else ""))
+        else:
+            print("creating image %s" %destPaths[0],end='')
+            fromCache = generate_image(localImagePath,group[0],fontPath,partPaths[0])
+            runJournal.mark(textKeys[0],'rendered',parts=[partPaths[0]])
+            paths[0] = finalize_image(textKeys[0],[partPaths[0]],runJournal)
+            print(" (from render cache)" if fromCache else "")
+        if renderer != 'html':
+            if os.path.exists(localImagePath):
+                os.remove(localImagePath)
+            runJournal.mark(imageKey,'finalized')
+        created.extend(paths)
         i+=1
+    if htmlJobs:
+        import htmlrender
+        print("rendering %d images with wkhtmltoimage ..." %len(htmlJobs))
+        with stats.timer('render_html'):
+            with htmlrender.HtmlRenderer() as htmlRenderer:
+                results = htmlRenderer.render(htmlJobs)
+        for (index,key),(partPath,error) in zip(htmlCaptions,results):
+            if error:
+                print("failed to render %s: %s" %(created[index],error))
+                created[index] = None
+            else:
+                runJournal.mark(key,'rendered',parts=[partPath])
+                finalize_image(key,[partPath],runJournal)
+                print("created image %s" %created[index])
+                stats.count('bytes_out',os.path.getsize(created[index]))
+                stats.count('images_created')
+        for imageKey,background in backgrounds:
+            os.remove(background)
+            runJournal.mark(imageKey,'finalized')
+    if renderCache is not None and renderer != 'html':
+        print("%d of %d images from the render cache." \
+            %(stats.counters['render_cache_hits']-cacheHits,
+              stats.counters['images_created']-imagesCreated))
+    close_render_workers()
     print("done.")
     print("all finished.")
+    return created
 
-def run(limit,imageSubreddits,textSubreddits,destDir,fontPath):
+def run(limit,imageSubreddits,textSubreddits,destDir,fontPath,renderer='pil',statsPath=None,
+        ledgerPath=None,ledgerExpiryDays=LEDGER_EXPIRY_DAYS,renderCacheDir=None,
+        renderCacheBytes=RENDER_CACHE_MB*1024*1024,captionsPerImage=1,maxSize=None,
+        targets=None,journalPath=None,resume=False):
     """
     create image files with text from textSubreddits ,
     and background from imageSubreddits.
     
     Args:
-        limit (int): The maximum number of images to create.
+        limit (int): The maximum number of background images to use.
         imageSubreddits (list of strings): all subreddits to take images from,
             orderd by priority, no "r/" 
         textSubreddits (list of strings): all subreddits to take text from,
             orderd by priority, no "r/" 
         destDir (string): local path where the files will be saved.
         fontPath (string): path to the font file to be used.                
+        renderer (string) optional, 'pil' or 'html'.
+        statsPath (string) optional, file the run's JSON summary is
+            appended to.
+        ledgerPath (string) optional, SQLite file of the seen-post ledger.
+            Posts handled by earlier runs are skipped. None disables it.
+        ledgerExpiryDays (float) optional, how long the ledger remembers
+            a post. The perceptual hashes of the images used, which catch
+            the same photo posted under other urls, are kept in the same
+            file for as long.
+        renderCacheDir (string) optional, directory of the render cache,
+            which makes reruns copy the images they rendered before.
+            None disables it.
+        renderCacheBytes (int) optional, byte budget of the render cache.
+        captionsPerImage (int) optional, images created from every
+            background, each with its own text.
+        maxSize (tuple) optional, (width, height) the backgrounds are
+            scaled down to fit in.
+        targets (list of RenderTargets) optional, sizes and encoder
+            settings to create every image in, each in its own
+            subdirectory of destDir.
+        journalPath (string) optional, JSON file the run records its
+            progress in, see RunJournal. None disables it.
+        resume (bool) optional, continue the unfinished run in the journal,
+            if it had the same settings, instead of starting a new one.
+            The files of an unfinished run that is not resumed are deleted.
+
+    Returns:
+        dict: the run's summary, see RunStats.summary.
     """    
+    global ledger, imageHashes, renderCache, journal
+    stats.reset()
+    #As stored in the journal, where tuples become lists.
+    settings = json.loads(json.dumps({'dest': destDir, 'renderer': renderer,
+        'captions_per_image': captionsPerImage, 'max_size': maxSize, 'targets': targets}))
+    resumed = False
+    if journalPath:
+        journal = RunJournal(journalPath)
+        resumed = journal.load(settings) and resume
+        if not resumed:
+            if not journal.state['finished']:
+                journal.clean(destDir)
+            journal = RunJournal(journalPath)
+    if renderCacheDir:
+        renderCache = RenderCache(renderCacheDir,renderCacheBytes)
+    if ledgerPath:
+        ledger = PostLedger(ledgerPath,ledgerExpiryDays)
+        imageHashes = ImageHashIndex(ledger.con,expiryDays=ledgerExpiryDays)
+    try:
+        if resumed:
+            imagePosts, textPosts = journal.posts()
+            print("resuming the run started %s with %d images and %d texts." \
+                %(journal.state['started'],len(imagePosts),len(textPosts)))
+        else:
+            with stats.timer('reddit'):
+                imagePosts, textPosts = get_reddit_posts(imageSubreddits,textSubreddits,limit,
+                                                         captionsPerImage)
+            if journal is not None:
+                journal.select(imagePosts,textPosts,settings)
+        images = [fix_image_url(post.url) for post in imagePosts]
+        texts = [post.title for post in textPosts]
+        with stats.timer('create_images'):
+            created = create_images(images,texts,destDir,fontPath,renderer,
+                                    [post.id for post in imagePosts],captionsPerImage,maxSize,
+                                    targets)
+        if ledger is not None:
+            for textPost,path in zip(textPosts,created):
+                if path:
+                    ledger.rendered(textPost.id,path)
+            for n,imagePost in enumerate(imagePosts):
+                paths = [path for path in created[n*captionsPerImage:(n+1)*captionsPerImage] if path]
+                if paths:
+                    ledger.rendered(imagePost.id,paths[0])
+        if journal is not None:
+            journal.finish()
+    finally:
+        journal = None
+        close_render_workers()
+        if imageHashes is not None:
+            imageHashes.close()
+            imageHashes = None
+        if renderCache is not None:
+            renderCache.close()
+            renderCache = None
+        if ledger is not None:
+            ledger.close()
+            ledger = None
+    summary = stats.summary()
+    print("run took %.1fs: %d images, %.2f images/s, %d bytes in, %d bytes out." \
+        %(summary['wall_time'],summary['images'],summary['images_per_second'],
+          summary['bytes_in'],summary['bytes_out']))
+    print("%d image sizes probed over the network, %d read from listing metadata." \
+        %(summary['counters'].get('probes',0),summary['counters'].get('probes_avoided',0)))
+    for stage,timer in sorted(summary['stages'].items()):
+        print("  %-15s %8.3fs in %d calls" %(stage,timer['seconds'],timer['calls']))
+    if statsPath:
+        stats.write(statsPath)
+    return summary
     
-    images, texts = get_reddit_content(imageSubreddits,textSubreddits,limit)
-    create_images(images,texts,destDir,fontPath)
-    
+def enqueue_posts(queuePath,limit,imageSubreddits,textSubreddits,captionsPerImage=1,
+                  ledgerPath=None,ledgerExpiryDays=LEDGER_EXPIRY_DAYS):
+    """
+    Selects posts as run does, and queues a 'render' job for every
+    background with its captions instead of creating the images.
+    The posts are recorded in the ledger as queued, so that the next
+    selection skips them while their jobs wait.
+
+    Args:
+        queuePath (string): SQLite file of the job queue, see jobqueue.
+        limit, imageSubreddits, textSubreddits, captionsPerImage,
+        ledgerPath, ledgerExpiryDays: as for run.
+
+    Returns:
+        list of ints: the ids of the queued jobs.
+    """
+    import jobqueue
+    global ledger, imageHashes
+    if ledgerPath:
+        ledger = PostLedger(ledgerPath,ledgerExpiryDays)
+        imageHashes = ImageHashIndex(ledger.con,expiryDays=ledgerExpiryDays)
+    queue = jobqueue.JobQueue(queuePath)
+    jobIds = []
+    try:
+        imagePosts, textPosts = get_reddit_posts(imageSubreddits,textSubreddits,limit,
+                                                 captionsPerImage)
+        stamp = time.strftime("%Y-%m-%d.%H-%M-%S")
+        for n,imagePost in enumerate(imagePosts):
+            group = textPosts[n*captionsPerImage:(n+1)*captionsPerImage]
+            if not group:
+                break
+            jobIds.append(queue.put('render',{'stamp': stamp,
+                'image': list(imagePost), 'texts': [list(post) for post in group]}))
+            if ledger is not None:
+                for post in [imagePost]+group:
+                    ledger.queued(post.id)
+    finally:
+        queue.close()
+        if imageHashes is not None:
+            imageHashes.close()
+            imageHashes = None
+        if ledger is not None:
+            ledger.close()
+            ledger = None
+    print("queued %d render jobs." %len(jobIds))
+    return jobIds
+
+def render_job(job,queue,destDir,fontPath,renderer='pil',maxSize=None,targets=None,
+               ledgerPath=None,ledgerExpiryDays=LEDGER_EXPIRY_DAYS):
+    """
+    Downloads a render job's background and creates its images with
+    create_images, then queues an 'upload' job for each file created.
+    The images are named after the job, so a retry overwrites what a
+    failed attempt left. Jobs do not use the render cache, nor check the
+    download for duplicates: their SQLite files would stay locked for the
+    other workers while the job renders. Raises if no image was created.
+
+    Args:
+        job (jobqueue.Job): payload as queued by enqueue_posts.
+        queue (jobqueue.JobQueue): the queue, for the upload jobs.
+        destDir, fontPath, renderer, maxSize, targets: as for run.
+        ledgerPath (string) optional, ledger the rendered posts are
+            recorded in.
+    """
+    global journal
+    imagePost = RedditPost(*job.payload['image'])
+    textPosts = [RedditPost(*post) for post in job.payload['texts']]
+    runJournal = RunJournal()
+    runJournal.mark('image-1','selected',name='%s-q%d' %(job.payload['stamp'],job.id))
+    journal = runJournal
+    try:
+        created = create_images([fix_image_url(imagePost.url)],[post.title for post in textPosts],
+                                destDir,fontPath,renderer,None,len(textPosts),maxSize,targets)
+    finally:
+        journal = None
+    if not any(created):
+        raise RuntimeError("no image created from %s" %imagePost.url)
+    for n in range(len(textPosts)):
+        item = runJournal.item('text-%d' %n)
+        if item.get('stage') == 'finalized':
+            for partPath in item['parts']:
+                queue.put('upload',{'path': partPath[:-len(PART_SUFFIX)]})
+    if ledgerPath:
+        jobLedger = PostLedger(ledgerPath,ledgerExpiryDays)
+        try:
+            for textPost,path in zip(textPosts,created):
+                if path:
+                    jobLedger.rendered(textPost.id,path)
+            jobLedger.rendered(imagePost.id,[path for path in created if path][0])
+        finally:
+            jobLedger.close()
+
+#uploadr instance of the upload workers of this process.
+uploader = None
+
+def upload_job(job):
+    """
+    Uploads the file of an upload job with uploadr, configured by its
+    uploadr.ini. Raises if the file is neither uploaded nor found on Flickr
+    already, so the job is retried.
+    """
+    global uploader
+    import uploadr
+    if uploader is None:
+        uploadr.loadConfig()
+        uploader = uploadr.Uploadr()
+        #Upload workers run alongside each other and uploadr's own runs.
+        uploader.shared = True
+        uploader.setupDB()
+        if not uploader.hasValidToken():
+            raise RuntimeError("uploadr has no valid Flickr token, run uploadr.py once first")
+    path = job.payload['path']
+    if not os.path.exists(path):
+        print("%s is gone, not uploading it." %path)
+        return
+    if not uploader.claimLease(path):
+        #Not a failure of the job: it is tried again once the lease may be over.
+        import jobqueue
+        raise jobqueue.Delay(jobqueue.RETRY_DELAY,"%s is being uploaded by another uploadr" %path)
+    #A copy of a photo already on Flickr is not uploaded, but recorded.
+    try:
+        uploader.uploadFile(path)
+    finally:
+        uploader.releaseLease(path)
+    if not uploader.isUploaded(path):
+        raise RuntimeError("could not upload %s" %path)
+
+def release_posts(job,ledgerPath,ledgerExpiryDays=LEDGER_EXPIRY_DAYS):
+    """
+    Makes the posts of a render job that failed for good candidates again
+    in the ledger, rather than skipped as queued until they expire.
+    """
+    jobLedger = PostLedger(ledgerPath,ledgerExpiryDays)
+    try:
+        for post in [job.payload['image']]+job.payload['texts']:
+            jobLedger.release(RedditPost(*post).id)
+    finally:
+        jobLedger.close()
+
+def work_stage(queuePath,stage,processes=1,wait=False,**settings):
+    """
+    Runs workers taking the jobs of a stage from the queue, in this process
+    or in several, until the stage is drained (or forever with wait).
+
+    Args:
+        queuePath (string): SQLite file of the job queue.
+        stage (string): 'render' or 'upload'.
+        processes (int) optional, number of worker processes.
+        wait (bool) optional, keep waiting for new jobs.
+        settings: the keyword arguments of render_job, for 'render'.
+    """
+    if processes > 1:
+        import multiprocessing
+        workers = [multiprocessing.Process(target=work_stage,args=(queuePath,stage,1,wait),
+                                           kwargs=settings) for i in range(processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return
+    import jobqueue
+    onFailed = None
+    if stage == 'render' and settings.get('ledgerPath'):
+        onFailed = lambda job: release_posts(job,settings['ledgerPath'],
+                                             settings.get('ledgerExpiryDays',LEDGER_EXPIRY_DAYS))
+    queue = jobqueue.JobQueue(queuePath,onFailed=onFailed)
+    if stage == 'render':
+        handler = lambda job: render_job(job,queue,**settings)
+    else:
+        handler = upload_job
+    try:
+        completed, failed = jobqueue.work(queue,stage,handler,wait)
+    finally:
+        queue.close()
+    print("%s worker %s: %d jobs done, %d failed." %(stage,jobqueue.worker_name(),completed,failed))
+
+def print_queue(queuePath):
+    """
+    Prints the number of jobs of every stage in each state.
+    """
+    import jobqueue
+    queue = jobqueue.JobQueue(queuePath)
+    try:
+        counts = queue.counts()
+    finally:
+        queue.close()
+    for stage in sorted(set(stage for stage,state in counts)):
+        print("%-8s %s" %(stage,", ".join("%d %s" %(counts.get((stage,state),0),state)
+              for state in ('queued','running','done','failed'))))
+
 class ShinyChromeShowerConfig():
-    def __init__(self,limit=0,imageSubreddits=[],textSubreddits=[],destDir='',fontPath=''):
+    def __init__(self,limit=0,imageSubreddits=[],textSubreddits=[],destDir='',fontPath='',renderer='pil',
+                 captionsPerImage=1,maxSize=None,targets=''):
         """
         Create configuration object.
         
@@ -406,17 +1983,28 @@ class ShinyChromeShowerConfig():
                 orderd by priority, no "r/" 
             destDir (string): local path where the files will be saved.
             fontPath (string): path to the font file to be used.
+            renderer (string): 'pil' or 'html', the backend drawing the text.
+            captionsPerImage (int): images created from every background.
+            maxSize (tuple): (width, height) backgrounds are scaled down
+                to fit in, None to keep their size.
+            targets (string): output variants, see parse_targets. Empty
+                for a single full size image.
         """  
         self.limit           = limit
         self.imageSubreddits = imageSubreddits
         self.textSubreddits  = textSubreddits 
         self.destDir         = destDir
         self.fontPath        = fontPath
+        self.renderer        = renderer
+        self.captionsPerImage = captionsPerImage
+        self.maxSize         = maxSize
+        self.targets         = targets
         
     def load_file(self,filePath):
         """
         Load configuration object with data from config file.
-        Fails if a parameter is missing.
+        Fails if a parameter is missing, except for the optional renderer,
+        captions_per_image, max_size and targets.
         
         Args:
             filePath (string): Path to configuration file.
@@ -428,6 +2016,14 @@ class ShinyChromeShowerConfig():
         self.fontPath        = config.get('Settings',   'font_path'       )
         self.imageSubreddits = config.get('Settings',   'image_subreddits').split()
         self.textSubreddits  = config.get('Settings',   'text_subreddits').split()
+        if config.has_option('Settings','renderer'):
+            self.renderer    = config.get('Settings',   'renderer'        )
+        if config.has_option('Settings','captions_per_image'):
+            self.captionsPerImage = config.getint('Settings','captions_per_image')
+        if config.has_option('Settings','max_size'):
+            self.maxSize     = parse_size(config.get('Settings','max_size'))
+        if config.has_option('Settings','targets'):
+            self.targets     = config.get('Settings',   'targets'         )
 
     def load_namespace(self,namespace):
         """
@@ -456,6 +2052,22 @@ class ShinyChromeShowerConfig():
         try:
             self.fontPath        = namespace.fontPath
         except AttributeError: pass
+
+        try:
+            self.renderer        = namespace.renderer
+        except AttributeError: pass
+
+        try:
+            self.captionsPerImage = namespace.captionsPerImage
+        except AttributeError: pass
+
+        try:
+            self.maxSize         = namespace.maxSize
+        except AttributeError: pass
+
+        try:
+            self.targets         = namespace.targets
+        except AttributeError: pass
         
     def _list2str(self,l):
         """
@@ -488,11 +2100,16 @@ class ShinyChromeShowerConfig():
         config.set('Settings','text_subreddits ' ,self._list2str(self.textSubreddits))
         config.set('Settings','dest_dir'         ,self.destDir)
         config.set('Settings','font_path'        ,self.fontPath)    
+        config.set('Settings','renderer'         ,self.renderer)
+        config.set('Settings','captions_per_image',str(self.captionsPerImage))
+        config.set('Settings','max_size'         ,'%dx%d' %self.maxSize if self.maxSize else '')
+        config.set('Settings','targets'          ,self.targets)
 
         config.write(cfgfile)
         cfgfile.close()
 
 if __name__ == "__main__":
+    import argparse
     #Default config
     config = ShinyChromeShowerConfig(
         limit           = 10,
@@ -549,6 +2166,70 @@ if __name__ == "__main__":
     argparser.add_argument("--font","-f",type=check_font_path,default=config.fontPath,
         help="The path of the .ttf font file.", 
         metavar="font_path", dest="fontPath")      
+    argparser.add_argument("--renderer","-r",choices=['pil','html'],default=config.renderer,
+        help="""How the text is drawn: 'pil' draws it with PIL, 'html' renders
+        templates/template.html with wkhtmltoimage.""",
+        dest="renderer")
+    argparser.add_argument("--captions-per-image","-k",type=check_positive,
+        default=config.captionsPerImage,
+        help='''How many images to create from every background image, each with
+        its own text. The background is downloaded and decoded once for all.''',
+        metavar="number", dest="captionsPerImage")
+    argparser.add_argument("--max-size",type=parse_size,default=config.maxSize,
+        help="Scale the background images down to fit in WIDTHxHEIGHT, e.g. 1920x1080 (pil renderer only).",
+        metavar="WIDTHxHEIGHT", dest="maxSize")
+    argparser.add_argument("--targets",type=str,default=config.targets,
+        help='''Create every image in several sizes from one decode, each in a
+        subdirectory of the destination (uploaded as its own Flickr set). Written as
+        NAME=WIDTHxHEIGHT[@JPEG_QUALITY] separated by spaces, e.g.
+        "4k=3840x2160@90 1080p=1920x1080" (pil renderer only).''',
+        metavar="targets", dest="targets")
+    argparser.add_argument("--stats-file","-s",type=str,default=get_resource_path('stats.jsonl'),
+        help="File a JSON summary of every run (timings, bytes, images/s) is appended to.",
+        metavar="stats_file_path", dest="statsPath")
+    argparser.add_argument("--ledger",type=str,default=get_resource_path('ledger.db'),
+        help="SQLite file remembering the posts already handled, which later runs skip.",
+        metavar="ledger_path", dest="ledgerPath")
+    argparser.add_argument("--ledger-expiry",type=float,default=LEDGER_EXPIRY_DAYS,
+        help="Days after which a handled post may be used again. 0 disables the ledger.",
+        metavar="days", dest="ledgerExpiryDays")
+    argparser.add_argument("--render-cache",type=str,default=get_resource_path('cache'),
+        help="Directory of the cache of rendered images, reused when a run is repeated.",
+        metavar="directory_path", dest="renderCacheDir")
+    argparser.add_argument("--render-cache-size",type=float,default=RENDER_CACHE_MB,
+        help="Megabytes the render cache may hold. 0 disables it.",
+        metavar="megabytes", dest="renderCacheMB")
+    argparser.add_argument("--journal",type=str,default=get_resource_path('journal.json'),
+        help="File each run records its progress in, so that it can be resumed.",
+        metavar="journal_path", dest="journalPath")
+    argparser.add_argument("--resume",action="store_true",
+        help='''Continue the last run if it did not finish, reusing the posts,
+        downloads and images it got to, instead of starting a new one.''',
+        dest="resume")
+    argparser.add_argument("--queue",type=str,default=get_resource_path('queue.db'),
+        help="SQLite file of the job queue used by --enqueue and --worker.",
+        metavar="queue_path", dest="queuePath")
+    argparser.add_argument("--enqueue",action="store_true",
+        help="Select posts and queue a render job for each image, instead of creating the images.",
+        dest="enqueue")
+    argparser.add_argument("--worker",choices=['render','upload'],default=None,
+        help='''Take jobs from the queue until it is drained: 'render' downloads
+        the images and creates the wallpapers, queuing them for upload, and 'upload'
+        uploads them with uploadr. Workers may run on several hosts sharing the queue.''',
+        dest="worker")
+    argparser.add_argument("--processes",type=check_positive,default=1,
+        help="Number of --worker processes to run.",
+        metavar="number", dest="processes")
+    argparser.add_argument("--wait",action="store_true",
+        help="Keep --worker waiting for new jobs once the queue is drained.",
+        dest="wait")
+    argparser.add_argument("--queue-status",action="store_true",
+        help="Print the number of queued, running, done and failed jobs and exit.",
+        dest="queueStatus")
+    argparser.add_argument("--profile","-p",nargs='?',const=get_resource_path('profile.prof'),
+        default=None,
+        help="Run under cProfile and save the profile to this file (default profile.prof).",
+        metavar="profile_path", dest="profilePath")
     
     argparams = argparser.parse_args()
     
@@ -561,10 +2242,46 @@ if __name__ == "__main__":
     if not os.path.exists(config.destDir):
         os.makedirs(config.destDir)
 
-    #Run.
-    run(config.limit,\
-        config.imageSubreddits,\
-        config.textSubreddits,\
-        config.destDir,\
-        config.fontPath)
+    ledgerPath = argparams.ledgerPath if argparams.ledgerExpiryDays > 0 else None
+    if argparams.queueStatus:
+        print_queue(argparams.queuePath)
+    elif argparams.enqueue or argparams.worker:
+        if argparams.enqueue:
+            enqueue_posts(argparams.queuePath,config.limit,config.imageSubreddits,
+                          config.textSubreddits,max(config.captionsPerImage,1),
+                          ledgerPath,argparams.ledgerExpiryDays)
+        if argparams.worker == 'render':
+            work_stage(argparams.queuePath,'render',argparams.processes,argparams.wait,
+                       destDir=config.destDir,fontPath=config.fontPath,renderer=config.renderer,
+                       maxSize=config.maxSize,targets=parse_targets(config.targets),
+                       ledgerPath=ledgerPath,ledgerExpiryDays=argparams.ledgerExpiryDays)
+        elif argparams.worker == 'upload':
+            work_stage(argparams.queuePath,'upload',argparams.processes,argparams.wait)
+    else:
+        #Run.
+        runArgs = (config.limit,\
+            config.imageSubreddits,\
+            config.textSubreddits,\
+            config.destDir,\
+            config.fontPath,\
+            config.renderer,\
+            argparams.statsPath,\
+            ledgerPath,\
+            argparams.ledgerExpiryDays,\
+            argparams.renderCacheDir if argparams.renderCacheMB > 0 else None,\
+            int(argparams.renderCacheMB*1024*1024),\
+            max(config.captionsPerImage,1),\
+            config.maxSize,\
+            parse_targets(config.targets),\
+            argparams.journalPath,\
+            argparams.resume)
+        if argparams.profilePath:
+            import cProfile, pstats
+            profiler = cProfile.Profile()
+            profiler.runcall(run,*runArgs)
+            profiler.dump_stats(argparams.profilePath)
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+            print("profile saved to %s" %argparams.profilePath)
+        else:
+            run(*runArgs)
          
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the adaptive concurrency limit against fixed ones.
+
+Runs a number of requests (300 by default) against a simulated host that
+serves `capacity` requests at once in its base latency: the others wait
+for a slot, and the requests over twice the capacity in flight are
+throttled, failing.
+Each run uses concurrency.ConcurrencyController.imap, with the limit
+fixed at 1, at the capacity and at 16, then adaptive from 2. Reports the
+requests per second, the errors and the median latency of every run, and
+the adaptive run's decisions.
+
+usage: python benchmarks/bench_concurrency.py [--requests N]
+           [--capacity N] [--latency S]
+"""
+from __future__ import print_function
+import os, sys, time, argparse, threading
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import concurrency
+
+class SimulatedHost(object):
+    def __init__(self, capacity, latency):
+        self.capacity = capacity
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(capacity)
+        self.inFlight = 0
+        self.errors = 0
+        self.latencies = []
+
+    def request(self, n):
+        with self.lock:
+            self.inFlight += 1
+            load = self.inFlight
+        start = time.time()
+        try:
+            if load > 2*self.capacity:
+                with self.lock:
+                    self.errors += 1
+                time.sleep(self.latency/4)
+                raise IOError("HTTP Error 429: Too Many Requests")
+            with self.slots:
+                time.sleep(self.latency)
+            return n
+        finally:
+            with self.lock:
+                self.inFlight -= 1
+                self.latencies.append(time.time() - start)
+
+def bench(controller, host, requests):
+    start = time.time()
+    results = controller.imap(host.request, range(requests))
+    done = 0
+    while True:
+        try:
+            next(results)
+            done += 1
+        except StopIteration:
+            break
+        except IOError:
+            pass
+    elapsed = time.time() - start
+    latencies = sorted(host.latencies)
+    return done, elapsed, latencies[len(latencies)//2]
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Adaptive concurrency benchmark')
+    argparser.add_argument("--requests", type=int, default=300)
+    argparser.add_argument("--capacity", type=int, default=4,
+        help="Requests the simulated host serves at once at its base latency.")
+    argparser.add_argument("--latency", type=float, default=0.05,
+        help="Base latency of a request, in seconds.")
+    args = argparser.parse_args()
+
+    runs = [("fixed 1", 1, 1), ("fixed %d" % args.capacity, args.capacity, args.capacity),
+            ("fixed 16", 16, 16), ("adaptive", 2, 16)]
+    print("%d requests, host capacity %d, base latency %.3fs" % (args.requests, args.capacity, args.latency))
+    print("%-10s %8s %8s %12s %10s" % ("", "req/s", "errors", "median lat.", "end limit"))
+    for name, initial, maximum in runs:
+        decisions = []
+        minimum = initial if initial == maximum else 1
+        controller = concurrency.ConcurrencyController(name, initial=initial, minimum=minimum,
+                                                       maximum=maximum, log=decisions.append)
+        host = SimulatedHost(args.capacity, args.latency)
+        done, elapsed, median = bench(controller, host, args.requests)
+        print("%-10s %8.1f %8d %11.3fs %10d" % (name, done/elapsed, host.errors, median, controller.limit))
+    for decision in decisions:
+        print("  " + decision)
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the perceptual-hash duplicate check.
+
+Fills an ImageHashIndex with random 64 bit hashes (100k by default) and
+reports the insert rate, the time to load the index back from SQLite and
+the lookup throughput for misses and for near duplicates of stored hashes,
+next to a linear scan over all hashes. Also times dhash on a wallpaper
+sized JPEG, decoded at thumbnail scale with draft() and at full size.
+
+usage: python benchmarks/bench_phash.py [--hashes N] [--lookups N]
+           [--distance D]
+"""
+from __future__ import print_function
+import os, sys, io, time, random, shutil, sqlite3, argparse, tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from PIL import Image
+import ShinyChromeShower
+import replay
+
+def flip_bits(value, count, rng):
+    """
+    value with count distinct random bits flipped.
+    """
+    for bit in rng.sample(range(64), count):
+        value ^= 1 << bit
+    return value
+
+def linear_find(hashes, value, maxDistance):
+    for candidate in hashes:
+        if bin(candidate ^ value).count('1') <= maxDistance:
+            return candidate
+    return None
+
+def rate(count, elapsed):
+    return count/elapsed if elapsed else float('inf')
+
+def bench_index(args, dbPath):
+    rng = random.Random(args.seed)
+    hashes = [rng.getrandbits(64) for i in range(args.hashes)]
+
+    con = sqlite3.connect(dbPath)
+    start = time.time()
+    index = ShinyChromeShower.ImageHashIndex(con, args.distance)
+    for i, value in enumerate(hashes):
+        index.add(value, 'p%d' % i)
+    index.close()
+    elapsed = time.time() - start
+    con.close()
+    print("insert     %7d hashes in %7.3fs  %10.0f/s" % (len(hashes), elapsed, rate(len(hashes), elapsed)))
+
+    con = sqlite3.connect(dbPath)
+    start = time.time()
+    index = ShinyChromeShower.ImageHashIndex(con, args.distance)
+    elapsed = time.time() - start
+    print("load       %7d hashes in %7.3fs" % (len(index), elapsed))
+
+    misses = [rng.getrandbits(64) for i in range(args.lookups)]
+    near = [flip_bits(rng.choice(hashes), rng.randint(0, args.distance), rng)
+            for i in range(args.lookups)]
+    for name, queries in (('miss', misses), ('near dup', near)):
+        start = time.time()
+        found = sum(1 for value in queries if index.find(value))
+        elapsed = time.time() - start
+        print("%-10s %7d lookups in %7.3fs  %10.0f/s  %d found" %
+              (name, len(queries), elapsed, rate(len(queries), elapsed), found))
+
+    sample = near[:args.linear]
+    start = time.time()
+    found = sum(1 for value in sample if linear_find(hashes, value, args.distance) is not None)
+    elapsed = time.time() - start
+    print("%-10s %7d lookups in %7.3fs  %10.0f/s  %d found" %
+          ('linear', len(sample), elapsed, rate(len(sample), elapsed), found))
+    con.close()
+
+def bench_dhash(args):
+    data = replay.synthetic_jpeg('bench_phash', 3840, 2160)
+    for name, prepare in (('draft', lambda img: None),
+                          ('full decode', lambda img: img.load())):
+        start = time.time()
+        for i in range(args.images):
+            img = Image.open(io.BytesIO(data))
+            prepare(img)
+            ShinyChromeShower.dhash(img)
+        elapsed = time.time() - start
+        print("dhash %-11s %4d images 3840x2160 in %6.3fs  %7.1f ms/image" %
+              (name, args.images, elapsed, 1000*elapsed/args.images))
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Perceptual hash benchmark')
+    argparser.add_argument("--hashes", type=int, default=100000,
+        help="Number of hashes stored in the index.")
+    argparser.add_argument("--lookups", type=int, default=10000,
+        help="Number of lookups of each kind.")
+    argparser.add_argument("--linear", type=int, default=200,
+        help="Number of lookups done by linear scan, for comparison.")
+    argparser.add_argument("--distance", type=int, default=ShinyChromeShower.HASH_MAX_DISTANCE,
+        help="Largest number of differing bits counted as a duplicate.")
+    argparser.add_argument("--images", type=int, default=10,
+        help="Number of images hashed by the dhash benchmark.")
+    argparser.add_argument("--seed", type=int, default=1)
+    args = argparser.parse_args()
+
+    workDir = tempfile.mkdtemp(prefix='bench_phash')
+    try:
+        bench_index(args, os.path.join(workDir, 'hashes.db'))
+        bench_dhash(args)
+    finally:
+        shutil.rmtree(workDir)
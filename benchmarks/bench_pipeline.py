@@ -0,0 +1,245 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Offline end-to-end benchmark of the wallpaper pipeline.
+
+Runs get_posts, create_images and Uploadr.upload against the local fixture
+server from replay.py and reports, per stage, throughput, p50/p99 latency
+and the peak RSS of the process once the stage finished. Results can be
+saved as JSON and compared with a saved baseline, failing when a stage got
+slower than the tolerance allows.
+
+usage: python benchmarks/bench_pipeline.py [--limit N] [--latency S]
+           [--bandwidth B] [--json results.json]
+           [--baseline baseline.json --tolerance 0.2]
+"""
+from __future__ import print_function
+import os, sys, time, json, shutil, argparse, tempfile, resource, contextlib
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import replay
+import ShinyChromeShower
+
+def percentile(values, fraction):
+    """
+    The value below which the given fraction of values fall.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered)-1, int(round(fraction*(len(ordered)-1))))]
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+@contextlib.contextmanager
+def quiet(enabled=True):
+    """
+    Silences the pipeline's progress output while a stage is measured.
+    """
+    if not enabled:
+        yield
+        return
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+class Stage(object):
+    """
+    Latencies of the items processed by one pipeline stage.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.elapsed = 0.0
+        self.peakRss = 0
+
+    @contextlib.contextmanager
+    def item(self):
+        start = time.time()
+        yield
+        self.latencies.append(time.time() - start)
+
+    def summary(self):
+        count = len(self.latencies)
+        return {'items': count,
+                'seconds': round(self.elapsed, 4),
+                'throughput': round(count/self.elapsed, 3) if self.elapsed else 0.0,
+                'p50_ms': round(1000*percentile(self.latencies, 0.50), 2),
+                'p99_ms': round(1000*percentile(self.latencies, 0.99), 2),
+                'peak_rss_kb': self.peakRss}
+
+def import_uploadr(workDir, filesDir):
+    """
+    Imports uploadr configured by the shipped uploadr.ini, with its files,
+    database and token redirected into workDir.
+    """
+    import uploadr
+    uploadr.loadConfig(os.path.join(ROOT_DIR, 'uploadr.ini'))
+    uploadr.FILES_DIR = filesDir
+    uploadr.DB_PATH = os.path.join(workDir, 'flickrdb')
+    uploadr.TOKEN_PATH = os.path.join(workDir, '.flickrToken')
+    uploadr.FLICKR['api_key'] = 'replay'
+    uploadr.FLICKR['secret'] = 'replay'
+    uploadr.args = argparse.Namespace(daemon=False, title=None, description=None,
+                                      tags=None, drip_feed=False, metrics_port=None,
+                                      metrics_textfile=None)
+    with open(uploadr.TOKEN_PATH, 'w') as token:
+        token.write('72157600000000000-replay')
+    return uploadr
+
+def bench_get_posts(args):
+    stage = Stage('get_posts')
+    #Warm up: the fixture server generates its images on first request.
+    ShinyChromeShower.get_posts(args.image_subs, args.limit, ShinyChromeShower.filter_image)
+    start = time.time()
+    for i in range(args.rounds):
+        with stage.item():
+            imagePosts = ShinyChromeShower.get_posts(args.image_subs, args.limit,
+                                                     ShinyChromeShower.filter_image)
+        with stage.item():
+            textPosts = ShinyChromeShower.get_posts(args.text_subs, len(imagePosts),
+                                                    ShinyChromeShower.filter_text)
+    stage.elapsed = time.time() - start
+    images = [ShinyChromeShower.fix_image_url(post.url) for post in imagePosts]
+    texts = [post.title for post in textPosts]
+    return stage, images, texts
+
+def bench_create_images(images, texts, destDir, fontPath):
+    """
+    Runs create_images once over all images. An item's latency is the time
+    between the completion of the previous image and its own, taken when
+    generate_image returns.
+    """
+    stage = Stage('create_images')
+    generate_image = ShinyChromeShower.generate_image
+    last = [time.time()]
+
+    def timed_generate_image(*args, **kwargs):
+        result = generate_image(*args, **kwargs)
+        now = time.time()
+        stage.latencies.append(now - last[0])
+        last[0] = now
+        return result
+
+    ShinyChromeShower.generate_image = timed_generate_image
+    try:
+        start = last[0] = time.time()
+        ShinyChromeShower.create_images(images, texts, destDir, fontPath)
+        stage.elapsed = time.time() - start
+    finally:
+        ShinyChromeShower.generate_image = generate_image
+    return stage
+
+def bench_upload(uploadr):
+    stage = Stage('upload')
+
+    class TimedUploadr(uploadr.Uploadr):
+        def uploadFile(self, file, *args):
+            with stage.item():
+                return uploadr.Uploadr.uploadFile(self, file, *args)
+
+    flick = TimedUploadr()
+    flick.setupDB()
+    flick.checkToken()
+    start = time.time()
+    flick.upload()
+    stage.elapsed = time.time() - start
+    return stage
+
+def compare(results, baseline, tolerance):
+    """
+    Lists the stages whose throughput dropped or whose p99 latency grew by
+    more than the tolerance compared with the baseline.
+    """
+    regressions = []
+    for name, stage in results['stages'].items():
+        base = baseline['stages'].get(name)
+        if not base:
+            continue
+        if base['throughput'] and stage['throughput'] < base['throughput']*(1-tolerance):
+            regressions.append("%s throughput %.2f/s < baseline %.2f/s"
+                               % (name, stage['throughput'], base['throughput']))
+        if base['p99_ms'] and stage['p99_ms'] > base['p99_ms']*(1+tolerance):
+            regressions.append("%s p99 %.1fms > baseline %.1fms"
+                               % (name, stage['p99_ms'], base['p99_ms']))
+    return regressions
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Offline pipeline benchmark')
+    argparser.add_argument("--limit", type=int, default=10,
+        help="The maximum number of images to create.")
+    argparser.add_argument("--rounds", type=int, default=3,
+        help="How many times the reddit listings are fetched and filtered.")
+    argparser.add_argument("--image-subs", nargs="+", default=["EarthPorn", "SkyPorn"])
+    argparser.add_argument("--text-subs", nargs="+", default=["Showerthoughts"])
+    argparser.add_argument("--latency", type=float, default=0.0,
+        help="Seconds the fixture server waits before every response.")
+    argparser.add_argument("--bandwidth", type=int, default=None,
+        help="Bytes per second the fixture server sends each response at.")
+    argparser.add_argument("--fixtures", default=replay.FIXTURES_DIR)
+    argparser.add_argument("--font",
+        default=ShinyChromeShower.get_resource_path("Roboto-Light.ttf"))
+    argparser.add_argument("--json", dest="jsonPath", default=None,
+        help="Write the results to this file.")
+    argparser.add_argument("--baseline", default=None,
+        help="Results file of an earlier run to compare with.")
+    argparser.add_argument("--tolerance", type=float, default=0.2,
+        help="Allowed relative slowdown against the baseline.")
+    argparser.add_argument("--verbose", "-v", action="store_true",
+        help="Show the pipeline's own output.")
+    args = argparser.parse_args()
+
+    workDir = tempfile.mkdtemp(prefix='bench_pipeline')
+    destDir = os.path.join(workDir, 'results')
+    os.makedirs(destDir)
+    try:
+        with quiet(not args.verbose):
+            uploadr = import_uploadr(workDir, destDir)
+        with replay.ReplayServer(args.fixtures, latency=args.latency,
+                                 bandwidth=args.bandwidth) as server:
+            replay.point_shinychromeshower(ShinyChromeShower, server)
+            replay.point_uploadr(uploadr, server)
+            stages = []
+            with quiet(not args.verbose):
+                stage, images, texts = bench_get_posts(args)
+            stage.peakRss = peak_rss_kb()
+            stages.append(stage)
+            with quiet(not args.verbose):
+                stage = bench_create_images(images, texts, destDir, args.font)
+            stage.peakRss = peak_rss_kb()
+            stages.append(stage)
+            with quiet(not args.verbose):
+                stage = bench_upload(uploadr)
+            stage.peakRss = peak_rss_kb()
+            stages.append(stage)
+            results = {'stages': dict((stage.name, stage.summary()) for stage in stages),
+                       'requests': server.requests,
+                       'bytes_served': server.bytesSent,
+                       'latency': args.latency,
+                       'bandwidth': args.bandwidth}
+    finally:
+        shutil.rmtree(workDir)
+
+    print("%-14s %6s %9s %10s %9s %9s %12s" %
+          ('stage', 'items', 'seconds', 'items/s', 'p50 ms', 'p99 ms', 'peak RSS KB'))
+    for stage in stages:
+        s = results['stages'][stage.name]
+        print("%-14s %6d %9.3f %10.2f %9.1f %9.1f %12d" % (stage.name, s['items'],
+              s['seconds'], s['throughput'], s['p50_ms'], s['p99_ms'], s['peak_rss_kb']))
+    print("%d requests, %.1f MB served" % (results['requests'], results['bytes_served']/1e6))
+
+    if args.jsonPath:
+        with open(args.jsonPath, 'w') as output:
+            json.dump(results, output, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            regressions = compare(results, json.load(baselineFile), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: " + regression)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks and checks the job queue with several local worker processes.
+
+Queues a number of jobs (1000 by default) and drains them with worker
+processes running jobqueue.work. A share of the attempts fail, to be
+retried, and some workers are killed while holding a job, whose lease
+must run out before another worker takes it over. Every attempt is
+logged, and the run fails unless every job ends up done, none twice, and
+none is taken by a worker while another one's lease on it still runs.
+Reports the jobs per second.
+
+usage: python benchmarks/bench_queue.py [--jobs N] [--processes N]
+           [--fail-rate R] [--kills N] [--keep DIR]
+"""
+from __future__ import print_function
+import os, sys, time, random, shutil, argparse, tempfile, multiprocessing
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import jobqueue
+
+VISIBILITY_TIMEOUT = 2.0
+
+def worker(dbPath, logPath, failRate, kill, seed):
+    """
+    Drains the 'bench' stage, logging "start|end|fail <id> <pid> <time>"
+    for every attempt. With kill, exits without a word while holding its
+    first job.
+    """
+    rng = random.Random(seed)
+    #Failed attempts are reported through the log, not printed.
+    sys.stdout = open(os.devnull, 'w')
+    queue = jobqueue.JobQueue(dbPath, visibilityTimeout=VISIBILITY_TIMEOUT,
+                              maxAttempts=100, retryDelay=0.05)
+    log = open(logPath, 'a', 0)
+
+    def handler(job):
+        log.write("start %d %d %f\n" % (job.id, os.getpid(), time.time()))
+        if kill:
+            os._exit(1)
+        time.sleep(rng.uniform(0, 0.002))
+        if rng.random() < failRate:
+            log.write("fail %d %d %f\n" % (job.id, os.getpid(), time.time()))
+            raise RuntimeError("simulated failure")
+        log.write("end %d %d %f\n" % (job.id, os.getpid(), time.time()))
+
+    jobqueue.work(queue, 'bench', handler, pollSeconds=0.1)
+    queue.close()
+
+def check(logPath, jobs):
+    """
+    Returns the problems found in the attempt log.
+    """
+    problems = []
+    holder = {}
+    ended = {}
+    for line in open(logPath):
+        event, jobId, pid, at = line.split()
+        jobId = int(jobId)
+        if event == 'start':
+            #A job may only be taken over once its lease ran out, which
+            #only happens to the jobs of killed workers.
+            if jobId in holder and float(at) - holder[jobId][1] < VISIBILITY_TIMEOUT:
+                problems.append("job %d started by %s while held by %s" % (jobId, pid, holder[jobId][0]))
+            holder[jobId] = (pid, float(at))
+        else:
+            if event == 'end':
+                ended[jobId] = ended.get(jobId, 0) + 1
+            holder.pop(jobId, None)
+    missing = [jobId for jobId in jobs if jobId not in ended]
+    if missing:
+        problems.append("%d jobs never done, e.g. %s" % (len(missing), missing[:5]))
+    twice = [jobId for jobId, count in ended.items() if count > 1]
+    if twice:
+        problems.append("%d jobs done twice, e.g. %s" % (len(twice), twice[:5]))
+    return problems
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Job queue benchmark')
+    argparser.add_argument("--jobs", type=int, default=1000)
+    argparser.add_argument("--processes", type=int, default=4)
+    argparser.add_argument("--fail-rate", type=float, default=0.05, dest="failRate")
+    argparser.add_argument("--kills", type=int, default=2,
+        help="Workers killed while holding a job, on top of --processes.")
+    argparser.add_argument("--keep", type=str, default=None,
+        help="Directory to keep the queue and attempt log in.")
+    args = argparser.parse_args()
+
+    workDir = args.keep or tempfile.mkdtemp()
+    if not os.path.isdir(workDir):
+        os.makedirs(workDir)
+    dbPath = os.path.join(workDir, 'queue.db')
+    logPath = os.path.join(workDir, 'attempts.log')
+    for path in (dbPath, logPath):
+        if os.path.exists(path):
+            os.remove(path)
+    try:
+        queue = jobqueue.JobQueue(dbPath)
+        start = time.time()
+        jobs = [queue.put('bench', {'n': n}) for n in range(args.jobs)]
+        queued = time.time() - start
+        queue.close()
+
+        start = time.time()
+        workers = [multiprocessing.Process(target=worker, args=(dbPath, logPath, args.failRate, n < args.kills, n))
+                   for n in range(args.kills + args.processes)]
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join()
+        elapsed = time.time() - start
+
+        queue = jobqueue.JobQueue(dbPath)
+        counts = queue.counts()
+        queue.close()
+        attempts = sum(1 for line in open(logPath) if line.startswith('start'))
+        print("queued %d jobs in %.3fs (%.0f jobs/s)" % (args.jobs, queued, args.jobs/queued))
+        print("%d workers (%d killed) drained them in %.3fs: %.0f jobs/s, %d attempts"
+              % (len(workers), args.kills, elapsed, args.jobs/elapsed, attempts))
+        print("states: %s" % ", ".join("%s %d" % (state, count) for (stage, state), count in sorted(counts.items())))
+        problems = check(logPath, jobs)
+        for problem in problems:
+            print("FAIL: " + problem)
+        if problems:
+            sys.exit(1)
+        print("ok: every job done once")
+    finally:
+        if not args.keep:
+            shutil.rmtree(workDir)
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Compares the PIL draw_text backend with the wkhtmltoimage HTML backend.
+
+Renders the same captions onto the same background with both backends and
+reports throughput (images per second) and output quality: the JPEG size and
+the PSNR of each HTML rendering against its PIL counterpart. The PIL backend
+is measured both one image at a time (generate_image) and as one batch from a
+single decode (generate_images).
+
+usage: python benchmarks/bench_render.py [--count N] [--processes N]
+           [--background image.jpg]
+"""
+from __future__ import print_function
+import os, sys, time, math, shutil, argparse, tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from PIL import Image, ImageChops, ImageStat
+import ShinyChromeShower
+import htmlrender
+
+CAPTIONS = [
+    "Your stomach thinks all potatoes are mashed.",
+    "If you rip a hole in a net, there are actually fewer holes in it than before.",
+    "Fish & chips taste better when somebody else is paying for them.",
+    "\"Pre-heating\" an oven is just heating it <before> you need it.",
+    "Nothing is on fire, fire is on things.",
+    "Maybe plants are really farming us, giving us oxygen until we eventually expire and turn into mulch.",
+]
+
+def make_background(path, width=1920, height=1080):
+    """
+    Writes a gradient test background, the size of a typical wallpaper.
+    """
+    gradient = Image.linear_gradient('L').resize((width, height))
+    img = Image.merge('RGB', (gradient, gradient.rotate(180), gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+    img.save(path, "JPEG", quality=95)
+
+def psnr(pathA, pathB):
+    """
+    Peak signal to noise ratio between two images of the same size, in dB.
+    """
+    a = Image.open(pathA).convert('RGB')
+    b = Image.open(pathB).convert('RGB').resize(a.size)
+    mse = sum(v*v for v in ImageStat.Stat(ImageChops.difference(a, b)).rms) / 3
+    if mse == 0:
+        return float('inf')
+    return 10*math.log10(255.0**2/mse)
+
+def bench_pil(background, captions, fontPath, workDir):
+    outputs = []
+    start = time.time()
+    for i, text in enumerate(captions):
+        dest = os.path.join(workDir, 'pil-%d.jpg' % i)
+        ShinyChromeShower.generate_image(background, text, fontPath, dest)
+        outputs.append(dest)
+    return time.time() - start, outputs
+
+def bench_batch(background, captions, fontPath, workDir, processes):
+    outputs = [os.path.join(workDir, 'batch-%d.jpg' % i) for i in range(len(captions))]
+    start = time.time()
+    results = ShinyChromeShower.generate_images(background, captions, fontPath, outputs,
+                                                processes=processes)
+    elapsed = time.time() - start
+    for fromCache, error in results:
+        if error:
+            raise SystemExit("batch render failed: %s" % error)
+    return elapsed, outputs
+
+def bench_html(background, captions, fontPath, workDir, processes):
+    jobs = [(background, text, fontPath, os.path.join(workDir, 'html-%d.jpg' % i))
+            for i, text in enumerate(captions)]
+    with htmlrender.HtmlRenderer(processes) as renderer:
+        #Warm up the pool so the measurement excludes one-time startup.
+        renderer.render(jobs[:1])
+        start = time.time()
+        results = renderer.render(jobs)
+        elapsed = time.time() - start
+    for path, error in results:
+        if error:
+            raise SystemExit("html renderer failed: %s" % error)
+    return elapsed, [path for path, error in results]
+
+def report(name, elapsed, outputs):
+    size = sum(os.path.getsize(path) for path in outputs) / float(len(outputs))
+    print("%-5s %3d images in %6.2fs  %6.2f images/s  avg %6.1f KB" %
+          (name, len(outputs), elapsed, len(outputs)/elapsed, size/1024))
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Render backend benchmark')
+    argparser.add_argument("--count", type=int, default=24,
+        help="Number of images to render with each backend.")
+    argparser.add_argument("--processes", type=int, default=None,
+        help="Number of HTML renderer and batch processes (default: CPU count).")
+    argparser.add_argument("--background", type=str, default=None,
+        help="Background image to use (default: a generated 1920x1080 gradient).")
+    argparser.add_argument("--font", type=str,
+        default=ShinyChromeShower.get_resource_path("Roboto-Light.ttf"))
+    args = argparser.parse_args()
+
+    workDir = tempfile.mkdtemp(prefix='bench_render')
+    try:
+        background = args.background
+        if background is None:
+            background = os.path.join(workDir, 'background.jpg')
+            make_background(background)
+        captions = [CAPTIONS[i % len(CAPTIONS)] for i in range(args.count)]
+
+        pilTime, pilOutputs = bench_pil(background, captions, args.font, workDir)
+        report('pil', pilTime, pilOutputs)
+        batchTime, batchOutputs = bench_batch(background, captions, args.font, workDir, args.processes)
+        report('batch', batchTime, batchOutputs)
+        print("batch speedup: %.2fx" % (pilTime/batchTime))
+        htmlTime, htmlOutputs = bench_html(background, captions, args.font, workDir, args.processes)
+        report('html', htmlTime, htmlOutputs)
+
+        scores = [psnr(p, h) for p, h in zip(pilOutputs, htmlOutputs)]
+        print("html vs pil PSNR: min %.2f dB  avg %.2f dB" % (min(scores), sum(scores)/len(scores)))
+        print("html speedup: %.2fx" % (pilTime/htmlTime))
+    finally:
+        shutil.rmtree(workDir)
@@ -0,0 +1,83 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks handing decoded images to worker processes.
+
+Sends a decoded background (6000x4000 RGB by default) to a pool of worker
+processes for a number of jobs (captions) two ways: pickled with every
+job, as a multiprocessing pool would send an image, and as a handle to an
+imagebuffers shared memory buffer. Each worker makes the private copy it
+would draw on and returns. Reports the time per image, the bytes sent
+through the pool's pipes and the bytes of pixels copied per image, the
+copy every worker makes to draw on left out.
+
+usage: python benchmarks/bench_shm.py [--size WxH] [--jobs N]
+           [--processes N] [--rounds N]
+"""
+from __future__ import print_function
+import os, sys, time, argparse, multiprocessing
+import cPickle as pickle
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from PIL import Image
+import imagebuffers
+
+def pickled_job(img):
+    """
+    Worker side of a pickled image: it arrives unpickled, a new image.
+    """
+    img = img.copy()
+    return img.size
+
+def shared_job(handle):
+    img = imagebuffers.image_copy(handle)
+    return img.size
+
+def bench(pool, func, items, rounds):
+    start = time.time()
+    for i in range(rounds):
+        pool.map(func, items, chunksize=1)
+    return (time.time() - start)/rounds
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Shared image buffer benchmark')
+    argparser.add_argument("--size", type=str, default="6000x4000")
+    argparser.add_argument("--jobs", type=int, default=4,
+        help="Jobs (captions) per image.")
+    argparser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    argparser.add_argument("--rounds", type=int, default=3)
+    args = argparser.parse_args()
+    width, height = [int(n) for n in args.size.lower().split('x')]
+
+    img = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        #Warm up the workers.
+        pool.map(len, [[]]*args.processes)
+        pickleBytes = len(pickle.dumps(img, pickle.HIGHEST_PROTOCOL))
+        pickledTime = bench(pool, pickled_job, [img]*args.jobs, args.rounds)
+
+        with imagebuffers.ImageBufferPool() as buffers:
+            start = time.time()
+            for i in range(args.rounds):
+                handle = buffers.put(img)
+                pool.map(shared_job, [handle]*args.jobs, chunksize=1)
+                buffers.release(handle)
+            sharedTime = (time.time() - start)/args.rounds
+            handleBytes = len(pickle.dumps(handle, pickle.HIGHEST_PROTOCOL))
+            copiedBytes = buffers.bytesCopied/args.rounds
+    finally:
+        pool.close()
+        pool.join()
+
+    mb = 1024.0*1024
+    #Pickling copies the pixels out of the image and back into a new one
+    #for every job.
+    pickledCopies = 2*pickleBytes*args.jobs
+    print("%dx%d RGB image, %d jobs per image, %d processes" % (width, height, args.jobs, args.processes))
+    print("%-8s %10s %14s %18s" % ("", "s/image", "MB piped/image", "MB copied/image"))
+    print("%-8s %10.3f %14.1f %18.1f" % ("pickled", pickledTime, pickleBytes*args.jobs/mb, pickledCopies/mb))
+    print("%-8s %10.3f %14.4f %18.1f" % ("shared", sharedTime, handleBytes*args.jobs/mb, copiedBytes/mb))
+    print("copy bytes saved per image: %.1f MB (%.1fx less), %.1fx faster"
+          % ((pickledCopies - copiedBytes)/mb, pickledCopies/float(copiedBytes),
+             pickledTime/sharedTime if sharedTime else float('inf')))
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Measures the startup cost of the scripts: the time a fresh interpreter takes
+to import ShinyChromeShower, uploadr and htmlrender, and to load uploadr's
+configuration, as paid by every spawned worker process. Each case runs in
+its own interpreter; the time of an empty interpreter is subtracted. Also
+lists the heavy modules each import pulled in.
+
+usage: python benchmarks/bench_startup.py [--runs N]
+"""
+from __future__ import print_function
+import os, sys, json, time, argparse, subprocess
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+#Modules a bare import should not need.
+HEAVY_MODULES = ['PIL', 'urllib', 'urllib2', 'ssl', 'sqlite3', 'multiprocessing',
+                 'subprocess', 'BaseHTTPServer', 'mimetypes', 'xml.dom.minidom', 'argparse']
+
+CASES = [
+    ('python', 'pass'),
+    ('import ShinyChromeShower', 'import ShinyChromeShower'),
+    ('import uploadr', 'import uploadr'),
+    ('uploadr.loadConfig', 'import uploadr; uploadr.loadConfig(%r)'
+     % os.path.join(ROOT_DIR, 'uploadr.ini')),
+    ('import htmlrender', 'import htmlrender'),
+]
+
+PROBE = """
+import sys, time, json
+sys.path.insert(0, %r)
+start = time.time()
+%s
+elapsed = time.time() - start
+print(json.dumps({'ms': 1000*elapsed,
+                  'heavy': [m for m in %r if m in sys.modules]}))
+"""
+
+def measure(statement, runs):
+    """
+    Runs statement in runs fresh interpreters.
+
+    Returns:
+        tuple(list of float, list of strings): milliseconds per run and the
+        heavy modules loaded by the statement.
+    """
+    times = []
+    heavy = []
+    for i in range(runs):
+        start = time.time()
+        output = subprocess.check_output([sys.executable, '-c',
+            PROBE % (ROOT_DIR, statement, HEAVY_MODULES)], cwd=ROOT_DIR)
+        total = 1000*(time.time() - start)
+        result = json.loads(output.strip().splitlines()[-1])
+        times.append((total, result['ms']))
+        heavy = result['heavy']
+    return times, heavy
+
+def median(values):
+    ordered = sorted(values)
+    return ordered[len(ordered)//2]
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Startup time benchmark')
+    argparser.add_argument("--runs", type=int, default=20,
+        help="Fresh interpreters started per case.")
+    args = argparser.parse_args()
+
+    print("%-24s %12s %12s  %s" % ('case', 'process ms', 'import ms', 'heavy modules loaded'))
+    baseline = None
+    for name, statement in CASES:
+        times, heavy = measure(statement, args.runs)
+        process = median([total for total, inside in times])
+        inside = median([inside for total, inside in times])
+        if baseline is None:
+            baseline = process
+            print("%-24s %12.1f %12s" % (name, process, '-'))
+            continue
+        print("%-24s %12.1f %12.1f  %s" % (name, process - baseline, inside,
+                                           ', '.join(heavy) or '-'))
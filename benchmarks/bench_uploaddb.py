@@ -0,0 +1,205 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks uploadr's database at scale.
+
+Generates a synthetic database with the version 1 schema (1M files by
+default, in sets of 200, with some files not in a set or not tagged yet and
+some sets left empty), migrates a copy of it to the current schema with
+Uploadr.setupDB and times the migration. Then runs the queries of every
+uploadr phase against both databases, each phase for the same sample of
+files and rolled back afterwards, and reports the time per phase.
+
+usage: python benchmarks/bench_uploaddb.py [--rows N] [--samples N]
+           [--keep DIR]
+"""
+from __future__ import print_function
+import os, sys, time, random, shutil, sqlite3, hashlib, argparse, tempfile
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import uploadr
+
+FILES_PER_SET = 200
+
+#The queries each phase runs, as uploadr runs them, per schema version
+#where the version 2 query differs.
+UNTAGGED = {
+    1: "SELECT files_id, path, set_id, tagged FROM files",
+    2: "SELECT files_id, path, set_id, tagged FROM files WHERE tagged IS NULL OR tagged = 0",
+}
+UNUSED_SETS = {
+    1: "SELECT set_id, name FROM sets WHERE set_id NOT IN (SELECT set_id FROM files)",
+    2: "SELECT set_id, name FROM sets WHERE NOT EXISTS (SELECT 1 FROM files WHERE files.set_id = sets.set_id)",
+}
+
+def build_v1(dbPath, rows, seed):
+    """
+    Creates a database as uploadr's version 1 setupDB left it, with rows
+    synthetic files.
+    """
+    rng = random.Random(seed)
+    con = sqlite3.connect(dbPath)
+    con.execute('create table files (files_id int, path text, set_id int, md5 text, tagged int, last_modified REAL)')
+    con.execute('create table sets (set_id int, name text, primary_photo_id INTEGER)')
+    con.execute('create unique index fileindex on files (path)')
+    con.execute('create index setsindex on sets (name)')
+    con.execute('create table raw_files (path text primary key, jpg_converted int, tags_copied int)')
+    con.execute('PRAGMA user_version="1"')
+    sets = rows//FILES_PER_SET + 1
+
+    def files():
+        for i in range(rows):
+            setNumber = i//FILES_PER_SET
+            #The newest files were not added to a set or tagged yet.
+            recent = i >= rows - rows//100
+            yield (10**10 + i, os.path.join('/photos', 'set%05d' % setNumber, 'img%07d.jpg' % i),
+                   None if recent else 72157600000000000 + setNumber,
+                   hashlib.md5(str(i)).hexdigest(), None if recent else 1,
+                   1.5e9 + rng.random()*1e8)
+    con.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)', files())
+    #Some sets more than the files use, left empty.
+    con.executemany('INSERT INTO sets VALUES (?, ?, ?)',
+                    ((72157600000000000 + n, 'set%05d' % n, 10**10 + n*FILES_PER_SET)
+                     for n in range(sets + sets//100)))
+    con.commit()
+    con.close()
+
+def used_mb(dbPath):
+    """
+    Megabytes of the database in use, leaving out free pages, such as those
+    of the tables the migration dropped, which SQLite reuses as it grows.
+    """
+    con = sqlite3.connect(dbPath)
+    pages = con.execute('PRAGMA page_count').fetchone()[0] - con.execute('PRAGMA freelist_count').fetchone()[0]
+    pageSize = con.execute('PRAGMA page_size').fetchone()[0]
+    con.close()
+    return pages*pageSize/1e6
+
+def migrate(dbPath, workDir):
+    """
+    Runs Uploadr.setupDB on the database. Returns the seconds it took.
+    """
+    uploadr.loadConfig(os.path.join(ROOT_DIR, 'uploadr.ini'))
+    uploadr.DB_PATH = dbPath
+    uploadr.TOKEN_PATH = os.path.join(workDir, '.flickrToken')
+    flick = uploadr.Uploadr()
+    start = time.time()
+    flick.setupDB()
+    return time.time() - start
+
+def phase_upload(cur, version, sample):
+    #upload: the paths known, then uploadFile's lookup of every file.
+    cur.execute("SELECT path FROM files")
+    set(row[0] for row in cur.fetchall())
+    for files_id, path, set_id, md5 in sample:
+        cur.execute("SELECT rowid,files_id,path,set_id,md5,tagged,last_modified FROM files WHERE path = ?", (path,))
+        cur.fetchone()
+
+def phase_replace(cur, version, sample):
+    for files_id, path, set_id, md5 in sample:
+        cur.execute('UPDATE files SET md5 = ?,last_modified = ? WHERE files_id = ?', (md5[::-1], time.time(), files_id))
+
+def phase_delete(cur, version, sample):
+    #deleteFile: is it the last file of its set, then the delete itself.
+    for files_id, path, set_id, md5 in sample:
+        cur.execute("SELECT set_id FROM files WHERE files_id = ?", (files_id,))
+        row = cur.fetchone()
+        cur.execute("SELECT set_id FROM files WHERE set_id = ?", (row[0],))
+        cur.fetchall()
+        cur.execute("DELETE FROM files WHERE files_id = ?", (files_id,))
+
+def phase_sets(cur, version, sample):
+    #createSets: sets by name, addFileToSet's update.
+    for files_id, path, set_id, md5 in sample:
+        cur.execute("SELECT set_id, name FROM sets WHERE name = ?", (os.path.basename(os.path.dirname(path)),))
+        cur.fetchone()
+        cur.execute("UPDATE files SET set_id = ? WHERE files_id = ?", (set_id, files_id))
+
+def phase_tags(cur, version, sample):
+    cur.execute(UNTAGGED[version])
+    [row for row in cur.fetchall() if row[3] != 1]
+    for files_id, path, set_id, md5 in sample:
+        cur.execute("UPDATE files SET tagged=? WHERE files_id=?", (1, files_id))
+
+def phase_unused_sets(cur, version, sample):
+    cur.execute(UNUSED_SETS[version])
+    cur.fetchall()
+
+def phase_md5(cur, version, sample):
+    #Finding an uploaded copy of a file by its checksum.
+    for files_id, path, set_id, md5 in sample:
+        cur.execute("SELECT files_id, path FROM files WHERE md5 = ?", (md5,))
+        cur.fetchall()
+
+PHASES = [
+    ('upload', phase_upload),
+    ('replacePhoto', phase_replace),
+    ('removeDeletedMedia', phase_delete),
+    ('createSets', phase_sets),
+    ('addTagsToUploaded', phase_tags),
+    ('removeUselessSets', phase_unused_sets),
+    ('md5 lookup', phase_md5),
+]
+
+def time_phase(dbPath, version, phase, sample):
+    con = sqlite3.connect(dbPath)
+    con.text_factory = str
+    cur = con.cursor()
+    start = time.time()
+    phase(cur, version, sample)
+    elapsed = time.time() - start
+    con.rollback()
+    con.close()
+    return elapsed
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='uploadr database benchmark')
+    argparser.add_argument("--rows", type=int, default=1000000,
+        help="Number of files in the synthetic database.")
+    argparser.add_argument("--samples", type=int, default=100,
+        help="Files each phase looks up or changes.")
+    argparser.add_argument("--keep", default=None,
+        help="Keep the generated databases in this directory.")
+    argparser.add_argument("--seed", type=int, default=1)
+    args = argparser.parse_args()
+
+    workDir = args.keep or tempfile.mkdtemp(prefix='bench_uploaddb')
+    if not os.path.isdir(workDir):
+        os.makedirs(workDir)
+    v1Path = os.path.join(workDir, 'flickrdb.v1')
+    v2Path = os.path.join(workDir, 'flickrdb.v2')
+    try:
+        for path in (v1Path, v2Path):
+            if os.path.exists(path):
+                os.remove(path)
+        start = time.time()
+        build_v1(v1Path, args.rows, args.seed)
+        print("generated %d files in %.1fs, %.1f MB" % (args.rows, time.time() - start,
+                                                      used_mb(v1Path)))
+        shutil.copy(v1Path, v2Path)
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            elapsed = migrate(v2Path, workDir)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        print("migrated to schema version %d in %.1fs, %.1f MB" % (uploadr.DB_SCHEMA_VERSION,
+              elapsed, used_mb(v2Path)))
+
+        con = sqlite3.connect(v1Path)
+        rng = random.Random(args.seed)
+        ids = rng.sample(range(args.rows), min(args.samples, args.rows))
+        sample = [con.execute("SELECT files_id, path, set_id, md5 FROM files WHERE rowid = ?",
+                              (i + 1,)).fetchone() for i in ids]
+        con.close()
+
+        print("%-20s %11s %11s %9s" % ('phase', 'v1 ms', 'v2 ms', 'speedup'))
+        for name, phase in PHASES:
+            v1 = time_phase(v1Path, 1, phase, sample)
+            v2 = time_phase(v2Path, 2, phase, sample)
+            print("%-20s %11.1f %11.1f %8.1fx" % (name, 1000*v1, 1000*v2, v1/v2 if v2 else float('inf')))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workDir)
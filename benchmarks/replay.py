@@ -0,0 +1,289 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for reddit, the image hosts and Flickr, serving recorded
+fixtures so the pipeline can run and be measured without network access.
+
+Fixture layout (benchmarks/fixtures by default):
+    reddit/<subreddit>.json   list of hot listing pages, as returned by
+                              /r/<subreddit>/hot.json. "{{server}}" in image
+                              urls is replaced by the server's base url.
+    images/<name>             image bytes served at /images/<name>. Names
+                              that are not recorded but contain a WxH size,
+                              like "earth-01-2560x1440.jpg", are served as a
+                              generated JPEG of that size.
+    flickr/<method>.json      canned response to a REST api call.
+    flickr/upload.xml         canned response to an upload,
+    flickr/replace.xml        and to a replace. "{{id}}" is replaced by a
+                              fresh id for every response.
+
+usage:
+    python benchmarks/replay.py serve [--port N] [--latency S] [--bandwidth B]
+    python benchmarks/replay.py record SUBREDDIT [SUBREDDIT ...]
+"""
+from __future__ import print_function
+import os, re, sys, json, time, errno, random, socket, threading, argparse
+import io, urllib2, urlparse, itertools, BaseHTTPServer, SocketServer
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures')
+
+def synthetic_jpeg(name, width, height):
+    """
+    A deterministic JPEG of the given size, noisy enough to compress like a
+    photo rather than like a flat color.
+    """
+    from PIL import Image, ImageFilter
+    rng = random.Random(name)
+    small = Image.new('RGB', (64, 36))
+    small.putdata([(rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255))
+                   for i in range(64*36)])
+    img = small.resize((width, height), Image.BICUBIC).filter(ImageFilter.DETAIL)
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+class Fixtures(object):
+    """
+    Loads the fixture files and answers requests from them.
+    """
+    _size = re.compile(r'(\d+)x(\d+)')
+
+    def __init__(self, fixturesDir=FIXTURES_DIR):
+        self.fixturesDir = fixturesDir
+        self.images = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count(10000000000)
+
+    def _read(self, *path):
+        with open(os.path.join(self.fixturesDir, *path), 'rb') as fixture:
+            return fixture.read()
+
+    def next_id(self):
+        with self.lock:
+            return str(next(self.ids))
+
+    def listing(self, subreddit, after, baseUrl):
+        """
+        The listing page following the 'after' cursor, or None.
+        """
+        try:
+            pages = json.loads(self._read('reddit', subreddit + '.json')
+                               .replace('{{server}}', baseUrl))
+        except IOError:
+            return None
+        if after:
+            for i, page in enumerate(pages):
+                if page['data']['after'] == after:
+                    return json.dumps(pages[i+1]) if i+1 < len(pages) else None
+            return None
+        return json.dumps(pages[0])
+
+    def image(self, name):
+        """
+        The bytes of an image, recorded or generated. None if unknown.
+        """
+        with self.lock:
+            if name not in self.images:
+                try:
+                    self.images[name] = self._read('images', name)
+                except IOError:
+                    size = self._size.search(name)
+                    if size is None:
+                        return None
+                    self.images[name] = synthetic_jpeg(name, int(size.group(1)), int(size.group(2)))
+            return self.images[name]
+
+    def flickr(self, name):
+        """
+        A canned flickr response with a fresh id. None if unknown.
+        """
+        try:
+            return self._read('flickr', name).replace('{{id}}', self.next_id())
+        except IOError:
+            return None
+
+class ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the fixtures with the server's latency and bandwidth.
+    """
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        self.handle_request(urlparse.parse_qs(urlparse.urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-length') or 0)
+        self.rfile.read(length)
+        self.handle_request(urlparse.parse_qs(urlparse.urlparse(self.path).query))
+
+    def handle_request(self, query):
+        fixtures = self.server.fixtures
+        path = urlparse.urlparse(self.path).path
+        body = None
+        contentType = 'application/json'
+        listing = re.match(r'^/r/([^/]+)/hot\.json$', path)
+        if listing:
+            body = fixtures.listing(listing.group(1), query.get('after', [None])[0],
+                                    self.server.url)
+        elif path.startswith('/images/'):
+            body = fixtures.image(path[len('/images/'):])
+            contentType = 'image/jpeg'
+        elif path == '/services/rest/':
+            body = fixtures.flickr(query.get('method', [''])[0] + '.json')
+        elif path in ('/services/upload/', '/services/replace/'):
+            body = fixtures.flickr(path.strip('/').split('/')[-1] + '.xml')
+            contentType = 'text/xml'
+        self.server.count(len(body or ''))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.server.bandwidth:
+            chunk = 16*1024
+            for start in range(0, len(body), chunk):
+                self.wfile.write(body[start:start+chunk])
+                time.sleep(min(chunk, len(body)-start)/float(self.server.bandwidth))
+        else:
+            self.wfile.write(body)
+
+class ReplayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded fixture server on localhost, running in a background thread.
+
+    Args:
+        fixturesDir (string) optional, fixture directory to serve.
+        port (int) optional, 0 picks a free port.
+        latency (float) optional, seconds added before every response.
+        bandwidth (int) optional, bytes per second each response is
+            throttled to. None for unthrottled.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, fixturesDir=FIXTURES_DIR, port=0, latency=0, bandwidth=None,
+                 verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), ReplayHandler)
+        self.fixtures = Fixtures(fixturesDir)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.verbose = verbose
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.requests = 0
+        self.bytesSent = 0
+        self.statsLock = threading.Lock()
+        self.thread = None
+
+    def handle_error(self, request, client_address):
+        #Clients such as get_image_size hang up once they have read enough.
+        error = sys.exc_info()[1]
+        if isinstance(error, socket.error) and error.errno in (errno.EPIPE, errno.ECONNRESET):
+            return
+        BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    def count(self, size):
+        with self.statsLock:
+            self.requests += 1
+            self.bytesSent += size
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def point_shinychromeshower(module, server):
+    """
+    Sends a ShinyChromeShower module's reddit requests to the server.
+    """
+    module.REDDIT_URL = server.url
+
+def point_uploadr(module, server):
+    """
+    Sends an uploadr module's flickr requests to the server.
+    """
+    base = server.url + '/services/'
+    module.api.rest = base + 'rest/'
+    module.api.auth = base + 'auth/'
+    module.api.upload = base + 'upload/'
+    module.api.replace = base + 'replace/'
+
+def record(subreddits, fixturesDir=FIXTURES_DIR, redditUrl='https://www.reddit.com',
+           pages=1):
+    """
+    Saves live hot listings and the images they link to as fixtures.
+    """
+    for name in ('reddit', 'images'):
+        if not os.path.isdir(os.path.join(fixturesDir, name)):
+            os.makedirs(os.path.join(fixturesDir, name))
+    for subreddit in subreddits:
+        listing = []
+        after = None
+        for page in range(pages):
+            url = '%s/r/%s/hot.json?limit=100&raw_json=1' % (redditUrl, subreddit)
+            if after:
+                url += '&after=' + after
+            request = urllib2.Request(url, headers={'User-Agent': 'ChromecastBackdrop'})
+            data = json.load(urllib2.urlopen(request, timeout=30))
+            for child in data['data']['children']:
+                postUrl = child['data'].get('url', '')
+                if re.search(r'\.(jpe?g|png)$', postUrl, re.I):
+                    name = child['data']['id'] + os.path.splitext(postUrl)[1].lower()
+                    try:
+                        content = urllib2.urlopen(postUrl, timeout=30).read()
+                    except Exception as e:
+                        print("skipping %s: %s" % (postUrl, e))
+                        continue
+                    with open(os.path.join(fixturesDir, 'images', name), 'wb') as image:
+                        image.write(content)
+                    child['data']['url'] = '{{server}}/images/' + name
+            listing.append(data)
+            after = data['data']['after']
+            if not after:
+                break
+        with open(os.path.join(fixturesDir, 'reddit', subreddit + '.json'), 'w') as fixture:
+            json.dump(listing, fixture, indent=1)
+        print("recorded %d pages of r/%s" % (len(listing), subreddit))
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Fixture replay server')
+    commands = argparser.add_subparsers(dest='command')
+    serve = commands.add_parser('serve', help='Serve the fixtures until interrupted.')
+    serve.add_argument('--port', type=int, default=8765)
+    serve.add_argument('--latency', type=float, default=0,
+        help='Seconds added before every response.')
+    serve.add_argument('--bandwidth', type=int, default=None,
+        help='Bytes per second per response.')
+    serve.add_argument('--fixtures', default=FIXTURES_DIR)
+    recorder = commands.add_parser('record', help='Record live listings and images.')
+    recorder.add_argument('subreddits', nargs='+')
+    recorder.add_argument('--pages', type=int, default=1)
+    recorder.add_argument('--fixtures', default=FIXTURES_DIR)
+    args = argparser.parse_args()
+
+    if args.command == 'serve':
+        server = ReplayServer(args.fixtures, args.port, args.latency, args.bandwidth,
+                              verbose=True)
+        print("serving %s on %s" % (args.fixtures, server.url))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    else:
+        record(args.subreddits, args.fixtures, pages=args.pages)
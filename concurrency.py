@@ -0,0 +1,187 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Adaptive concurrency limits for the network bound stages of
+ShinyChromeShower and uploadr.
+
+A ConcurrencyController decides how many requests of a stage may run at
+once, from what it measures rather than from a fixed worker count. It
+looks at windows of completed requests, one window per step of the limit:
+    - on an error, or when the median latency of the window rose to more
+      than `spike` times the lowest seen (the host is throttling or the
+      link is saturated), the limit is cut by the `backoff` factor;
+    - when the window right after an increase did not beat the throughput
+      of the one before by more than `gain`, the extra request did not pay
+      off: the increase is taken back, and the limit holds for a window;
+    - otherwise the limit grows by one (additive increase), probing for
+      more throughput.
+Every change is logged with its reason.
+"""
+from __future__ import print_function
+import time, threading, collections
+
+#Longest wait for a result of imap; a timeout keeps the wait interruptible.
+REQUEST_WAIT = 24*3600
+
+class ConcurrencyController(object):
+    """
+    AIMD limit of the requests of one stage in flight.
+    """
+    def __init__(self, name, initial=2, minimum=1, maximum=16, spike=2.0, backoff=0.5,
+                 gain=0.05, log=print):
+        """
+        Args:
+            name (string): the stage, for the log.
+            initial, minimum, maximum (int): the limit to start at and its
+                bounds.
+            spike (float): latency over the lowest seen that counts as a
+                spike.
+            backoff (float): factor the limit is cut by.
+            gain (float): relative throughput change that counts.
+            log (function): receives every decision as a string.
+        """
+        self.name = name
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.spike = spike
+        self.backoff = backoff
+        self.gain = gain
+        self.log = log
+        self.condition = threading.Condition()
+        self.inFlight = 0
+        self.baseLatency = None
+        self.lastThroughput = None
+        self.lastChange = 0
+        self.lastCut = 0
+        self.decisions = []
+        self._startWindow()
+
+    def _startWindow(self):
+        self.windowStart = time.time()
+        self.latencies = []
+        self.errors = 0
+
+    def acquire(self):
+        """
+        Waits for a free slot under the limit.
+        """
+        with self.condition:
+            while self.inFlight >= self.limit:
+                #A timeout keeps the wait interruptible by Ctrl-C
+                self.condition.wait(60)
+            self.inFlight += 1
+
+    def release(self, latency, ok=True):
+        """
+        Frees a slot, recording how long its request took and whether it
+        failed.
+        """
+        with self.condition:
+            self.inFlight -= 1
+            self.latencies.append(latency)
+            #Requests started before the last cut failed at the old limit,
+            #which was already cut for.
+            if not ok and time.time() - latency >= self.lastCut:
+                self.errors += 1
+            if self.errors or len(self.latencies) >= max(2*self.limit, 8):
+                self._decide()
+            self.condition.notify_all()
+
+    def _decide(self):
+        elapsed = time.time() - self.windowStart
+        latencies = sorted(self.latencies)
+        median = latencies[len(latencies)//2]
+        throughput = len(latencies)/elapsed if elapsed > 0 else None
+        if self.baseLatency is None or median < self.baseLatency:
+            self.baseLatency = median
+        old = self.limit
+        reason = None
+        if self.errors:
+            reason = "%d errors" % self.errors
+            self.limit = int(self.limit*self.backoff)
+        elif median > self.spike*self.baseLatency:
+            reason = "latency %.2fs, %.1fx the lowest" % (median, median/self.baseLatency)
+            self.limit = int(self.limit*self.backoff)
+        elif throughput is None or self.lastThroughput is None:
+            pass
+        elif self.lastChange > 0 and throughput <= self.lastThroughput*(1 + self.gain):
+            reason = "throughput %.2f/s, no better after an increase" % throughput
+            self.limit -= 1
+        elif self.lastChange >= 0:
+            reason = "probing, throughput %.2f/s" % throughput
+            self.limit += 1
+        if self.limit < old:
+            #Latency is measured afresh at the lower limit.
+            self.baseLatency = None
+            self.lastCut = time.time()
+        self.limit = min(max(self.limit, self.minimum), self.maximum)
+        self.lastChange = self.limit - old
+        self.lastThroughput = throughput
+        if self.limit != old:
+            self.decisions.append((time.time(), old, self.limit, reason))
+            self.log("%s concurrency %d -> %d: %s." % (self.name, old, self.limit, reason))
+        self._startWindow()
+
+    def call(self, func, *args, **kwargs):
+        """
+        Runs func in a slot, and returns its result. An exception counts as
+        an error and is raised again.
+        """
+        self.acquire()
+        start = time.time()
+        ok = False
+        try:
+            result = func(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            self.release(time.time() - start, ok)
+
+    def imap(self, func, iterable, isError=None, skip=None):
+        """
+        Like itertools.imap, with up to limit calls of func running at once
+        on threads, started as far ahead of the consumer as the limit
+        allows. Results come in order; an exception of func is raised when
+        its result is reached.
+
+        Args:
+            isError (function) optional, tells from a result that its call
+                failed, for functions reporting failures without raising.
+            skip (function) optional, tells the items that need no call:
+                they are yielded as they are, in their place.
+        """
+        from multiprocessing.pool import ThreadPool
+        def timed(item):
+            start = time.time()
+            try:
+                result = func(item)
+            except:
+                self.release(time.time() - start, False)
+                raise
+            self.release(time.time() - start, not (isError and isError(result)))
+            return result
+        pool = ThreadPool(self.maximum)
+        pending = collections.deque()
+        items = iter(iterable)
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < self.limit:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if skip and skip(item):
+                        pending.append((item, None))
+                        continue
+                    self.acquire()
+                    pending.append((None, pool.apply_async(timed, (item,))))
+                if not pending:
+                    return
+                item, result = pending.popleft()
+                yield item if result is None else result.get(REQUEST_WAIT)
+        finally:
+            #Calls still running finish on their own.
+            pool.close()
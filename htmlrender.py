@@ -0,0 +1,348 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+HTML render backend for ShinyChromeShower.
+
+Fills templates/template.html with the background image, font and text and
+rasterizes the page with wkhtmltoimage. The template is compiled once and a
+batch of captions is stacked into a single document, so the rasterizer runs
+once per batch; the pages are then cropped apart and saved as JPEG.
+Rasterizing happens in a pool of long lived worker processes, each of which
+loads libwkhtmltox once and keeps it initialized for every sheet it renders.
+When the library is not available the workers fall back to running the
+wkhtmltoimage binary.
+"""
+from __future__ import print_function
+import os, sys, re, io, base64, urllib, subprocess, multiprocessing
+import ctypes, ctypes.util
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             'templates', 'template.html')
+
+def escape(value):
+    """
+    HTML-escape a value for use in text or in a quoted attribute.
+    """
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')\
+        .replace('"', '&quot;').replace("'", '&#39;')
+
+class CompiledTemplate(object):
+    """
+    A {{...}} template parsed once into static segments and slots.
+    Rendering copies the segments, drops the escaped values into the slot
+    positions and joins once.
+    """
+    _slot = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+    def __init__(self, text):
+        #split() alternates static text and captured slot names.
+        self.parts = self._slot.split(text)
+        self.slots = [(i, self.parts[i]) for i in range(1, len(self.parts), 2)]
+
+    def extend(self, out, values):
+        """
+        Appends the rendered parts to the list out, without joining.
+
+        Args:
+            out (list): list of strings receiving the output.
+            values (dict): slot name to unescaped value.
+        """
+        parts = list(self.parts)
+        for i, name in self.slots:
+            parts[i] = escape(values[name])
+        out.extend(parts)
+
+    def render(self, values):
+        """
+        Returns the template filled with the escaped values.
+        """
+        out = []
+        self.extend(out, values)
+        return ''.join(out)
+
+class PageTemplate(object):
+    """
+    Splits a full page template into the document around <body> and the
+    body itself, so any number of pages can be stacked into one document and
+    rasterized together. The body's attributes move onto a <div> per page.
+    """
+    _body = re.compile(r'<body\b([^>]*)>(.*)</body>', re.S | re.I)
+
+    def __init__(self, text):
+        match = self._body.search(text)
+        if match is None:
+            raise ValueError("template has no <body> element")
+        self.head = CompiledTemplate(text[:match.start()])
+        self.page = CompiledTemplate('<div%s>%s</div>' % match.groups())
+        self.tail = CompiledTemplate(text[match.end():])
+
+    @classmethod
+    def from_file(cls, templatePath):
+        with open(templatePath) as templateFile:
+            return cls(templateFile.read())
+
+    def render(self, shared, pages):
+        """
+        Renders a document holding one page per entry of pages, stacked
+        top to bottom without margins.
+
+        Args:
+            shared (dict): values used by the document around the pages.
+            pages (list of dicts): values of every page.
+
+        Returns:
+            The html document.
+        """
+        out = []
+        self.head.extend(out, shared)
+        out.append('<body style="margin: 0; padding: 0;">')
+        for values in pages:
+            self.page.extend(out, values)
+        out.append('</body>')
+        self.tail.extend(out, shared)
+        return ''.join(out)
+
+def file_url(path):
+    """
+    Returns the file:// URL of a local path.
+    """
+    return 'file:' + urllib.pathname2url(os.path.abspath(path))
+
+def font_values(fontPath):
+    """
+    Template values that make a local .ttf file available to the page.
+    The font is declared in an inline stylesheet passed as a data: URL, so
+    nothing has to be written next to the font file.
+
+    Args:
+        fontPath (string): path to the font file to be used.
+
+    Returns:
+        dict with the 'font' and 'font_url' template values.
+    """
+    family = os.path.splitext(os.path.basename(fontPath))[0]
+    css = "@font-face { font-family: '%s'; src: url('%s'); }" \
+        % (family, file_url(fontPath))
+    return {'font': family,
+            'font_url': 'data:text/css;base64,' + base64.b64encode(css)}
+
+class LibWkhtmltoimage(object):
+    """
+    Renders through libwkhtmltox, loaded and initialized once per process.
+    Qt requires every call to come from the thread that initialized it, so
+    an instance must only be used by the thread that created it.
+    """
+    def __init__(self, libPath=None):
+        libPath = libPath or ctypes.util.find_library('wkhtmltox')
+        if libPath is None:
+            raise OSError("libwkhtmltox not found")
+        lib = ctypes.CDLL(libPath)
+        lib.wkhtmltoimage_create_global_settings.restype = ctypes.c_void_p
+        lib.wkhtmltoimage_set_global_setting.argtypes = \
+            [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+        lib.wkhtmltoimage_create_converter.restype = ctypes.c_void_p
+        lib.wkhtmltoimage_create_converter.argtypes = \
+            [ctypes.c_void_p, ctypes.c_char_p]
+        lib.wkhtmltoimage_convert.argtypes = [ctypes.c_void_p]
+        lib.wkhtmltoimage_get_output.restype = ctypes.c_long
+        lib.wkhtmltoimage_get_output.argtypes = \
+            [ctypes.c_void_p, ctypes.POINTER(ctypes.c_void_p)]
+        lib.wkhtmltoimage_destroy_converter.argtypes = [ctypes.c_void_p]
+        lib.wkhtmltoimage_init(0)
+        self.lib = lib
+
+    def render(self, html, width, height, fmt='png', quality=95):
+        """
+        Rasterizes an html page.
+
+        Returns:
+            The image file contents, in format fmt.
+        """
+        lib = self.lib
+        settings = lib.wkhtmltoimage_create_global_settings()
+        for name, value in (('fmt', fmt),
+                            ('quality', str(quality)),
+                            ('screenWidth', str(width)),
+                            ('smartWidth', 'false'),
+                            ('crop.width', str(width)),
+                            ('crop.height', str(height)),
+                            ('load.blockLocalFileAccess', 'false')):
+            lib.wkhtmltoimage_set_global_setting(settings, name, value)
+        converter = lib.wkhtmltoimage_create_converter(settings, html)
+        try:
+            if not lib.wkhtmltoimage_convert(converter):
+                raise RuntimeError("wkhtmltoimage conversion failed")
+            data = ctypes.c_void_p()
+            length = lib.wkhtmltoimage_get_output(converter, ctypes.byref(data))
+            return ctypes.string_at(data, length)
+        finally:
+            lib.wkhtmltoimage_destroy_converter(converter)
+
+class CliWkhtmltoimage(object):
+    """
+    Renders by running the wkhtmltoimage binary, page on stdin and image on
+    stdout.
+    """
+    def __init__(self, binary='wkhtmltoimage'):
+        self.binary = binary
+        usage = subprocess.Popen([binary, '--extended-help'],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0]
+        #Newer releases block file:// access unless asked not to.
+        self.extraArgs = ['--enable-local-file-access'] \
+            if 'enable-local-file-access' in usage else []
+
+    def render(self, html, width, height, fmt='png', quality=95):
+        """
+        Rasterizes an html page.
+
+        Returns:
+            The image file contents, in format fmt.
+        """
+        command = [self.binary, '--quiet', '--format', fmt,
+                   '--quality', str(quality), '--disable-smart-width',
+                   '--width', str(width), '--height', str(height)] \
+                   + self.extraArgs + ['-', '-']
+        process = subprocess.Popen(command, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate(html)
+        if process.returncode != 0 or not out:
+            raise RuntimeError("wkhtmltoimage failed: %s" % err.strip())
+        return out
+
+def create_renderer(binary='wkhtmltoimage'):
+    """
+    Returns the fastest available wkhtmltoimage renderer:
+    the shared library if it can be loaded, the binary otherwise.
+    """
+    try:
+        return LibWkhtmltoimage()
+    except OSError:
+        return CliWkhtmltoimage(binary)
+
+#Rasterizer owned by each worker process of HtmlRenderer.
+_worker = {}
+
+def _start_worker(binary):
+    #An exception escaping a pool initializer makes the pool respawn the
+    #worker forever, so failures are kept and reported per sheet instead.
+    try:
+        _worker['renderer'] = create_renderer(binary)
+    except Exception as e:
+        _worker['error'] = "cannot start renderer: %s" % e
+
+def _render_sheet(sheet):
+    """
+    Rasterizes one document of stacked pages inside a worker process and
+    saves every page as its own JPEG file.
+
+    Args:
+        sheet (tuple): (html, width, height, quality, pages) where pages is
+            a list of (destFilePath, top, width, height).
+
+    Returns:
+        list of (destFilePath, error message or None) per page.
+    """
+    from PIL import Image
+    html, width, height, quality, pages = sheet
+    if 'error' in _worker:
+        return [(page[0], _worker['error']) for page in pages]
+    try:
+        data = _worker['renderer'].render(html, width, height, 'png')
+        img = Image.open(io.BytesIO(data))
+        img.load()
+    except Exception as e:
+        return [(page[0], str(e)) for page in pages]
+    result = []
+    for destFilePath, top, pageWidth, pageHeight in pages:
+        try:
+            img.crop((0, top, pageWidth, top + pageHeight)).convert('RGB')\
+                .save(destFilePath, "JPEG", quality=quality,
+                      optimize=True, progressive=True)
+            result.append((destFilePath, None))
+        except Exception as e:
+            result.append((destFilePath, str(e)))
+    return result
+
+class HtmlRenderer(object):
+    """
+    Pool of persistent wkhtmltoimage renderer processes.
+    Use as a context manager, or call close() when done.
+    """
+    #QtWebKit cannot paint pages taller than 32767 pixels.
+    MAX_SHEET_HEIGHT = 32000
+
+    def __init__(self, processes=None, templatePath=TEMPLATE_PATH,
+                 binary='wkhtmltoimage', quality=95):
+        """
+        Args:
+            processes (int) optional, number of renderer processes.
+                default is the number of CPUs.
+            templatePath (string) optional, the html template to fill.
+            binary (string) optional, wkhtmltoimage executable used when
+                libwkhtmltox is not available.
+            quality (int) optional, JPEG quality of the output.
+        """
+        self.quality = quality
+        self.template = PageTemplate.from_file(templatePath)
+        self.pool = multiprocessing.Pool(processes,
+            initializer=_start_worker, initargs=(binary,))
+
+    def _sheets(self, jobs):
+        """
+        Lays the jobs out as stacked pages, one document per font, starting
+        a new document whenever one would get too tall to rasterize.
+        """
+        from PIL import Image
+        sheets = []
+        current = {}
+        for background, text, fontPath, dest in jobs:
+            width, height = Image.open(background).size
+            fonts = font_values(fontPath)
+            values = dict(fonts, image=file_url(background), width=str(width),
+                          height=str(height), showerthought=text)
+            sheet = current.get(fontPath)
+            if sheet is None or sheet['height'] + height > self.MAX_SHEET_HEIGHT:
+                sheet = current[fontPath] = {'shared': fonts, 'values': [],
+                    'pages': [], 'width': 0, 'height': 0}
+                sheets.append(sheet)
+            sheet['values'].append(values)
+            sheet['pages'].append((dest or background, sheet['height'], width, height))
+            sheet['width'] = max(sheet['width'], width)
+            sheet['height'] += height
+        result = []
+        for sheet in sheets:
+            html = self.template.render(sheet['shared'], sheet['values'])
+            if isinstance(html, unicode):
+                html = html.encode('utf-8')
+            result.append((html, sheet['width'], sheet['height'],
+                           self.quality, sheet['pages']))
+        return result
+
+    def render(self, jobs):
+        """
+        Renders images, one rasterizer call per sheet of stacked pages,
+        sheets in parallel.
+
+        Args:
+            jobs (list of tuples): (backgroundImagePath, text, fontPath,
+                destFilePath) per image. destFilePath may be None to
+                overwrite the background image.
+
+        Returns:
+            list of (destFilePath, error message or None), in job order.
+        """
+        results = {}
+        for sheetResult in self.pool.map(_render_sheet, self._sheets(jobs), chunksize=1):
+            results.update(sheetResult)
+        return [(dest or background, results[dest or background])
+                for background, text, fontPath, dest in jobs]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Shared memory buffers of decoded images for ShinyChromeShower's worker
+processes.
+
+A decoded background is copied once into a file in tmpfs (/dev/shm), and
+the workers are sent an ImageHandle naming it, a few dozen bytes, instead
+of the pickled pixels: a 6000x4000 RGB image pickles to 72 MB, which is
+copied into the pipe, out of it and into a new image for every job. A
+worker maps the buffer read only and gets an image backed by the mapping
+without copying it; the only copy it makes is the one it draws on.
+
+Lifecycle: the process owning an ImageBufferPool puts images into it and
+releases each one once no worker uses its handle any more. Released
+buffers are kept for reuse by later images up to a number of spares, and
+close() deletes them all. Buffers are named after the owner's pid, so the
+ones a crashed owner left behind are deleted by the next pool opened.
+"""
+from __future__ import print_function
+import os, re, mmap, errno, atexit, tempfile, itertools, contextlib, collections
+
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+PREFIX = 'shinychromeshower-'
+#The modes PIL can back with a buffer without copying it, by image mode.
+#RGB is kept in memory with 4 bytes per pixel, the layout of RGBX.
+STORED_MODES = {'L': 'L', 'RGB': 'RGBX', 'RGBX': 'RGBX', 'RGBA': 'RGBA', 'CMYK': 'CMYK'}
+
+#A decoded image in a shared buffer. mode is the image's own mode, the
+#pixels are stored in STORED_MODES[mode].
+ImageHandle = collections.namedtuple('ImageHandle', ['path', 'mode', 'size', 'length'])
+
+#The pools not closed yet, closed at exit.
+_openPools = set()
+
+def _close_pools():
+    for pool in list(_openPools):
+        pool.close()
+
+atexit.register(_close_pools)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+class ImageBufferPool(object):
+    """
+    The shared buffers of one owner process.
+    """
+    _name = re.compile(re.escape(PREFIX) + r'(\d+)-\d+\.buf$')
+
+    def __init__(self, directory=SHM_DIR, spares=2):
+        """
+        Args:
+            directory (string) optional, where the buffers are created,
+                tmpfs by default so they never touch a disk.
+            spares (int) optional, released buffers kept for reuse.
+        """
+        self.directory = directory
+        self.spares = spares
+        self.free = []
+        self.used = {}
+        self.names = itertools.count(1)
+        #Bytes of pixels copied into the buffers.
+        self.bytesCopied = 0
+        self.closed = False
+        for name in os.listdir(directory):
+            match = self._name.match(name)
+            if match and not _pid_alive(int(match.group(1))):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
+        _openPools.add(self)
+
+    def put(self, img):
+        """
+        Copies a decoded image into a buffer, reusing a spare one when one
+        is large enough.
+
+        Returns:
+            ImageHandle, to send to the workers, and release once they are
+            done with it.
+        """
+        if img.mode not in STORED_MODES:
+            img = img.convert('RGB')
+        storedMode = STORED_MODES[img.mode]
+        data = img.tobytes('raw', storedMode)
+        length = len(data)
+        spare = [(path, capacity) for path, capacity in self.free if capacity >= length]
+        if spare:
+            path, capacity = spare[0]
+            self.free.remove(spare[0])
+        else:
+            path = os.path.join(self.directory, '%s%d-%d.buf' % (PREFIX, os.getpid(), next(self.names)))
+            capacity = length
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < length:
+                os.ftruncate(fd, length)
+            buf = mmap.mmap(fd, length)
+        finally:
+            os.close(fd)
+        try:
+            buf[:] = data
+        finally:
+            buf.close()
+        self.bytesCopied += length
+        handle = ImageHandle(path, img.mode, img.size, length)
+        self.used[path] = capacity
+        return handle
+
+    def release(self, handle):
+        """
+        Gives a buffer back once no worker uses its handle: it is kept as a
+        spare, or deleted.
+        """
+        capacity = self.used.pop(handle.path, None)
+        if capacity is None:
+            return
+        if len(self.free) < self.spares:
+            self.free.append((handle.path, capacity))
+        else:
+            os.remove(handle.path)
+
+    def close(self):
+        """
+        Deletes every buffer, released or not.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        _openPools.discard(self)
+        for path in list(self.used) + [path for path, capacity in self.free]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.used.clear()
+        self.free = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+@contextlib.contextmanager
+def mapped_image(handle):
+    """
+    Context manager giving a read only image backed by a handle's buffer,
+    without copying it. The image must not be used once the block exits,
+    when the buffer is unmapped: draw on a copy, see image_copy.
+    """
+    from PIL import Image
+    storedMode = STORED_MODES[handle.mode]
+    fd = os.open(handle.path, os.O_RDONLY)
+    try:
+        buf = mmap.mmap(fd, handle.length, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+    try:
+        img = Image.frombuffer(storedMode, handle.size, buf, 'raw', storedMode, 0, 1)
+        yield img
+        del img
+    finally:
+        buf.close()
+
+def image_copy(handle):
+    """
+    Returns a private, writable copy of a handle's image in its own mode:
+    the single copy a worker makes.
+    """
+    with mapped_image(handle) as img:
+        if img.mode != handle.mode:
+            return img.convert(handle.mode)
+        return img.copy()
@@ -0,0 +1,273 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Durable job queue of ShinyChromeShower's pipeline stages.
+
+Jobs are rows of a SQLite file, so they survive crashes and can be drained
+by any number of worker processes, on this host or on others sharing the
+volume the file is on. A worker takes a job by leasing it for a visibility
+timeout: the job is hidden from the other workers until then, and becomes
+visible again if the worker dies or hangs without completing it. A job
+that fails is retried after a delay, and marked failed once it used up its
+attempts. Taking a job is a single write transaction, so no two workers
+ever hold the same job at once.
+
+The database uses SQLite's default rollback journal rather than WAL, which
+needs shared memory that network file systems do not provide.
+"""
+from __future__ import print_function
+import os, json, time, socket, sqlite3, threading, contextlib, collections
+
+VISIBILITY_TIMEOUT = 10*60 #seconds a taken job stays hidden from other workers.
+MAX_ATTEMPTS = 3 #Tries of a job before it is marked failed.
+RETRY_DELAY = 60 #seconds before a failed job is tried again.
+EXPIRY_DAYS = 30 #Jobs not updated for this many days are dropped on open.
+
+#A job taken from the queue. payload is the JSON value it was put with,
+#attempts counts this one.
+Job = collections.namedtuple('Job', ['id', 'stage', 'payload', 'attempts'])
+
+class Delay(Exception):
+    """
+    Raised by a handler to put its job back for a number of seconds without
+    using up an attempt, such as when something else holds what it needs.
+    """
+    def __init__(self, seconds, reason=''):
+        Exception.__init__(self, reason)
+        self.seconds = seconds
+
+def worker_name():
+    """
+    Names this process in the jobs it holds: host and pid.
+    """
+    return '%s:%d' %(socket.gethostname(), os.getpid())
+
+class JobQueue(object):
+    """
+    The jobs of all stages, each in one of the states
+        queued   waiting, visible from visible_at on.
+        running  leased by owner until visible_at.
+        done     completed.
+        failed   out of attempts, with the last error.
+    """
+    def __init__(self, dbPath, visibilityTimeout=VISIBILITY_TIMEOUT,
+                 maxAttempts=MAX_ATTEMPTS, retryDelay=RETRY_DELAY, expiryDays=EXPIRY_DAYS,
+                 onFailed=None):
+        """
+        Args:
+            dbPath (string): path of the SQLite file, created if missing.
+            visibilityTimeout (float): seconds a job stays leased.
+            maxAttempts (int): tries of a job before it is marked failed.
+            retryDelay (float): seconds before a failed job is retried.
+            expiryDays (float): drop jobs not updated for this long.
+            onFailed (function) optional, called with every Job this queue
+                marks failed, once the change is committed.
+        """
+        self.visibilityTimeout = visibilityTimeout
+        self.onFailed = onFailed
+        self.maxAttempts = maxAttempts
+        self.retryDelay = retryDelay
+        self.owner = worker_name()
+        #Shared with the thread extending the lease of a long job.
+        self.lock = threading.Lock()
+        #Transactions are explicit, and wait for the other workers' ones.
+        self.con = sqlite3.connect(dbPath, timeout=60, isolation_level=None,
+                                   check_same_thread=False)
+        with self.transaction():
+            self.con.execute('create table if not exists jobs (id integer primary key, '
+                             'stage text, payload text, state text, attempts integer, '
+                             'visible_at real, owner text, error text, updated_at real)')
+            self.con.execute('create index if not exists jobs_visible on jobs '
+                             '(stage, state, visible_at)')
+            self.con.execute("delete from jobs where updated_at < ?",
+                             (time.time()-expiryDays*24*3600,))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Context manager of a write transaction, holding the lock that
+        serializes this process's use of the connection.
+        """
+        with self.lock:
+            self.con.execute('begin immediate')
+            try:
+                yield
+            except:
+                self.con.execute('rollback')
+                raise
+            self.con.execute('commit')
+
+    def put(self, stage, payload, delay=0):
+        """
+        Queues a job.
+
+        Args:
+            stage (string): the stage whose workers take it.
+            payload: JSON serializable value handed to the worker.
+            delay (float) optional, seconds before it may be taken.
+
+        Returns:
+            int, the job's id.
+        """
+        now = time.time()
+        with self.transaction():
+            cursor = self.con.execute('insert into jobs (stage, payload, state, attempts, '
+                                      'visible_at, updated_at) values (?, ?, ?, 0, ?, ?)',
+                                      (stage, json.dumps(payload), 'queued', now+delay, now))
+            return cursor.lastrowid
+
+    def take(self, stage):
+        """
+        Leases the next visible job of a stage: a queued one, or a running
+        one whose lease ran out. A job whose lease ran out on its last
+        attempt is marked failed instead.
+
+        Returns:
+            Job, None if the stage has no visible job.
+        """
+        now = time.time()
+        job = None
+        timedOut = []
+        with self.transaction():
+            while True:
+                row = self.con.execute("select id, payload, attempts, state from jobs "
+                                       "where stage = ? and state in ('queued', 'running') "
+                                       "and visible_at <= ? order by visible_at, id limit 1",
+                                       (stage, now)).fetchone()
+                if row is None:
+                    break
+                jobId, payload, attempts, state = row
+                if state == 'running' and attempts >= self.maxAttempts:
+                    self.con.execute("update jobs set state = 'failed', updated_at = ?, "
+                                     "error = coalesce(error, 'timed out') where id = ?",
+                                     (now, jobId))
+                    timedOut.append(Job(jobId, stage, json.loads(payload), attempts))
+                    continue
+                self.con.execute("update jobs set state = 'running', attempts = ?, owner = ?, "
+                                 "visible_at = ?, updated_at = ? where id = ?",
+                                 (attempts+1, self.owner, now+self.visibilityTimeout, now, jobId))
+                job = Job(jobId, stage, json.loads(payload), attempts+1)
+                break
+        if self.onFailed is not None:
+            for failed in timedOut:
+                self.onFailed(failed)
+        return job
+
+    def _update(self, job, sql, values):
+        """
+        Runs an update of a job this worker still holds.
+
+        Returns:
+            True if it held the job, False if its lease ran out and another
+            worker took it since.
+        """
+        with self.transaction():
+            cursor = self.con.execute(sql+" where id = ? and owner = ? and attempts = ? "
+                                      "and state = 'running'",
+                                      values+(job.id, self.owner, job.attempts))
+            return cursor.rowcount == 1
+
+    def extend(self, job, seconds=None):
+        """
+        Extends the lease of a job still being worked on.
+        """
+        now = time.time()
+        return self._update(job, "update jobs set visible_at = ?, updated_at = ?",
+                            (now+(seconds or self.visibilityTimeout), now))
+
+    def complete(self, job):
+        return self._update(job, "update jobs set state = 'done', updated_at = ?",
+                            (time.time(),))
+
+    def fail(self, job, error):
+        """
+        Records a failed attempt: the job is retried after the retry delay,
+        or marked failed if it was its last attempt.
+        """
+        now = time.time()
+        state = 'failed' if job.attempts >= self.maxAttempts else 'queued'
+        updated = self._update(job, "update jobs set state = ?, error = ?, visible_at = ?, "
+                               "updated_at = ?", (state, str(error), now+self.retryDelay, now))
+        if updated and state == 'failed' and self.onFailed is not None:
+            self.onFailed(job)
+        return updated
+
+    def delay(self, job, seconds):
+        """
+        Puts a job back, to be taken again after seconds, giving back the
+        attempt it was taken with.
+        """
+        now = time.time()
+        return self._update(job, "update jobs set state = 'queued', attempts = attempts - 1, "
+                            "visible_at = ?, updated_at = ?", (now+seconds, now))
+
+    def pending(self, stage):
+        """
+        Number of jobs of a stage not done or failed yet, including the
+        ones leased by workers or waiting for a retry.
+        """
+        with self.lock:
+            return self.con.execute("select count(*) from jobs where stage = ? and "
+                                    "state in ('queued', 'running')", (stage,)).fetchone()[0]
+
+    def counts(self):
+        """
+        Returns:
+            dict of (stage, state) to the number of jobs.
+        """
+        with self.lock:
+            return dict(((stage, state), count) for stage, state, count in
+                        self.con.execute('select stage, state, count(*) from jobs '
+                                         'group by stage, state'))
+
+    def close(self):
+        with self.lock:
+            self.con.close()
+
+def work(queue, stage, handler, wait=False, pollSeconds=5):
+    """
+    Takes the jobs of a stage and runs handler(job) on each, until the stage
+    has no jobs left that are queued or leased by other workers, or forever
+    with wait. The lease of a job is extended while the handler runs; a job
+    is completed when handler returns, put back when it raises Delay and
+    failed when it raises anything else.
+
+    Returns:
+        tuple(int, int): the jobs completed by this worker, and the ones it
+            failed on their last attempt.
+    """
+    completed = failed = 0
+    while True:
+        job = queue.take(stage)
+        if job is None:
+            if wait or queue.pending(stage):
+                time.sleep(pollSeconds)
+                continue
+            return completed, failed
+        stopped = threading.Event()
+        def keep_leased():
+            while not stopped.wait(queue.visibilityTimeout/3.0):
+                queue.extend(job)
+        extender = threading.Thread(target=keep_leased)
+        extender.daemon = True
+        extender.start()
+        try:
+            handler(job)
+        except Delay as e:
+            stopped.set()
+            extender.join()
+            print("%s job %d put back for %ds: %s" %(stage, job.id, e.seconds, e))
+            queue.delay(job, e.seconds)
+        except Exception as e:
+            stopped.set()
+            extender.join()
+            print("%s job %d failed (attempt %d of %d): %s"
+                  %(stage, job.id, job.attempts, queue.maxAttempts, e))
+            if queue.fail(job, e) and job.attempts >= queue.maxAttempts:
+                failed += 1
+        else:
+            stopped.set()
+            extender.join()
+            if not queue.complete(job):
+                print("%s job %d was taken over by another worker." %(stage, job.id))
+            completed += 1
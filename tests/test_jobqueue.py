@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Tests of the job queue's leases, retries and failures.
+
+usage: python -m unittest discover tests
+"""
+import os, sys, time, shutil, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import jobqueue
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.failed = []
+        self.queues = []
+
+    def tearDown(self):
+        for queue in self.queues:
+            queue.close()
+        shutil.rmtree(self.dir)
+
+    def worker(self, name, **kwargs):
+        """ A queue on the shared file, as another worker process opens it """
+        settings = dict(visibilityTimeout=0.2, maxAttempts=2, retryDelay=0,
+                        onFailed=self.failed.append)
+        settings.update(kwargs)
+        queue = jobqueue.JobQueue(os.path.join(self.dir, 'queue.db'), **settings)
+        queue.owner = name
+        self.queues.append(queue)
+        return queue
+
+    def test_a_leased_job_is_hidden_until_its_lease_runs_out(self):
+        first, second = self.worker('first'), self.worker('second')
+        first.put('render', {'n': 1})
+        job = first.take('render')
+        self.assertEqual((job.payload, job.attempts), ({'n': 1}, 1))
+        self.assertIsNone(second.take('render'))
+        self.assertEqual(second.pending('render'), 1)
+        time.sleep(0.3)
+        retaken = second.take('render')
+        self.assertEqual((retaken.id, retaken.attempts), (job.id, 2))
+        # The first worker lost the job, and cannot complete it any more
+        self.assertFalse(first.complete(job))
+        self.assertTrue(second.complete(retaken))
+        self.assertEqual(second.counts(), {('render', 'done'): 1})
+
+    def test_extending_a_lease_keeps_the_job(self):
+        first, second = self.worker('first'), self.worker('second')
+        first.put('render', {})
+        job = first.take('render')
+        time.sleep(0.1)
+        self.assertTrue(first.extend(job, 1))
+        time.sleep(0.2)
+        self.assertIsNone(second.take('render'))
+        self.assertTrue(first.complete(job))
+
+    def test_a_failed_job_is_retried_then_marked_failed(self):
+        queue = self.worker('worker')
+        queue.put('upload', {'path': '/a.jpg'})
+        job = queue.take('upload')
+        self.assertTrue(queue.fail(job, ValueError('first')))
+        self.assertEqual(self.failed, [])
+        job = queue.take('upload')
+        self.assertEqual(job.attempts, 2)
+        self.assertTrue(queue.fail(job, ValueError('second')))
+        self.assertIsNone(queue.take('upload'))
+        self.assertEqual(queue.counts(), {('upload', 'failed'): 1})
+        self.assertEqual(self.failed, [job])
+
+    def test_a_job_timing_out_on_its_last_attempt_is_marked_failed(self):
+        queue = self.worker('worker', maxAttempts=1)
+        queue.put('render', {})
+        job = queue.take('render')
+        time.sleep(0.3)
+        self.assertIsNone(queue.take('render'))
+        self.assertEqual(queue.counts(), {('render', 'failed'): 1})
+        self.assertEqual(self.failed, [job])
+
+    def test_retry_waits_for_the_retry_delay(self):
+        queue = self.worker('worker', retryDelay=60)
+        queue.put('render', {})
+        queue.fail(queue.take('render'), 'error')
+        self.assertIsNone(queue.take('render'))
+        self.assertEqual(queue.pending('render'), 1)
+
+    def test_delay_gives_the_attempt_back(self):
+        queue = self.worker('worker', maxAttempts=1)
+        queue.put('upload', {})
+        job = queue.take('upload')
+        self.assertTrue(queue.delay(job, 0))
+        job = queue.take('upload')
+        self.assertEqual(job.attempts, 1)
+        self.assertTrue(queue.delay(job, 60))
+        self.assertIsNone(queue.take('upload'))
+        self.assertEqual(queue.counts(), {('upload', 'queued'): 1})
+
+    def test_work_counts_each_job_once(self):
+        queue = self.worker('worker')
+        for n in range(3):
+            queue.put('render', {'n': n})
+        def handler(job):
+            if job.payload['n'] == 1:
+                raise ValueError('broken')
+        self.assertEqual(jobqueue.work(queue, 'render', handler), (2, 1))
+        self.assertEqual(queue.counts(), {('render', 'done'): 2, ('render', 'failed'): 1})
+
+    def test_work_puts_delayed_jobs_back(self):
+        queue = self.worker('worker', maxAttempts=1)
+        queue.put('upload', {})
+        delayed = []
+        def handler(job):
+            if not delayed:
+                delayed.append(job)
+                raise jobqueue.Delay(0, 'leased elsewhere')
+        self.assertEqual(jobqueue.work(queue, 'upload', handler, pollSeconds=0), (1, 0))
+        self.assertEqual(queue.counts(), {('upload', 'done'): 1})
+
+if __name__ == '__main__':
+    unittest.main()
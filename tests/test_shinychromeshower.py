@@ -0,0 +1,206 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Tests of the state ShinyChromeShower keeps from one run to the next.
+
+usage: python -m unittest discover tests
+"""
+import os, sys, time, random, shutil, sqlite3, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import ShinyChromeShower
+
+class PostLedgerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'ledger.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def reopen(self, ledger, expiryDays=30):
+        ledger.close()
+        return ShinyChromeShower.PostLedger(self.path, expiryDays)
+
+    def test_skips_rejected_queued_and_rendered_posts(self):
+        ledger = ShinyChromeShower.PostLedger(self.path)
+        ledger.accept('a')
+        ledger.reject('r', 'resolution 640x480')
+        ledger.queued('q')
+        ledger.rendered('w', '/tmp/w.png')
+        ledger = self.reopen(ledger)
+        self.assertFalse(ledger.is_known('a'))
+        self.assertTrue(ledger.is_known('r'))
+        self.assertTrue(ledger.is_known('q'))
+        self.assertTrue(ledger.is_known('w'))
+        self.assertFalse(ledger.is_known('new'))
+        ledger.close()
+
+    def test_release_makes_queued_posts_candidates_again(self):
+        ledger = ShinyChromeShower.PostLedger(self.path)
+        ledger.queued('q')
+        ledger.rendered('w', '/tmp/w.png')
+        ledger.release('q')
+        ledger.release('w')
+        ledger = self.reopen(ledger)
+        self.assertFalse(ledger.is_known('q'))
+        self.assertTrue(ledger.is_known('w'))
+        ledger.close()
+
+    def test_expired_entries_are_dropped_on_open(self):
+        ledger = ShinyChromeShower.PostLedger(self.path)
+        ledger.reject('old', 'aspect ratio')
+        ledger.reject('recent', 'aspect ratio')
+        ledger.con.execute('update posts set seen_at = ? where id = ?',
+                           (time.time() - 3*24*3600, 'old'))
+        ledger = self.reopen(ledger, expiryDays=2)
+        self.assertFalse(ledger.is_known('old'))
+        self.assertTrue(ledger.is_known('recent'))
+        self.assertEqual(ledger.con.execute('select count(*) from posts').fetchone()[0], 1)
+        ledger.close()
+
+def flip(value, bits):
+    """ value with the given bit positions inverted """
+    for bit in bits:
+        value ^= 1 << bit
+    return value
+
+class ImageHashIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.con = sqlite3.connect(':memory:')
+        self.index = ShinyChromeShower.ImageHashIndex(self.con, maxDistance=4)
+        self.value = random.Random(34).getrandbits(64)
+        self.index.add(self.value, 'original')
+
+    def test_matches_up_to_the_threshold(self):
+        #Bits spread over every chunk, so no chunk is left whole but one.
+        self.assertEqual(self.index.find(flip(self.value, [0, 13, 26, 39])), ('original', 4))
+        self.assertIsNone(self.index.find(flip(self.value, [0, 13, 26, 39, 52])))
+
+    def test_returns_the_closest_match(self):
+        self.index.add(flip(self.value, [1, 2, 3]), 'far')
+        self.index.add(flip(self.value, [1]), 'near')
+        self.assertEqual(self.index.find(flip(self.value, [1, 5])), ('near', 1))
+
+    def test_ignores_the_excluded_post(self):
+        self.assertIsNone(self.index.find(self.value, excludeId='original'))
+
+    def test_hashes_above_63_bits_survive_a_reload(self):
+        value = (1 << 63) | 5
+        self.index.add(value, 'high')
+        self.index.close()
+        index = ShinyChromeShower.ImageHashIndex(self.con, maxDistance=4)
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.find(flip(value, [0])), ('high', 1))
+
+class RenderCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = ShinyChromeShower.RenderCache(os.path.join(self.dir, 'cache'), maxBytes=25)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.dir)
+
+    def image(self, name, content):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_keys_change_with_every_input(self):
+        key = ShinyChromeShower.render_key('digest', 'caption', 'font.ttf', 1080)
+        self.assertEqual(key, ShinyChromeShower.render_key('digest', 'caption', 'font.ttf', 1080))
+        self.assertNotEqual(key, ShinyChromeShower.render_key('digest', 'other caption', 'font.ttf', 1080))
+        self.assertNotEqual(key, ShinyChromeShower.render_key('other', 'caption', 'font.ttf', 1080))
+        self.assertNotEqual(key, ShinyChromeShower.render_key('digest', 'caption', 'font.ttf', 720))
+
+    def test_hit_copies_the_stored_image(self):
+        dest = os.path.join(self.dir, 'out.jpg')
+        self.assertFalse(self.cache.get('a', dest))
+        self.cache.put('a', self.image('a.jpg', 'x'*10))
+        self.assertTrue(self.cache.get('a', dest))
+        self.assertEqual(self.read(dest), 'x'*10)
+
+    def test_evicts_the_least_recently_used(self):
+        dest = os.path.join(self.dir, 'out.jpg')
+        self.cache.put('a', self.image('a.jpg', 'a'*10))
+        time.sleep(0.01)
+        self.cache.put('b', self.image('b.jpg', 'b'*10))
+        time.sleep(0.01)
+        self.assertTrue(self.cache.get('a', dest))
+        self.cache.put('c', self.image('c.jpg', 'c'*10))
+        self.assertTrue(self.cache.get('a', dest))
+        self.assertFalse(self.cache.get('b', dest))
+        self.assertTrue(self.cache.get('c', dest))
+        self.assertEqual(self.cache.size, 20)
+
+    def test_an_entry_whose_file_is_gone_is_a_miss(self):
+        self.cache.put('a', self.image('a.jpg', 'a'*10))
+        os.remove(os.path.join(self.dir, 'cache', 'a.jpg'))
+        self.assertFalse(self.cache.get('a', os.path.join(self.dir, 'out.jpg')))
+        self.assertEqual(self.cache.size, 0)
+
+def post(postId, title='title'):
+    return ShinyChromeShower.RedditPost(postId, 'http://i.imgur.com/%s.jpg' % postId, title,
+                                        None, 1080, 1920)
+
+class RunJournalTest(unittest.TestCase):
+    settings = {'dest': '/wallpapers', 'renderer': 'pil', 'captions_per_image': 1,
+                'max_size': None, 'targets': None}
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'journal.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def crashed_run(self):
+        journal = ShinyChromeShower.RunJournal(self.path)
+        journal.select([post('i1'), post('i2')], [post('t1', u'caf\xe9')], self.settings)
+        journal.mark('i1', 'downloaded', name='i1')
+        journal.mark('i1', 'finalized')
+        journal.mark('i2', 'downloaded', name='i2')
+        return journal
+
+    def test_resumes_an_unfinished_run_with_its_posts_and_stages(self):
+        self.crashed_run()
+        journal = ShinyChromeShower.RunJournal(self.path)
+        self.assertTrue(journal.load(self.settings))
+        images, texts = journal.posts()
+        self.assertEqual([p.id for p in images], ['i1', 'i2'])
+        self.assertEqual(texts, [post('t1', u'caf\xe9')])
+        self.assertEqual(journal.item('i1'), {'stage': 'finalized', 'name': 'i1'})
+        self.assertEqual(journal.item('i2')['stage'], 'downloaded')
+        self.assertEqual(journal.item('t1'), {})
+
+    def test_does_not_resume_a_finished_run_or_other_settings(self):
+        self.crashed_run()
+        self.assertFalse(ShinyChromeShower.RunJournal(self.path).load(dict(self.settings, renderer='html')))
+        journal = ShinyChromeShower.RunJournal(self.path)
+        journal.load(self.settings)
+        journal.finish()
+        self.assertFalse(ShinyChromeShower.RunJournal(self.path).load(self.settings))
+
+    def test_a_missing_or_broken_journal_is_not_resumed(self):
+        self.assertFalse(ShinyChromeShower.RunJournal(self.path).load(self.settings))
+        with open(self.path, 'w') as f:
+            f.write('{"finished": fal')
+        self.assertFalse(ShinyChromeShower.RunJournal(self.path).load(self.settings))
+
+    def test_clean_deletes_what_unfinished_items_left(self):
+        journal = self.crashed_run()
+        leftovers = [os.path.join(self.dir, name + '.background') for name in ('i1', 'i2')]
+        for path in leftovers:
+            open(path, 'w').close()
+        journal.clean(self.dir)
+        self.assertTrue(os.path.exists(leftovers[0]))
+        self.assertFalse(os.path.exists(leftovers[1]))
+
+if __name__ == '__main__':
+    unittest.main()
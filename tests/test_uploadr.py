@@ -0,0 +1,298 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Tests of the database and the run state of uploadr.
+
+usage: python -m unittest discover tests
+"""
+import os, sys, time, fcntl, socket, shutil, sqlite3, tempfile, unittest, subprocess
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+import uploadr
+
+class UploadrTestCase(unittest.TestCase):
+    """ Points uploadr's files at a temporary directory for every test """
+    settings = ('FILES_DIR', 'DB_PATH', 'TOKEN_PATH', 'LOCK_PATH')
+
+    def setUp(self):
+        uploadr.loadConfig(os.path.join(ROOT, 'uploadr.ini'))
+        self.saved = dict((name, getattr(uploadr, name)) for name in self.settings)
+        self.dir = tempfile.mkdtemp()
+        uploadr.FILES_DIR = os.path.join(self.dir, 'files')
+        uploadr.DB_PATH = os.path.join(self.dir, 'flickrdb')
+        uploadr.TOKEN_PATH = os.path.join(self.dir, '.flickrToken')
+        uploadr.LOCK_PATH = os.path.join(self.dir, 'uploadr.lock')
+        os.makedirs(uploadr.FILES_DIR)
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(uploadr, name, value)
+        shutil.rmtree(self.dir)
+
+    def query(self, sql, *values):
+        con = sqlite3.connect(uploadr.DB_PATH)
+        try:
+            return con.execute(sql, values).fetchall()
+        finally:
+            con.close()
+
+class MigrationTest(UploadrTestCase):
+    def build_v1(self, userVersion=1):
+        """ A database as the version 1 setupDB left it """
+        con = sqlite3.connect(uploadr.DB_PATH)
+        con.execute('create table files (files_id int, path text, set_id int, md5 text, tagged int'
+                    + (', last_modified REAL)' if userVersion else ')'))
+        con.execute('create table sets (set_id int, name text, primary_photo_id INTEGER)')
+        con.execute('create unique index fileindex on files (path)')
+        con.execute('create index setsindex on sets (name)')
+        con.execute('PRAGMA user_version=%d' % userVersion)
+        files = [(1, '/photos/a/1.jpg', 10, 'md5-1', 1), (2, '/photos/a/2.jpg', 10, 'md5-2', None),
+                 (None, '/photos/a/broken.jpg', None, 'md5-3', None),
+                 (2, '/photos/b/2.jpg', 11, 'md5-2', 1)]
+        con.executemany('insert into files (files_id, path, set_id, md5, tagged) values (?, ?, ?, ?, ?)', files)
+        con.executemany('insert into sets values (?, ?, ?)', [(10, 'a', 1), (11, 'b', 2), (None, 'c', 3)])
+        con.commit()
+        con.close()
+
+    def test_migrates_a_v1_database(self):
+        self.build_v1()
+        uploadr.Uploadr().setupDB()
+        self.assertEqual(self.query('PRAGMA user_version'), [(uploadr.DB_SCHEMA_VERSION,)])
+        # Of the rows sharing an ID the latest is kept, rows without one are dropped
+        self.assertEqual(self.query('select files_id, path, set_id, md5, tagged from files order by files_id'),
+                         [(1, '/photos/a/1.jpg', 10, 'md5-1', 1), (2, '/photos/b/2.jpg', 11, 'md5-2', 1)])
+        self.assertEqual(self.query('select set_id, name from sets order by set_id'), [(10, 'a'), (11, 'b')])
+        indexes = set(row[0] for row in self.query("select name from sqlite_master where type = 'index'"))
+        self.assertTrue(set(['fileindex', 'files_set_id', 'files_md5', 'files_tagged', 'setsindex']) <= indexes)
+        self.assertEqual(self.query("select count(*) from sqlite_master where name like '%_v1'"), [(0,)])
+
+    def test_migrates_a_database_older_than_v1(self):
+        self.build_v1(userVersion=0)
+        uploadr.Uploadr().setupDB()
+        self.assertEqual(self.query('PRAGMA user_version'), [(uploadr.DB_SCHEMA_VERSION,)])
+        self.assertEqual(self.query('select count(last_modified), count(*) from files'), [(0, 2)])
+
+    def test_a_current_database_is_left_alone(self):
+        self.build_v1()
+        uploadr.Uploadr().setupDB()
+        before = self.query('select * from files order by files_id')
+        uploadr.Uploadr().setupDB()
+        self.assertEqual(self.query('select * from files order by files_id'), before)
+
+class TreeWalkerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.dir, 'files')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def touch(self, *names, **kwargs):
+        path = os.path.join(self.root, *names)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write('x' * kwargs.get('size', 1))
+        return path
+
+    def walk(self, **kwargs):
+        settings = dict(excludedFolders=['@eaDir'], ignoredRegex=[r'^\.'],
+                        allowedExt=['jpg', 'png'], maxSize=100, threads=4)
+        settings.update(kwargs)
+        return sorted(uploadr.TreeWalker(self.root, **settings).walk())
+
+    def test_yields_the_files_that_may_be_uploaded(self):
+        wanted = [self.touch('a', '1.jpg'), self.touch('a', 'b', '2.PNG'), self.touch('3.jpg')]
+        self.touch('a', 'notes.txt')
+        self.touch('a', '.hidden.jpg')
+        self.touch('a', 'big.jpg', size=200)
+        self.touch('@eaDir', '4.jpg')
+        self.assertEqual(self.walk(), sorted(wanted))
+
+    def test_no_size_limit(self):
+        big = self.touch('big.jpg', size=200)
+        self.assertEqual(self.walk(maxSize=None), [big])
+
+    def test_symlink_cycles_are_not_followed(self):
+        wanted = self.touch('a', 'b', '1.jpg')
+        os.symlink(self.root, os.path.join(self.root, 'a', 'b', 'up'))
+        os.symlink(os.path.join(self.root, 'a'), os.path.join(self.root, 'a', 'self'))
+        self.assertEqual(self.walk(), [wanted])
+
+    def test_symlinks_to_other_directories_are_followed(self):
+        outside = os.path.join(self.dir, 'elsewhere')
+        os.makedirs(outside)
+        with open(os.path.join(outside, '1.jpg'), 'w') as f:
+            f.write('x')
+        self.touch('a', '2.jpg')
+        os.symlink(outside, os.path.join(self.root, 'a', 'linked'))
+        # A dangling link is skipped
+        os.symlink(os.path.join(self.dir, 'gone'), os.path.join(self.root, 'a', 'gone.jpg'))
+        self.assertEqual(self.walk(), [os.path.join(self.root, 'a', '2.jpg'),
+                                       os.path.join(self.root, 'a', 'linked', '1.jpg')])
+
+class InstanceLockTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'uploadr.lock')
+        self.held = []
+
+    def tearDown(self):
+        for f in self.held:
+            f.close()
+        shutil.rmtree(self.dir)
+
+    def hold(self, host, pid, touched=None):
+        """ Locks the file as another process recorded in it would """
+        f = open(self.path, 'a+')
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        f.write("%s %d %f\n" % (host, pid, time.time()))
+        f.flush()
+        if touched is not None:
+            os.utime(self.path, (touched, touched))
+        self.held.append(f)
+
+    def dead_pid(self):
+        process = subprocess.Popen(['true'])
+        process.wait()
+        return process.pid
+
+    def test_only_one_holder_at_a_time(self):
+        first = uploadr.InstanceLock(self.path, 3600)
+        self.assertTrue(first.acquire())
+        self.assertEqual(first.holder()[:2], (socket.gethostname(), os.getpid()))
+        self.assertFalse(uploadr.InstanceLock(self.path, 3600).acquire())
+        first.release()
+        self.assertFalse(os.path.exists(self.path))
+        second = uploadr.InstanceLock(self.path, 3600)
+        self.assertTrue(second.acquire())
+        second.release()
+
+    def test_live_holder_on_another_host_is_kept(self):
+        self.hold('otherhost', 1)
+        self.assertFalse(uploadr.InstanceLock(self.path, 3600).acquire())
+
+    def test_takes_over_from_a_dead_holder(self):
+        self.hold(socket.gethostname(), self.dead_pid())
+        lock = uploadr.InstanceLock(self.path, 3600)
+        self.assertTrue(lock.acquire())
+        self.assertEqual(lock.holder()[1], os.getpid())
+        lock.release()
+
+    def test_takes_over_a_lock_whose_heartbeat_stopped(self):
+        self.hold('otherhost', 1, touched=time.time() - 120)
+        self.assertFalse(uploadr.InstanceLock(self.path, 300).acquire())
+        lock = uploadr.InstanceLock(self.path, 60)
+        self.assertTrue(lock.acquire())
+        self.assertEqual(lock.holder()[1], os.getpid())
+        lock.release()
+
+class LeaseTest(UploadrTestCase):
+    def uploader(self, owner, shared=True):
+        flick = uploadr.Uploadr()
+        flick.owner = owner
+        flick.shared = shared
+        return flick
+
+    def test_shared_processes_lease_files_from_each_other(self):
+        first, second = self.uploader('host:1'), self.uploader('host:2')
+        first.setupDB()
+        self.assertTrue(first.claimLease('/photos/1.jpg'))
+        self.assertFalse(second.claimLease('/photos/1.jpg'))
+        self.assertTrue(second.claimLease('/photos/2.jpg'))
+        first.releaseLease('/photos/1.jpg')
+        self.assertTrue(second.claimLease('/photos/1.jpg'))
+
+    def test_the_lock_holder_takes_no_lease(self):
+        holder, helper = self.uploader('host:1', shared=False), self.uploader('host:2')
+        holder.setupDB()
+        self.assertTrue(holder.claimLease('/photos/1.jpg'))
+        self.assertEqual(self.query('select count(*) from leases'), [(0,)])
+        self.assertTrue(helper.claimLease('/photos/2.jpg'))
+        self.assertFalse(holder.claimLease('/photos/2.jpg'))
+
+    def test_an_expired_lease_is_taken_over(self):
+        first, second = self.uploader('host:1'), self.uploader('host:2')
+        first.setupDB()
+        self.assertTrue(first.claimLease('/photos/1.jpg'))
+        con = sqlite3.connect(uploadr.DB_PATH)
+        con.execute('update leases set expires = ?', (time.time() - 1,))
+        con.commit()
+        con.close()
+        self.assertTrue(second.claimLease('/photos/1.jpg'))
+        self.assertEqual(self.query('select owner from leases'), [('host:2',)])
+
+class ChangeTrackerTest(UploadrTestCase):
+    def setUp(self):
+        UploadrTestCase.setUp(self)
+        uploadr.Uploadr().setupDB()
+        self.album = os.path.join(uploadr.FILES_DIR, 'album')
+        os.makedirs(self.album)
+        self.photo = os.path.join(self.album, '1.jpg')
+        open(self.photo, 'w').close()
+        self.age_tree()
+
+    def age_tree(self):
+        """ Directory mtimes recent enough to change unnoticed are not trusted """
+        old = time.time() - 60
+        for path in (uploadr.FILES_DIR, self.album):
+            os.utime(path, (old, old))
+
+    def run_phase(self, phase, maxAge=3600, failures=None):
+        """ Runs phase as a new uploadr run would; True if it was not skipped """
+        tracker = uploadr.ChangeTracker(uploadr.FILES_DIR, uploadr.EXCLUDED_FOLDERS, maxAge, 2)
+        return tracker.run(phase, lambda: None, failures)
+
+    def execute(self, sql, *values):
+        con = sqlite3.connect(uploadr.DB_PATH)
+        with con:
+            con.execute(sql, values)
+        con.close()
+
+    def test_skips_a_phase_whose_inputs_did_not_change(self):
+        self.assertTrue(self.run_phase('upload'))
+        self.assertFalse(self.run_phase('upload'))
+        self.assertFalse(self.run_phase('upload'))
+
+    def test_runs_when_a_file_is_added_or_removed(self):
+        self.run_phase('upload')
+        open(os.path.join(self.album, '2.jpg'), 'w').close()
+        self.assertTrue(self.run_phase('upload'))
+        self.age_tree()
+        self.assertTrue(self.run_phase('upload'))
+        self.assertFalse(self.run_phase('upload'))
+        os.remove(self.photo)
+        self.assertTrue(self.run_phase('upload'))
+
+    def test_runs_when_its_tables_change(self):
+        self.run_phase('addTagsToUploadedPhotos')
+        self.assertFalse(self.run_phase('addTagsToUploadedPhotos'))
+        self.execute('insert into files (files_id, path, tagged) values (1, ?, 1)', self.photo)
+        self.assertTrue(self.run_phase('addTagsToUploadedPhotos'))
+        self.assertFalse(self.run_phase('addTagsToUploadedPhotos'))
+        # Tables the phase does not read do not matter
+        self.execute("insert into sets (set_id, name) values (5, 'album')")
+        self.assertFalse(self.run_phase('addTagsToUploadedPhotos'))
+
+    def test_runs_again_after_failures_or_with_work_pending(self):
+        self.run_phase('upload', failures=lambda: 1)
+        self.assertTrue(self.run_phase('upload'))
+        self.assertFalse(self.run_phase('upload'))
+        self.execute('insert into files (files_id, path) values (1, ?)', self.photo)
+        # The photo is in no set yet, so createSets has work left
+        self.assertTrue(self.run_phase('createSets'))
+        self.assertTrue(self.run_phase('createSets'))
+        self.execute('update files set set_id = 5')
+        self.assertTrue(self.run_phase('createSets'))
+        self.assertFalse(self.run_phase('createSets'))
+
+    def test_runs_once_its_last_run_is_too_old(self):
+        self.run_phase('upload')
+        self.assertTrue(self.run_phase('upload', maxAge=0))
+        self.execute('update run_state set completed_at = ?', time.time() - 7200)
+        self.assertTrue(self.run_phase('upload'))
+        self.assertFalse(self.run_phase('upload'))
+
+if __name__ == '__main__':
+    unittest.main()
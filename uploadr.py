@@ -58,64 +58,124 @@ if sys.version_info < (2,7):
   sys.stderr.flush()
   sys.exit(1)
 
-import argparse
 import hashlib
-import mimetools
-import mimetypes
 import os
-import shelve
-import string
 import time
-import urllib
-import urllib2
-import webbrowser
 import sqlite3 as lite
-import pprint
 import json
-from xml.dom.minidom import parse
-import hashlib
-import errno
-import subprocess
-from sys import stdout
-import itertools
 import re
+import stat
+import threading
+import Queue
+import heapq
+import zlib
+import socket
+import errno
+import concurrency
+
+# scandir tells directories from files without a stat call per entry
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Heavier modules (urllib and urllib2, which pull in ssl, multiprocessing,
+# subprocess, BaseHTTPServer, the upload encoding and XML parsing) are imported by the methods using them, so
+# importing uploadr as a library stays cheap and has no side effects.
 
 ##
-## Read Config from config.ini file
+## Read Config from uploadr.ini file
 ##
 
-import ConfigParser
-config = ConfigParser.ConfigParser()
-config.read(os.path.join(os.path.dirname(sys.argv[0]), "uploadr.ini"))
-FILES_DIR = eval(config.get('Config','FILES_DIR'))
-FLICKR = eval(config.get('Config','FLICKR'))
-SLEEP_TIME = eval(config.get('Config','SLEEP_TIME'))
-DRIP_TIME = eval(config.get('Config','DRIP_TIME'))
-DB_PATH = eval(config.get('Config','DB_PATH'))
-LOCK_PATH = eval(config.get('Config','LOCK_PATH'))
-TOKEN_PATH = eval(config.get('Config','TOKEN_PATH'))
-EXCLUDED_FOLDERS = eval(config.get('Config','EXCLUDED_FOLDERS'))
-IGNORED_REGEX = [re.compile(regex) for regex in eval(config.get('Config', 'IGNORED_REGEX'))]
-ALLOWED_EXT = eval(config.get('Config','ALLOWED_EXT'))
-RAW_EXT = eval(config.get('Config','RAW_EXT'))
-FILE_MAX_SIZE = eval(config.get('Config','FILE_MAX_SIZE'))
-MANAGE_CHANGES = eval(config.get('Config','MANAGE_CHANGES'))
-RAW_TOOL_PATH = eval(config.get('Config','RAW_TOOL_PATH'))
-CONVERT_RAW_FILES = eval(config.get('Config','CONVERT_RAW_FILES'))
-FULL_SET_NAME = eval(config.get('Config','FULL_SET_NAME'))
-
-#print FILES_DIR
-#print FLICKR
-#print SLEEP_TIME
-#print DRIP_TIME
-#print DB_PATH
-#print LOCK_PATH
-#print TOKEN_PATH
-#print EXCLUDED_FOLDERS
-#print ALLOWED_EXT
-#print FILE_MAX_SIZE
-#print MANAGE_CHANGES
-#sys.exit()
+# The settings, filled in by loadConfig()
+FILES_DIR = None
+FLICKR = None
+SLEEP_TIME = None
+DRIP_TIME = None
+DB_PATH = None
+LOCK_PATH = None
+TOKEN_PATH = None
+TOKEN_TTL = None
+EXCLUDED_FOLDERS = None
+IGNORED_REGEX = None
+ALLOWED_EXT = None
+RAW_EXT = None
+FILE_MAX_SIZE = None
+MANAGE_CHANGES = None
+RAW_TOOL_PATH = None
+CONVERT_RAW_FILES = None
+RAW_CONVERT_PROCESSES = None
+FULL_SET_NAME = None
+WALK_THREADS = None
+LOCK_STALE_TIME = None
+LEASE_TIME = None
+UPLOAD_THREADS = None
+UPLOAD_SHARES = None
+UPLOAD_DEADLINES = None
+FRESH_AGE = None
+SKIP_UNCHANGED_FOR = None
+
+configPath = None
+
+# Version of the database schema, kept in PRAGMA user_version
+DB_SCHEMA_VERSION = 2
+
+def configValue( config, name, default=None ):
+    """ Evaluates one setting of uploadr.ini, default when it is missing.
+    A setting left blank, such as "FILES_DIR =", is an empty string rather
+    than an expression eval cannot parse.
+    """
+    if not config.has_option('Config', name):
+        return default
+    value = config.get('Config', name)
+    if not value.strip():
+        return ""
+    return eval(value)
+
+def loadConfig( path=None ):
+    """ Reads the settings from uploadr.ini, by default the one next to the script.
+    Only the first call reads the file unless a path is given.
+    """
+    global configPath, FILES_DIR, FLICKR, SLEEP_TIME, DRIP_TIME, DB_PATH, LOCK_PATH, TOKEN_PATH, TOKEN_TTL
+    global EXCLUDED_FOLDERS, IGNORED_REGEX, ALLOWED_EXT, RAW_EXT, FILE_MAX_SIZE, MANAGE_CHANGES
+    global RAW_TOOL_PATH, CONVERT_RAW_FILES, RAW_CONVERT_PROCESSES, FULL_SET_NAME, WALK_THREADS
+    global UPLOAD_THREADS, UPLOAD_SHARES, UPLOAD_DEADLINES, FRESH_AGE, LOCK_STALE_TIME, LEASE_TIME
+    global SKIP_UNCHANGED_FOR
+    if configPath is not None and path is None:
+        return
+    import ConfigParser
+    configPath = path or os.path.join(os.path.dirname(sys.argv[0]), "uploadr.ini")
+    config = ConfigParser.ConfigParser()
+    config.read(configPath)
+    FILES_DIR = configValue(config, 'FILES_DIR')
+    FLICKR = configValue(config, 'FLICKR')
+    SLEEP_TIME = configValue(config, 'SLEEP_TIME')
+    DRIP_TIME = configValue(config, 'DRIP_TIME')
+    DB_PATH = configValue(config, 'DB_PATH')
+    LOCK_PATH = configValue(config, 'LOCK_PATH')
+    LOCK_STALE_TIME = configValue(config, 'LOCK_STALE_TIME', 60 * 60)
+    LEASE_TIME = configValue(config, 'LEASE_TIME', 30 * 60)
+    TOKEN_PATH = configValue(config, 'TOKEN_PATH')
+    TOKEN_TTL = configValue(config, 'TOKEN_TTL', 7 * 24 * 60 * 60)
+    EXCLUDED_FOLDERS = configValue(config, 'EXCLUDED_FOLDERS')
+    IGNORED_REGEX = [re.compile(regex) for regex in configValue(config, 'IGNORED_REGEX')]
+    ALLOWED_EXT = configValue(config, 'ALLOWED_EXT')
+    RAW_EXT = configValue(config, 'RAW_EXT')
+    FILE_MAX_SIZE = configValue(config, 'FILE_MAX_SIZE')
+    MANAGE_CHANGES = configValue(config, 'MANAGE_CHANGES')
+    RAW_TOOL_PATH = configValue(config, 'RAW_TOOL_PATH')
+    CONVERT_RAW_FILES = configValue(config, 'CONVERT_RAW_FILES')
+    RAW_CONVERT_PROCESSES = configValue(config, 'RAW_CONVERT_PROCESSES', 4)
+    FULL_SET_NAME = configValue(config, 'FULL_SET_NAME')
+    WALK_THREADS = configValue(config, 'WALK_THREADS', 8)
+    UPLOAD_THREADS = configValue(config, 'UPLOAD_THREADS', 8)
+    UPLOAD_SHARES = configValue(config, 'UPLOAD_SHARES', {"fresh": 4, "replace": 2, "backfill": 1})
+    UPLOAD_DEADLINES = configValue(config, 'UPLOAD_DEADLINES', {"fresh": 15 * 60, "replace": 60 * 60, "backfill": 24 * 60 * 60})
+    FRESH_AGE = configValue(config, 'FRESH_AGE', 24 * 60 * 60)
+    SKIP_UNCHANGED_FOR = configValue(config, 'SKIP_UNCHANGED_FOR', 24 * 60 * 60)
 
 ##
 ##  You shouldn't need to modify anything below here
@@ -138,17 +198,168 @@ class APIConstants:
 
 api = APIConstants()
 
+class Metrics:
+    """ Metrics class
+
+    Live counters, gauges and latency histograms of the uploader, rendered in
+    the Prometheus text exposition format for the metrics endpoint or a
+    node_exporter textfile.
+    """
+
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    help = {
+        "uploadr_files_scanned_total"          : "Files found by the directory scans.",
+        "uploadr_files_hashed_total"           : "Files whose md5 checksum was computed.",
+        "uploadr_files_uploaded_total"         : "Files uploaded to Flickr.",
+        "uploadr_files_replaced_total"         : "Changed files replaced on Flickr.",
+        "uploadr_files_deleted_total"          : "Photos deleted from Flickr.",
+        "uploadr_bytes_sent_total"             : "Bytes of media sent to Flickr.",
+        "uploadr_files_deduplicated_total"     : "New paths matched by md5 to a photo already on Flickr.",
+        "uploadr_bytes_saved_total"            : "Bytes not sent to Flickr thanks to md5 deduplication.",
+        "uploadr_queue_depth"                  : "Files of the current pass still to be processed.",
+        "uploadr_upload_queue_depth"           : "Files waiting for an upload worker, by priority class.",
+        "uploadr_api_concurrency_limit"        : "Flickr requests allowed in flight by kind, adapted to the latency and errors.",
+        "uploadr_upload_deadline_missed_total" : "Uploads completed after their deadline.",
+        "uploadr_last_check_timestamp_seconds" : "Unix time the last pass completed.",
+        "uploadr_api_request_duration_seconds" : "Latency of Flickr API requests by method.",
+        "uploadr_scan_duration_seconds"        : "Duration of the directory scans.",
+    }
+
+    def __init__( self ):
+        """ Constructor
+        """
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc( self, name, amount=1 ):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set( self, name, value, label=None ):
+        """ Sets a gauge, optionally labelled ("class", "fresh")
+        """
+        with self.lock:
+            self.gauges.setdefault(name, {})[label] = value
+
+    def observe( self, name, value, label=None ):
+        """ Records one sample of a histogram, optionally labelled ("method", "flickr.photos.delete")
+        """
+        with self.lock:
+            histogram = self.histograms.setdefault(name, {})
+            counts, total, count = histogram.get(label, ([0] * len(self.buckets), 0.0, 0))
+            counts = [c + (1 if value <= bound else 0) for c, bound in zip(counts, self.buckets)]
+            histogram[label] = (counts, total + value, count + 1)
+
+    def render( self ):
+        """ All metrics in the Prometheus text format
+        """
+        lines = []
+        with self.lock:
+            for name in sorted(self.counters):
+                lines.append("# HELP %s %s" % (name, self.help.get(name, name)))
+                lines.append("# TYPE %s counter" % name)
+                lines.append("%s %s" % (name, repr(self.counters[name])))
+            for name in sorted(self.gauges):
+                lines.append("# HELP %s %s" % (name, self.help.get(name, name)))
+                lines.append("# TYPE %s gauge" % name)
+                for label in sorted(self.gauges[name]):
+                    braces = '{%s="%s"}' % label if label else ""
+                    lines.append("%s%s %s" % (name, braces, repr(self.gauges[name][label])))
+            for name in sorted(self.histograms):
+                lines.append("# HELP %s %s" % (name, self.help.get(name, name)))
+                lines.append("# TYPE %s histogram" % name)
+                for label in sorted(self.histograms[name]):
+                    counts, total, count = self.histograms[name][label]
+                    labels = '%s="%s",' % label if label else ""
+                    for c, bound in zip(counts, self.buckets):
+                        lines.append('%s_bucket{%sle="%s"} %d' % (name, labels, repr(float(bound)), c))
+                    lines.append('%s_bucket{%sle="+Inf"} %d' % (name, labels, count))
+                    braces = "{" + labels[:-1] + "}" if labels else ""
+                    lines.append("%s_sum%s %s" % (name, braces, repr(total)))
+                    lines.append("%s_count%s %d" % (name, braces, count))
+        return "\n".join(lines) + "\n"
+
+    def writeTextfile( self, path ):
+        """ Writes the metrics for node_exporter's textfile collector, atomically
+        """
+        tmpPath = path + ".tmp"
+        with open(tmpPath, "w") as f:
+            f.write(self.render())
+        os.rename(tmpPath, path)
+
+    def serve( self, port, address="127.0.0.1" ):
+        """ Serves the metrics on http://address:port/metrics from a background thread,
+        on the loopback interface unless another address is given
+        """
+        import BaseHTTPServer
+        metrics = self
+
+        class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET( self ):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message( self, format, *args ):
+                pass
+
+        server = BaseHTTPServer.HTTPServer((address, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        print("Serving metrics on " + (address or "all interfaces") + " port " + str(port))
+        return server
+
+metrics = Metrics()
+
 class Uploadr:
     """ Uploadr class
     """
 
     token = None
     perms = ""
+    # When Flickr last confirmed the token, 0 if never
+    tokenValidatedAt = 0
+    # Flickr error codes of a revoked token or of missing permissions
+    tokenErrors = ("98", "99")
+    # Files and bytes of the current upload pass found on Flickr by md5
+    dedupedFiles = 0
+    dedupedBytes = 0
+    # Files the current upload pass failed to upload, and photos removeDeletedMedia
+    # failed to delete, left for the next run
+    uploadFailures = 0
+    deleteFailures = 0
+    # Files of the current upload pass left to another uploadr leasing them
+    leasedFiles = 0
+    # True when this process shares the uploads of the lock's holder: it then
+    # takes a lease on every file it uploads
+    shared = False
 
     def __init__( self ):
         """ Constructor
         """
-        self.token = self.getCachedToken()
+        loadConfig()
+        self.token, self.perms, self.tokenValidatedAt = self.getCachedToken()
+        self.tokenRejected = False
+        self.lock = threading.Lock()
+        # Adapts how many of the upload threads talk to Flickr at once. Uploads
+        # take as long as their file is big, so they get their own controller
+        # rather than passing for latency spikes of the API calls.
+        self.apiLimit = concurrency.ConcurrencyController("flickr", initial=min(4, UPLOAD_THREADS),
+                                                          maximum=max(1, UPLOAD_THREADS))
+        self.uploadLimit = concurrency.ConcurrencyController("flickr uploads", initial=min(4, UPLOAD_THREADS),
+                                                             maximum=max(1, UPLOAD_THREADS))
+        # Names this process in the leases it takes on files
+        self.owner = socket.gethostname() + ":" + str(os.getpid())
 
 
 
@@ -172,6 +383,7 @@ class Uploadr:
         """
         data['api_key'] = FLICKR[ "api_key" ]
         data['api_sig'] = sig
+        import urllib
         encoded_url = base + "?" + urllib.urlencode( data )
         return encoded_url
 
@@ -228,6 +440,7 @@ class Uploadr:
         url = self.urlGen( api.auth, d, sig )
         ans = ""
         try:
+            import webbrowser
             webbrowser.open( url )
             print("Copy-paste following URL into a web browser and follow instructions:")
             print(url)
@@ -283,21 +496,64 @@ class Uploadr:
 
     def getCachedToken( self ):
         """
-        Attempts to get the flickr token from disk.
-       """
-        if ( os.path.exists( TOKEN_PATH )):
-            return open( TOKEN_PATH ).read()
-        else :
-            return None
-
-
+        Attempts to get the flickr token from disk, with its perms and when Flickr last
+        confirmed it. A cache holding only the token, as older versions wrote it, was
+        never confirmed.
+        """
+        if ( not os.path.exists( TOKEN_PATH )):
+            return None, "", 0
+        cached = open( TOKEN_PATH ).read().strip()
+        try:
+            cached = json.loads(cached)
+        except ValueError:
+            return cached, "", 0
+        if not isinstance(cached, dict):
+            return str(cached), "", 0
+        token = cached.get("token")
+        return str(token) if token else None, str(cached.get("perms", "")), cached.get("validated_at", 0)
 
     def cacheToken( self ):
         """ cacheToken
+
+        Saves the token with its perms, as confirmed by Flickr now.
         """
 
+        self.tokenValidatedAt = time.time()
         try:
-            open( TOKEN_PATH , "w").write( str(self.token) )
+            open( TOKEN_PATH , "w").write( json.dumps({
+                "token"        : str(self.token),
+                "perms"        : str(self.perms),
+                "validated_at" : self.tokenValidatedAt }) )
+        except:
+            print("Issue writing token to local cache ", str(sys.exc_info()))
+
+    def hasValidToken( self ):
+        """ True when there is a token Flickr confirmed within TOKEN_TTL seconds, without
+        asking Flickr again, so a run with nothing to do makes no request. Otherwise
+        confirms it with checkToken. A token Flickr rejects later on is checked again
+        then, see reportError.
+        """
+        if ( self.token and self.perms and time.time() - self.tokenValidatedAt < TOKEN_TTL ):
+            return True
+        return self.checkToken()
+
+    def rejectToken( self ):
+        """ Called when Flickr refused a request for the token: checks it once, and if
+        it was revoked, marks the cache unconfirmed so the next run authenticates again.
+        """
+        with self.lock:
+            if self.tokenRejected:
+                return
+            self.tokenRejected = True
+        if ( self.checkToken() ):
+            return
+        print("The cached Flickr token was rejected, run uploadr.py to authenticate again")
+        self.tokenValidatedAt = 0
+        try:
+            open( TOKEN_PATH , "w").write( json.dumps({
+                "token"        : str(self.token),
+                "perms"        : "",
+                "validated_at" : 0 }) )
         except:
             print("Issue writing token to local cache ", str(sys.exc_info()))
 
@@ -320,6 +576,8 @@ class Uploadr:
         if ( self.token == None ):
             return False
         else :
+            # Its answer settles the token for this run, see rejectToken
+            self.tokenRejected = True
             d = {
                 "auth_token"      :  str(self.token) ,
                 "method"          :  "flickr.auth.checkToken",
@@ -332,8 +590,9 @@ class Uploadr:
             try:
                 res = self.getResponse( url )
                 if ( self.isGood( res ) ):
-                    self.token = res['auth']['token']['_content']
-                    self.perms = res['auth']['perms']['_content']
+                    self.token = str(res['auth']['token']['_content'])
+                    self.perms = str(res['auth']['perms']['_content'])
+                    self.cacheToken()
                     return True
                 else :
                     self.reportError( res )
@@ -352,128 +611,299 @@ class Uploadr:
 
         print("*****Removing deleted files*****")
 
-        if ( not self.checkToken() ):
+        if ( not self.hasValidToken() ):
             self.authenticate()
         con = lite.connect(DB_PATH)
         con.text_factory = str
 
         with con:
             cur = con.cursor()
+            # Copies that are gone leave their set
+            cur.execute("SELECT d.path, d.files_id, d.set_id, f.set_id FROM duplicates d LEFT JOIN files f ON f.files_id = d.files_id")
+            for path, photoId, setId, fileSetId in cur.fetchall():
+                if( not os.path.isfile(path)):
+                    if setId is not None and setId != fileSetId:
+                        self.removeFileFromSet(setId, (photoId, path), cur, recordFile=False)
+                    cur.execute("DELETE FROM duplicates WHERE path = ?", (path,))
+
             cur.execute("SELECT files_id, path FROM files")
             rows = cur.fetchall()
 
+            self.deleteFailures = 0
             for row in rows:
                 if( not os.path.isfile(row[1])):
+                    if self.promoteDuplicate(row, cur):
+                        continue
                     success = self.deleteFile(row, cur)
+                    if not success:
+                        self.deleteFailures += 1
         print("*****Completed deleted files*****")
 
+    def promoteDuplicate( self, file, cur ):
+        """ When the file of a photo is gone but a copy of it is left, the photo is
+        kept, as the copy's: its row takes the copy's path and set. Returns True if
+        a copy was left.
+        """
+        cur.execute("SELECT path, last_modified, set_id FROM duplicates WHERE files_id = ?", (file[0],))
+        copy = cur.fetchone()
+        if copy is None:
+            return False
+        path, last_modified, setId = copy
+        print("Keeping photo " + str(file[0]) + " of deleted file " + str(file[1]) + " for its copy " + path)
+        cur.execute("SELECT set_id FROM files WHERE files_id = ?", (file[0],))
+        fileSetId = cur.fetchone()[0]
+        if fileSetId is not None and fileSetId != setId:
+            self.removeFileFromSet(fileSetId, file, cur)
+        cur.execute("UPDATE files SET path = ?, last_modified = ?, set_id = ? WHERE files_id = ?", (path, last_modified, setId, file[0]))
+        cur.execute("DELETE FROM duplicates WHERE path = ?", (path,))
+        return True
+
     def upload( self ):
         """ upload
+
+        Uploads the files of FILES_DIR on UPLOAD_THREADS threads, through an
+        UploadScheduler: files new to the DB and modified within FRESH_AGE,
+        such as tonight's wallpapers, go first, then changed files to replace,
+        then older new files (backfill). Each class is worked on earliest
+        deadline first, the deadline being its UPLOAD_DEADLINES entry after
+        a fresh file's mtime, or after the start of the pass.
         """
 
         print("*****Uploading files*****")
 
-        allMedia = self.grabNewFiles()
-        # If managing changes, consider all files
-        if MANAGE_CHANGES:
-            changedMedia = allMedia
-        # If not, then get just the new and missing files
-        else:
-            con = lite.connect(DB_PATH)
-            with con:
-                cur = con.cursor()
-                cur.execute("SELECT path FROM files")
-                existingMedia = set(file[0] for file in cur.fetchall())
-                changedMedia = set(allMedia) - existingMedia
-
-        changedMedia_count = len(changedMedia)
-        print("Found " + str(changedMedia_count) + " files")
+        # last_modified of the files already uploaded, to classify the new
+        # ones. Files unchanged since are left alone, and without
+        # MANAGE_CHANGES so are all of the known files.
+        con = lite.connect(DB_PATH)
+        con.text_factory = str
+        with con:
+            cur = con.cursor()
+            cur.execute("SELECT path, last_modified FROM files UNION ALL SELECT path, last_modified FROM duplicates")
+            knownMedia = dict(cur.fetchall())
+
+        self.dedupedFiles = 0
+        self.dedupedBytes = 0
+        self.uploadFailures = 0
+        self.leasedFiles = 0
+        scheduler = UploadScheduler(UPLOAD_SHARES)
+        # Drip feeding uploads one file at a time
+        threads = 1 if args.drip_feed else max(1, UPLOAD_THREADS)
+        processed = [0]
+
+        def work():
+            success = False
+            while True:
+                job = scheduler.get()
+                if job is None:
+                    return
+                uploadClass, deadline, file = job
+                if args.drip_feed and success:
+                    print("Waiting " + str(DRIP_TIME) + " seconds before next upload")
+                    time.sleep( DRIP_TIME )
+                try:
+                    success = False
+                    if self.claimLease( file ):
+                        try:
+                            success = self.uploadFile( file, args.title, args.description, args.tags )
+                        finally:
+                            self.releaseLease( file )
+                    else:
+                        with self.lock:
+                            self.leasedFiles += 1
+                except:
+                    success = False
+                    self.countUploadFailure()
+                    print(str(sys.exc_info()))
+                scheduler.done(uploadClass)
+                if time.time() > deadline:
+                    metrics.inc("uploadr_upload_deadline_missed_total")
+                with self.lock:
+                    processed[0] += 1
+                    if (processed[0]%100 == 0):
+                        print("   " + str(processed[0]) + " files processed (uploaded, md5ed or timestamp checked)")
+
+        workers = []
+        for i in range(threads):
+            worker = threading.Thread(target=work)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        # Files are queued as the walker finds them
         coun = 0;
-
-        for i, file in enumerate( changedMedia ):
-            success = self.uploadFile( file )
-            if args.drip_feed and success and i != changedMedia_count-1:
-                print("Waiting " + str(DRIP_TIME) + " seconds before next upload")
-                time.sleep( DRIP_TIME )
-            coun = coun + 1;
-            if (coun%100 == 0):
-                print("   " + str(coun) + " files processed (uploaded, md5ed or timestamp checked)")
-        if (coun%100 > 0):
-            print("   " + str(coun) + " files processed (uploaded, md5ed or timestamp checked)")
+        now = time.time()
+        try:
+            for file in self.walkFiles():
+                coun = coun + 1;
+                try:
+                    last_modified = os.stat(file).st_mtime
+                except OSError:
+                    continue
+                if file not in knownMedia:
+                    uploadClass = "fresh" if now - last_modified < FRESH_AGE else "backfill"
+                elif MANAGE_CHANGES and knownMedia[file] != last_modified:
+                    uploadClass = "replace"
+                else:
+                    continue
+                # Fresh files are due some time after they were made, the
+                # others after the pass found them
+                since = last_modified if uploadClass == "fresh" else now
+                scheduler.put(file, uploadClass, since + UPLOAD_DEADLINES[uploadClass])
+                self.reportQueueDepth(scheduler)
+        finally:
+            scheduler.close()
+        for worker in workers:
+            # A timeout keeps the wait interruptible by Ctrl-C
+            while worker.is_alive():
+                worker.join(60)
+        if (processed[0]%100 > 0):
+            print("   " + str(processed[0]) + " files processed (uploaded, md5ed or timestamp checked)")
+        self.reportQueueDepth(scheduler)
+        metrics.set("uploadr_queue_depth", 0)
+        print("Found " + str(coun) + " files")
+        if (self.dedupedFiles > 0):
+            print("Skipped " + str(self.dedupedFiles) + " files already on Flickr, saving " + str(self.dedupedBytes) + " bytes of upload")
+        if (self.leasedFiles > 0):
+            print("Left " + str(self.leasedFiles) + " files to the other uploadrs working on them")
         print("*****Completed uploading files*****")
 
+    def claimLease( self, file ):
+        """ claimLease
+
+        Takes the lease on a file for LEASE_TIME seconds, so that no other
+        uploadr process works on it meanwhile. False if another process
+        holds a lease on it that has not expired.
+        The lock's holder, not shared, takes no lease: it only leaves alone
+        the files that processes sharing its uploads have leased.
+        """
+        now = time.time()
+        con = lite.connect(DB_PATH)
+        con.text_factory = str
+        with con:
+            cur = con.cursor()
+            if self.shared:
+                cur.execute("DELETE FROM leases WHERE path = ? AND (expires < ? OR owner = ?)", (file, now, self.owner))
+                cur.execute("INSERT OR IGNORE INTO leases (path, owner, expires) VALUES (?, ?, ?)", (file, self.owner, now + LEASE_TIME))
+                claimed = cur.rowcount == 1
+            else:
+                cur.execute("SELECT 1 FROM leases WHERE path = ? AND expires >= ? AND owner != ?", (file, now, self.owner))
+                claimed = cur.fetchone() is None
+        con.close()
+        if not claimed:
+            print("Skipping " + file + ", another uploadr is working on it")
+        return claimed
+
+    def releaseLease( self, file ):
+        """ Gives up the lease taken by claimLease
+        """
+        if not self.shared:
+            return
+        con = lite.connect(DB_PATH)
+        with con:
+            con.execute("DELETE FROM leases WHERE path = ? AND owner = ?", (file, self.owner))
+        con.close()
+
+    def isUploaded( self, file ):
+        """ True if the DB has a photo at this path, its own or one it is a copy of
+        """
+        con = lite.connect(DB_PATH)
+        con.text_factory = str
+        with con:
+            row = con.execute("SELECT files_id FROM files WHERE path = ? UNION ALL "
+                              "SELECT files_id FROM duplicates WHERE path = ?", (file, file)).fetchone()
+        con.close()
+        return row is not None
+
+    def reportQueueDepth( self, scheduler ):
+        """ Publishes the files waiting in each priority class
+        """
+        for uploadClass, depth in scheduler.depths().items():
+            metrics.set("uploadr_upload_queue_depth", depth, ("class", uploadClass))
+
     def convertRawFiles( self ):
         """ convertRawFiles
+
+        Walks FILES_DIR once, skipping what the upload walk skips, buckets the
+        RAW files by extension and converts the ones not yet recorded as done
+        in the raw_files table on a pool of exiftool workers.
         """
         if (not CONVERT_RAW_FILES):
             return
 
         print "*****Converting files*****"
+        buckets = {}
         for ext in RAW_EXT:
-            print ("About to convert files with extension:" + ext + " files.")
-
-            for dirpath, dirnames, filenames in os.walk( FILES_DIR, followlinks=True):
-                if '.picasaoriginals' in dirnames:
-                    dirnames.remove('.picasaoriginals')
-                if  '@eaDir' in dirnames:
-                    dirnames.remove('@eaDir')
-                for f in filenames :
-
-                    fileExt = f.split(".")[-1]
-                    filename = f.split(".")[0]
-                    if ( fileExt.lower() == ext):
-
-                        if (not os.path.exists(dirpath + "/" + filename + ".JPG")):
-                            print("About to create JPG from raw "+ dirpath + "/" + f )
-
-                            flag = ""
-                            if ext is "cr2":
-                                flag = "PreviewImage"
-                            else :
-                                flag = "JpgFromRaw"
+            buckets[ext] = []
+        excluded = list(EXCLUDED_FOLDERS or []) + ['.picasaoriginals', '@eaDir']
+        walker = TreeWalker(FILES_DIR, excluded, IGNORED_REGEX, RAW_EXT, None, WALK_THREADS)
+        for path in walker.walk():
+            buckets[path.split(".")[-1].lower()].append(path)
 
-                            command = RAW_TOOL_PATH +"exiftool -b -" + flag + " -w .JPG -ext " + ext + " -r '" + dirpath + "/" + filename + "." + fileExt + "'"
-                            #print(command)
-
-                            p = subprocess.call(command, shell=True)
-
-                        if (not os.path.exists(dirpath + "/" + filename + ".JPG_original")):
-                            print ("About to copy tags from "+ dirpath + "/" + f + " to JPG.")
-
-                            command = RAW_TOOL_PATH + "exiftool -tagsfromfile '" + dirpath + "/" + f + "' -r -all:all -ext JPG '" + dirpath + "/" + filename + ".JPG'"
-                            #print(command)
-
-                            p = subprocess.call(command, shell=True)
+        con = lite.connect(DB_PATH)
+        con.text_factory = str
+        with con:
+            cur = con.cursor()
+            cur.execute("SELECT path, jpg_converted, tags_copied FROM raw_files")
+            state = dict((row[0], (row[1], row[2])) for row in cur.fetchall())
 
-                            print ("Finished copying tags.")
+            jobs = []
+            for ext in RAW_EXT:
+                if not buckets[ext]:
+                    continue
+                pending = [path for path in buckets[ext] if state.get(path) != (1, 1)]
+                print ("About to convert " + str(len(pending)) + " files with extension:" + ext + " (" + str(len(buckets[ext]) - len(pending)) + " already converted).")
+                for path in pending:
+                    converted, tagged = state.get(path, (None, None))
+                    jobs.append((path, ext, converted, tagged))
+
+            if jobs:
+                import multiprocessing
+                pool = multiprocessing.Pool(min(RAW_CONVERT_PROCESSES, len(jobs)), initializer=startRawWorker)
+                try:
+                    for path, converted, tagged in pool.imap_unordered(convertRawFile, jobs):
+                        if converted is None:
+                            # Left for a worker that has an exiftool
+                            continue
+                        cur.execute("INSERT OR REPLACE INTO raw_files (path, jpg_converted, tags_copied) VALUES (?, ?, ?)", (path, int(converted), int(tagged)))
+                        con.commit()
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
 
+        print "*****Completed converting files*****"
 
-            print ("Finished converting files with extension:" + ext + ".")
+    def walkFiles( self ):
+        """ walkFiles
 
-        print "*****Completed converting files*****"
+        Yields the files of FILES_DIR that may be uploaded, in the order the
+        TreeWalker finds them.
+        """
+        walker = TreeWalker(FILES_DIR, EXCLUDED_FOLDERS, IGNORED_REGEX, ALLOWED_EXT,
+                            FILE_MAX_SIZE, WALK_THREADS)
+        count = 0
+        for file in walker.walk():
+            count += 1
+            metrics.set("uploadr_queue_depth", walker.backlog())
+            yield file
+        metrics.set("uploadr_queue_depth", 0)
+        metrics.inc("uploadr_files_scanned_total", count)
+        metrics.observe("uploadr_scan_duration_seconds", walker.elapsed)
 
     def grabNewFiles( self ):
         """ grabNewFiles
+
+        All the files of FILES_DIR that may be uploaded, sorted.
         """
+        return sorted(self.walkFiles())
 
-        files = []
-        for dirpath, dirnames, filenames in os.walk( FILES_DIR, followlinks=True):
-            for curr_dir in EXCLUDED_FOLDERS:
-                if curr_dir in dirnames:
-                    dirnames.remove(curr_dir)
-            for f in filenames :
-                if any(ignored.search(f) for ignored in IGNORED_REGEX):
-                    continue
-                ext = f.lower().split(".")[-1]
-                if ext in ALLOWED_EXT:
-                    fileSize = os.path.getsize( dirpath + "/" + f )
-                    if (fileSize < FILE_MAX_SIZE):
-                        files.append( os.path.normpath( dirpath + "/" + f ).replace("'", "\'") )
-        files.sort()
-        return files
-
-    def uploadFile( self, file ):
+    def uploadFile( self, file, title=None, description=None, tags=None ):
         """ uploadFile
+
+        title and description replace the ones of FLICKR, tags are added to
+        its tags.
         """
 
         success = False
@@ -486,25 +916,27 @@ class Uploadr:
 
             last_modified = os.stat(file).st_mtime;
             if(row is None):
+                fileMd5 = self.md5Checksum(file)
+                if self.relinkDuplicate(file, fileMd5, last_modified, cur, con):
+                    return success
                 print("Uploading " + file + "...")
-                if FULL_SET_NAME:
-                    setName = os.path.relpath(os.path.dirname(file), FILES_DIR)
-                else:
-                    head, setName = os.path.split(os.path.dirname(file))
+                setName = self.setNameOf(file)
                 try:
                     photo = ('photo', file, open(file,'rb').read())
-                    if args.title: # Replace
-                        FLICKR["title"] = args.title
-                    if args.description: # Replace
-                        FLICKR["description"] = args.description
-                    if args.tags: # Append
-                        FLICKR["tags"] += " " + args.tags
+                    # A copy for this upload: the upload threads share FLICKR
+                    flickr = dict(FLICKR)
+                    if title: # Replace
+                        flickr["title"] = title
+                    if description: # Replace
+                        flickr["description"] = description
+                    if tags: # Append
+                        flickr["tags"] += " " + tags
                     d = {
                         "auth_token"    : str(self.token),
                         "perms"         : str(self.perms),
-                        "title"         : str( FLICKR["title"] ),
-                        "description"   : str( FLICKR["description"] ),
-                        "tags"          : str( FLICKR["tags"] + " " + setName ),
+                        "title"         : str( flickr["title"] ),
+                        "description"   : str( flickr["description"] ),
+                        "tags"          : str( flickr["tags"] + " " + setName ),
                         "is_public"     : str( FLICKR["is_public"] ),
                         "is_friend"     : str( FLICKR["is_friend"] ),
                         "is_family"     : str( FLICKR["is_family"] )
@@ -513,19 +945,23 @@ class Uploadr:
                     d[ "api_sig" ] = sig
                     d[ "api_key" ] = FLICKR[ "api_key" ]
                     url = self.build_request(api.upload, d, (photo,))
-                    res = parse(urllib2.urlopen( url ))
+                    from xml.dom.minidom import parse
+                    res = parse(self.timedUrlopen( url, "upload" ))
                     if ( not res == "" and res.documentElement.attributes['stat'].value == "ok" ):
                         print("Successfully uploaded the file: " + file)
+                        metrics.inc("uploadr_files_uploaded_total")
+                        metrics.inc("uploadr_bytes_sent_total", len(photo[2]))
                         # Add to set
-                        cur.execute('INSERT INTO files (files_id, path, md5, last_modified, tagged) VALUES (?, ?, ?, ?, 1)',(int(str(res.getElementsByTagName('photoid')[0].firstChild.nodeValue)), file, self.md5Checksum(file),last_modified))
+                        cur.execute('INSERT INTO files (files_id, path, md5, last_modified, tagged) VALUES (?, ?, ?, ?, 1)',(int(str(res.getElementsByTagName('photoid')[0].firstChild.nodeValue)), file, fileMd5, last_modified))
+                        # A copy edited since is a photo of its own now
+                        cur.execute('DELETE FROM duplicates WHERE path = ?', (file,))
                         success = True
                     else :
                         print("A problem occurred while attempting to upload the file: " + file)
-                        try:
-                            print("Error: " + str( res.toxml() ))
-                        except:
-                            print("Error: " + str( res.toxml() ))
+                        self.countUploadFailure()
+                        self.reportUploadError( res )
                 except:
+                    self.countUploadFailure()
                     print(str(sys.exc_info()))
             elif (MANAGE_CHANGES):
                 if (row[6] == None) :
@@ -534,9 +970,72 @@ class Uploadr:
                 if (row[6] != last_modified) :
                     fileMd5 = self.md5Checksum(file)
                     if (fileMd5 != str(row[4])) :
-                        self.replacePhoto(file, row[1], fileMd5, last_modified, cur, con);
+                        if not self.replacePhoto(file, row[1], fileMd5, last_modified, cur, con):
+                            self.countUploadFailure()
             return success
 
+    def countUploadFailure( self ):
+        """ Counts a file of the upload pass that is left to upload or replace
+        """
+        with self.lock:
+            self.uploadFailures += 1
+
+    def setNameOf( self, file ):
+        """ Name of the set a file goes into, from its directory
+        """
+        if FULL_SET_NAME:
+            return os.path.relpath(os.path.dirname(file), FILES_DIR)
+        head, setName = os.path.split(os.path.dirname(file))
+        return setName
+
+    def relinkDuplicate( self, file, fileMd5, last_modified, cur, con ):
+        """ relinkDuplicate
+
+        Looks a new path up by its md5 among the files already uploaded.
+        When the photo's recorded path is gone, the file was moved or renamed:
+        its row is pointed at the new path, and when that changes the set the
+        photo is taken out of the old set and left for createSets and
+        addTagsToUploadedPhotos to file under the new one. When the recorded
+        path is still there the new path is a copy and is not uploaded: it is
+        recorded in the duplicates table, so later passes skip it, and left
+        for createSets to add the photo to the copy's set. Returns True if the
+        file needs no upload.
+        """
+        cur.execute("SELECT files_id, path, set_id FROM files WHERE md5 = ?", (fileMd5,))
+        rows = cur.fetchall()
+        if not rows:
+            return False
+        moved = [row for row in rows if not os.path.isfile(row[1])]
+        size = os.path.getsize(file)
+        if moved:
+            photoId, oldPath, setId = moved[0]
+            print("Relinking " + oldPath + " to " + file + " (same content, not uploaded again)")
+            if self.setNameOf(oldPath) == self.setNameOf(file):
+                cur.execute("UPDATE files SET path = ?, last_modified = ? WHERE files_id = ?", (file, last_modified, photoId))
+            else:
+                if setId is not None:
+                    self.removeFileFromSet(setId, (photoId, oldPath), cur)
+                cur.execute("UPDATE files SET path = ?, last_modified = ?, set_id = NULL, tagged = NULL WHERE files_id = ?", (file, last_modified, photoId))
+            con.commit()
+        else:
+            photoId, path, setId = rows[0]
+            cur.execute("SELECT files_id FROM duplicates WHERE path = ?", (file,))
+            known = cur.fetchone()
+            if self.setNameOf(path) != self.setNameOf(file):
+                setId = None
+            cur.execute("INSERT OR REPLACE INTO duplicates (path, files_id, last_modified, set_id) VALUES (?, ?, ?, ?)", (file, photoId, last_modified, setId))
+            con.commit()
+            if known is not None:
+                # A copy touched since, its saving was counted when it was found
+                return True
+            print("Not uploading " + file + ", it is a copy of " + path)
+        with self.lock:
+            self.dedupedFiles += 1
+            self.dedupedBytes += size
+        metrics.inc("uploadr_files_deduplicated_total")
+        metrics.inc("uploadr_bytes_saved_total", size)
+        return True
+
     def replacePhoto ( self, file, file_id, fileMd5, last_modified, cur, con ) :
         success = False
         print("Replacing the file: " + file + "...")
@@ -551,19 +1050,19 @@ class Uploadr:
             d[ "api_sig" ] = sig
             d[ "api_key" ] = FLICKR[ "api_key" ]
             url = self.build_request(api.replace, d, (photo,))
-            res = parse(urllib2.urlopen( url ))
+            from xml.dom.minidom import parse
+            res = parse(self.timedUrlopen( url, "replace" ))
             if ( not res == "" and res.documentElement.attributes['stat'].value == "ok" ):
                 print("Successfully replaced the file: " + file)
+                metrics.inc("uploadr_files_replaced_total")
+                metrics.inc("uploadr_bytes_sent_total", len(photo[2]))
                 # Add to set
                 cur.execute('UPDATE files SET md5 = ?,last_modified = ? WHERE files_id = ?',(fileMd5, last_modified, file_id))
                 con.commit()
                 success = True
             else :
                 print("A problem occurred while attempting to replace the file: " + file)
-                try:
-                    print("Error: " + str( res.toxml() ))
-                except:
-                    print("Error: " + str( res.toxml() ))
+                self.reportUploadError( res )
         except:
             print(str(sys.exc_info()))
 
@@ -600,6 +1099,7 @@ class Uploadr:
                 # Delete file record from the local db
                 cur.execute("DELETE FROM files WHERE files_id = ?", (file[0],))
                 print("Successful deletion.")
+                metrics.inc("uploadr_files_deleted_total")
                 success = True
             else :
                 if( res['code'] == 1 ):
@@ -612,12 +1112,18 @@ class Uploadr:
             print(str(sys.exc_info()))
         return success
 
-    def logSetCreation( self, setId, setName, primaryPhotoId, cur, con):
+    def logSetCreation( self, setId, setName, primaryPhotoId, cur, con, duplicate=None):
+        """ Records a new set, and that its primary photo is in it: the photo's
+        own file, or the copy of it at the path duplicate
+        """
         print("adding set to log: " + str(setName))
 
         success = False
         cur.execute("INSERT INTO sets (set_id, name, primary_photo_id) VALUES (?,?,?)", (setId,setName,primaryPhotoId))
-        cur.execute("UPDATE files SET set_id = ? WHERE files_id = ?", (setId, primaryPhotoId))
+        if duplicate is None:
+            cur.execute("UPDATE files SET set_id = ? WHERE files_id = ?", (setId, primaryPhotoId))
+        else:
+            cur.execute("UPDATE duplicates SET set_id = ? WHERE path = ?", (setId, duplicate))
         con.commit()
         return True
 
@@ -631,6 +1137,7 @@ class Uploadr:
         files is a sequence of (name, filename, value) elements for data to be uploaded as files.
         """
 
+        import urllib2
         content_type, body = self.encode_multipart_formdata(fields, files)
         if not txheaders: txheaders = {}
         txheaders['Content-type'] = content_type
@@ -638,13 +1145,17 @@ class Uploadr:
 
         return urllib2.Request(theurl, body, txheaders)
 
-    def encode_multipart_formdata(self,fields, files, BOUNDARY = '-----'+mimetools.choose_boundary()+'-----'):
+    def encode_multipart_formdata(self,fields, files, BOUNDARY = None):
         """ Encodes fields and files for uploading.
         fields is a sequence of (name, value) elements for regular form fields - or a dictionary.
         files is a sequence of (name, filename, value) elements for data to be uploaded as files.
         Return (content_type, body) ready for urllib2.Request instance
         You can optionally pass in a boundary string to use or we'll let mimetools provide one.
         """
+        import mimetypes
+        if BOUNDARY is None:
+            import mimetools
+            BOUNDARY = '-----'+mimetools.choose_boundary()+'-----'
 
         CRLF = '\r\n'
         L = []
@@ -682,29 +1193,66 @@ class Uploadr:
         """
 
         try:
-            print("Error: " + str( res['code'] + " " + res['message'] ))
+            print("Error: " + str( res['code'] ) + " " + res['message'])
         except:
             print("Error: " + str( res ))
+        if ( isinstance(res, dict) and str(res.get('code')) in self.tokenErrors ):
+            self.rejectToken()
+
+    def reportUploadError( self, res ):
+        """ reportError for the XML responses of the upload and replace endpoints
+        """
+
+        print("Error: " + str( res.toxml() ))
+        err = res.getElementsByTagName('err')
+        if ( err and err[0].getAttribute('code') in self.tokenErrors ):
+            self.rejectToken()
 
     def getResponse( self, url ):
         """
         Send the url and get a response.  Let errors float up
         """
+        import urllib2, urlparse
 
         try:
-            res = urllib2.urlopen( url ).read()
+            method = urlparse.parse_qs(urlparse.urlparse(url).query).get("method", ["unknown"])[0]
+            res = self.timedUrlopen( url, method ).read()
         except urllib2.HTTPError, e:
             print(e.code)
         except urllib2.URLError, e:
             print(e.args)
         return json.loads(res)
 
+    def timedUrlopen( self, url, method ):
+        """ urllib2.urlopen, recording the request latency under the API method name
+        """
+        import urllib2
+        if method in ( "upload", "replace" ):
+            limit, kind = self.uploadLimit, "upload"
+        else:
+            limit, kind = self.apiLimit, "api"
+        limit.acquire()
+        start = time.time()
+        ok = False
+        try:
+            res = urllib2.urlopen( url )
+            ok = True
+            return res
+        finally:
+            elapsed = time.time() - start
+            limit.release(elapsed, ok)
+            metrics.set("uploadr_api_concurrency_limit", limit.limit, ("kind", kind))
+            metrics.observe("uploadr_api_request_duration_seconds", elapsed, ("method", method))
+
     def run( self ):
         """ run
         """
 
         while ( True ):
             self.upload()
+            metrics.set("uploadr_last_check_timestamp_seconds", time.time())
+            if args.metrics_textfile:
+                metrics.writeTextfile(args.metrics_textfile)
             print("Last check: " + str( time.asctime(time.localtime())))
             time.sleep( SLEEP_TIME )
 
@@ -741,6 +1289,19 @@ class Uploadr:
                 if row[2] == None and newSetCreated == False :
                     print "adding file to set " + row[1]
                     self.addFileToSet(setId, row, cur)
+
+            # Copies of uploaded photos put the photo into their own set too
+            cur.execute("SELECT path, files_id FROM duplicates WHERE set_id IS NULL")
+            for path, photoId in cur.fetchall():
+                setName = self.setNameOf(path)
+                cur.execute("SELECT set_id FROM sets WHERE name = ?", (setName,))
+                set = cur.fetchone()
+                if set == None:
+                    if self.createSet(setName, photoId, cur, con, duplicate=path):
+                        print("Created the set: " + setName)
+                else :
+                    print "adding copy to set " + path
+                    self.addDuplicateToSet(set[0], (photoId, path), cur)
         print('*****Completed creating sets*****')
 
     def addFileToSet( self, setId, file, cur):
@@ -782,7 +1343,60 @@ class Uploadr:
         except:
             print(str(sys.exc_info()))
 
-    def createSet( self, setName, primaryPhotoId, cur, con):
+    def addDuplicateToSet( self, setId, duplicate, cur):
+        """ Adds a photo to the set of a copy of it, (photo id, copy path)
+        """
+        try:
+            d = {
+                "auth_token"          : str(self.token),
+                "perms"               : str(self.perms),
+                "format"              : "json",
+                "nojsoncallback"      : "1",
+                "method"              : "flickr.photosets.addPhoto",
+                "photoset_id"         : str( setId ),
+                "photo_id"            : str( duplicate[0] )
+            }
+            sig = self.signCall( d )
+            url = self.urlGen( api.rest, d, sig )
+
+            res = self.getResponse( url )
+            # Code 3: the photo is in the set already
+            if ( self.isGood( res ) or res['code'] == 3 ):
+                print("Successfully added copy " + str(duplicate[1]) + " to its set.")
+                cur.execute("UPDATE duplicates SET set_id = ? WHERE path = ?", (setId, duplicate[1]))
+            else :
+                self.reportError( res )
+        except:
+            print(str(sys.exc_info()))
+
+    def removeFileFromSet( self, setId, file, cur, recordFile=True):
+        """ Takes a photo out of a set, on Flickr and, unless recordFile is False,
+        in the files table
+        """
+        try:
+            d = {
+                "auth_token"          : str(self.token),
+                "perms"               : str(self.perms),
+                "format"              : "json",
+                "nojsoncallback"      : "1",
+                "method"              : "flickr.photosets.removePhoto",
+                "photoset_id"         : str( setId ),
+                "photo_id"            : str( file[0] )
+            }
+            sig = self.signCall( d )
+            url = self.urlGen( api.rest, d, sig )
+
+            res = self.getResponse( url )
+            if ( self.isGood( res ) ):
+                print("Removed file " + str(file[1]) + " from its old set.")
+            else :
+                self.reportError( res )
+        except:
+            print(str(sys.exc_info()))
+        if recordFile:
+            cur.execute("UPDATE files SET set_id = NULL WHERE files_id = ?", (file[0],))
+
+    def createSet( self, setName, primaryPhotoId, cur, con, duplicate=None):
         print("Creating new set: " + str(setName))
 
         try:
@@ -803,7 +1417,7 @@ class Uploadr:
             url = self.urlGen( api.rest, d, sig )
             res = self.getResponse( url )
             if ( self.isGood( res ) ):
-                self.logSetCreation( res["photoset"]["id"], setName, primaryPhotoId, cur, con )
+                self.logSetCreation( res["photoset"]["id"], setName, primaryPhotoId, cur, con, duplicate )
                 return res["photoset"]["id"]
             else :
                 print(d)
@@ -813,36 +1427,93 @@ class Uploadr:
         return False
 
     def setupDB ( self ):
+        """ setupDB
+
+        Creates the database, or migrates it to the current schema, in a
+        single transaction: an interrupted migration leaves the database
+        as it was.
+        """
         print("Setting up the database: " + DB_PATH)
         con = None
         try:
             con = lite.connect(DB_PATH)
             con.text_factory = str
+            # sqlite3 would commit before every CREATE and ALTER on its own
+            con.isolation_level = None
             cur = con.cursor()
-            cur.execute('create table if not exists files (files_id int, path text, set_id int, md5 text, tagged int)')
-            cur.execute('create table if not exists sets (set_id int, name text, primary_photo_id INTEGER)')
-            cur.execute('create unique index if not exists fileindex on files (path)')
-            cur.execute('create index if not exists setsindex on sets (name)')
-            con.commit()
-            cur = con.cursor()
-            cur.execute('PRAGMA user_version')
-            row = cur.fetchone();
-            if (row[0] == 0) :
-                print('Adding last_modified column to database');
-                cur = con.cursor()
-                cur.execute('PRAGMA user_version="1"')
-                cur.execute('ALTER TABLE files ADD COLUMN last_modified REAL');
-                con.commit()
+            cur.execute('BEGIN IMMEDIATE')
+            cur.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'files'")
+            if (cur.fetchone()[0] == 0) :
+                self.createTables( cur )
+            else :
+                cur.execute('PRAGMA user_version')
+                version = cur.fetchone()[0]
+                if (version < 1) :
+                    print('Adding last_modified column to database');
+                    cur.execute('ALTER TABLE files ADD COLUMN last_modified REAL');
+                if (version < 2) :
+                    self.migrateToV2( cur )
+            cur.execute('create table if not exists raw_files (path text primary key, jpg_converted int, tags_copied int)')
+            cur.execute('create table if not exists leases (path text primary key, owner text, expires REAL)')
+            cur.execute('create table if not exists duplicates (path text primary key, files_id int, last_modified REAL, set_id int)')
+            cur.execute('create table if not exists run_state (phase text primary key, fingerprint text, completed_at REAL)')
+            cur.execute('create table if not exists tree_state (path text primary key, mtime REAL)')
+            cur.execute('COMMIT')
             con.close()
         except lite.Error, e:
             print("Error: %s" % e.args[0])
             if con != None:
+                # Closing rolls back what the migration did so far
                 con.close()
             sys.exit(1)
         finally:
             print("Completed database setup")
 
+    def createTables( self, cur ):
+        """ createTables
+
+        Creates the files and sets tables and their indexes, current schema.
+        Photo and set IDs are the tables' INTEGER PRIMARY KEYs, so looking
+        a row up by ID does not need an index of its own.
+        """
+        cur.execute('create table if not exists files (files_id INTEGER PRIMARY KEY, path text, set_id int, md5 text, tagged int, last_modified REAL)')
+        cur.execute('create table if not exists sets (set_id INTEGER PRIMARY KEY, name text, primary_photo_id INTEGER)')
+        cur.execute('create unique index if not exists fileindex on files (path)')
+        cur.execute('create index if not exists files_set_id on files (set_id)')
+        cur.execute('create index if not exists files_md5 on files (md5)')
+        cur.execute('create index if not exists files_tagged on files (tagged)')
+        cur.execute('create index if not exists setsindex on sets (name)')
+        cur.execute('PRAGMA user_version=%d' % DB_SCHEMA_VERSION)
+
+    def migrateToV2( self, cur ):
+        """ migrateToV2
+
+        Rebuilds the files and sets tables of a version 1 database with the
+        version 2 schema. Rows without an ID cannot be kept; of rows sharing
+        an ID the latest one is.
+        """
+        print('Migrating database to schema version 2')
+        cur.execute('DROP INDEX IF EXISTS fileindex')
+        cur.execute('DROP INDEX IF EXISTS setsindex')
+        cur.execute('ALTER TABLE files RENAME TO files_v1')
+        cur.execute('ALTER TABLE sets RENAME TO sets_v1')
+        self.createTables( cur )
+        cur.execute('INSERT OR REPLACE INTO files (files_id, path, set_id, md5, tagged, last_modified) '
+                    'SELECT files_id, path, set_id, md5, tagged, last_modified FROM files_v1 '
+                    'WHERE files_id IS NOT NULL ORDER BY rowid')
+        cur.execute('INSERT OR REPLACE INTO sets (set_id, name, primary_photo_id) '
+                    'SELECT set_id, name, primary_photo_id FROM sets_v1 '
+                    'WHERE set_id IS NOT NULL ORDER BY rowid')
+        cur.execute('SELECT (SELECT count(*) FROM files_v1) - (SELECT count(*) FROM files), '
+                    '(SELECT count(*) FROM sets_v1) - (SELECT count(*) FROM sets)')
+        droppedFiles, droppedSets = cur.fetchone()
+        if droppedFiles or droppedSets:
+            print('Dropped %d file and %d set rows without a unique ID' % (droppedFiles, droppedSets))
+        cur.execute('DROP TABLE files_v1')
+        cur.execute('DROP TABLE sets_v1')
+
     def md5Checksum(self, filePath):
+        metrics.inc("uploadr_files_hashed_total")
         with open(filePath, 'rb') as fh:
             m = hashlib.md5()
             while True:
@@ -861,7 +1532,8 @@ class Uploadr:
         with con:
 
             cur = con.cursor()
-            cur.execute("SELECT files_id, path, set_id, tagged FROM files")
+            # tagged is only ever set to 1, so the rest are NULL or 0
+            cur.execute("SELECT files_id, path, set_id, tagged FROM files WHERE tagged IS NULL OR tagged = 0")
 
             files = cur.fetchall()
 
@@ -916,7 +1588,11 @@ class Uploadr:
         with con:
 
             cur = con.cursor()
-            cur.execute("SELECT set_id, name FROM sets WHERE set_id NOT IN (SELECT set_id FROM files)")
+            # NOT EXISTS uses the set_id index, and unlike NOT IN still
+            # matches when some files have no set yet (a NULL set_id).
+            # A set made for a copy is only recorded in duplicates.
+            cur.execute("SELECT set_id, name FROM sets WHERE NOT EXISTS (SELECT 1 FROM files WHERE files.set_id = sets.set_id) "
+                        "AND NOT EXISTS (SELECT 1 FROM duplicates d WHERE d.set_id = sets.set_id)")
             unusedsets = cur.fetchall()
 
             for row in unusedsets:
@@ -972,8 +1648,621 @@ class Uploadr:
             print(str(sys.exc_info()))
         print('*****Completed adding Flickr Sets to DB*****')
 
-print("--------- Start time: " + time.strftime("%c") + " ---------");
+class TreeWalker:
+    """ TreeWalker class
+
+    Walks a directory tree, following symlinks, and yields the files that
+    may be uploaded while it is still walking. Directories are listed by a
+    pool of threads, so that the latency of a slow disk or network volume
+    is paid for several directories at once. A symlink to a directory the
+    walk is already inside of is not followed, which stops symlink cycles.
+    """
+
+    # Marks the end of the walk in the queue of files found
+    done = object()
+
+    def __init__( self, root, excludedFolders=(), ignoredRegex=(), allowedExt=(),
+                  maxSize=None, threads=8 ):
+        """ Constructor
+
+        excludedFolders are names of directories not to enter. A file is
+        yielded unless its name matches one of ignoredRegex (patterns or
+        compiled expressions, searched in the name), if its extension is in
+        allowedExt and it is smaller than maxSize bytes.
+        """
+        self.root = root
+        self.excludedFolders = set(excludedFolders or ())
+        patterns = [getattr(regex, 'pattern', regex) for regex in ignoredRegex or ()]
+        # One search of the name instead of one per pattern
+        self.ignored = re.compile("|".join("(?:%s)" % pattern for pattern in patterns)) \
+            if patterns else None
+        self.allowedExt = set(allowedExt or ())
+        self.maxSize = maxSize
+        self.threads = max(1, threads)
+        self.found = Queue.Queue()
+        # mtime of every directory listed, taken before listing it
+        self.mtimes = {}
+        self.elapsed = 0.0
+
+    def wanted( self, name ):
+        """ True if a file of this name may be uploaded, size aside
+        """
+        if self.ignored is not None and self.ignored.search(name):
+            return False
+        return name.lower().split(".")[-1] in self.allowedExt
+
+    def scan( self, path ):
+        """ scan
+
+        Lists one directory. Returns its subdirectories, as
+        (path, (st_dev, st_ino)), and the files to upload. Files whose name
+        is not wanted are never stat'ed; with scandir, neither are they to
+        tell them from directories.
+        """
+        dirs = []
+        files = []
+        try:
+            self.mtimes[path] = os.stat(path).st_mtime
+            if scandir is not None:
+                entries = [(entry.name, entry.path, entry.is_dir(), entry.stat)
+                           for entry in scandir(path)]
+            else:
+                entries = []
+                for name in os.listdir(path):
+                    entryPath = os.path.join(path, name)
+                    try:
+                        info = os.stat(entryPath)
+                    except OSError:
+                        continue
+                    entries.append((name, entryPath, stat.S_ISDIR(info.st_mode),
+                                    lambda info=info: info))
+        except OSError:
+            # As os.walk, skip what cannot be listed
+            return dirs, files
+        for name, entryPath, isDir, entryStat in entries:
+            try:
+                if isDir:
+                    if name not in self.excludedFolders:
+                        info = entryStat()
+                        dirs.append((entryPath, (info.st_dev, info.st_ino)))
+                elif self.wanted(name) and (self.maxSize is None or entryStat().st_size < self.maxSize):
+                    files.append(os.path.normpath(entryPath))
+            except OSError:
+                # Dangling symlink, or removed while walking
+                continue
+        return dirs, files
+
+    def backlog( self ):
+        """ Number of files found and not yet taken from walk()
+        """
+        return self.found.qsize()
+
+    def walk( self ):
+        """ walk
+
+        Yields the paths of the files to upload as they are found.
+        """
+        start = time.time()
+        directories = Queue.Queue()
+        lock = threading.Lock()
+        stopped = threading.Event()
+        info = os.stat(self.root)
+        # Directories queued or being listed
+        pending = [1]
+        # Each with the (st_dev, st_ino) of itself and its parents
+        directories.put((self.root, frozenset([(info.st_dev, info.st_ino)])))
+
+        def work():
+            while True:
+                item = directories.get()
+                if item is None:
+                    return
+                path, parents = item
+                dirs, files = ([], []) if stopped.is_set() else self.scan(path)
+                for file in files:
+                    self.found.put(file)
+                with lock:
+                    for dirPath, key in dirs:
+                        if key not in parents:
+                            pending[0] += 1
+                            directories.put((dirPath, parents | set([key])))
+                    pending[0] -= 1
+                    if pending[0] == 0:
+                        self.elapsed = time.time() - start
+                        for i in range(self.threads):
+                            directories.put(None)
+                        self.found.put(self.done)
+
+        for i in range(self.threads):
+            worker = threading.Thread(target=work)
+            worker.daemon = True
+            worker.start()
+        try:
+            while True:
+                # A timeout keeps the wait interruptible by Ctrl-C
+                try:
+                    file = self.found.get(True, 60)
+                except Queue.Empty:
+                    continue
+                if file is self.done:
+                    break
+                yield file
+        finally:
+            stopped.set()
+
+class InstanceLock:
+    """ InstanceLock class
+
+    Keeps other uploadr processes from running the same phases at once,
+    with an fcntl lock on LOCK_PATH. The lock file holds the host, pid and
+    start time of its holder and is touched every minute while held, so
+    that a lock left behind can be told from a live one: it is stale when
+    its holder is a process of this host that no longer exists, or when it
+    was not touched for staleTime seconds (a holder on another host of a
+    network volume, or a hung one). A stale lock file is replaced.
+    """
+
+    heartbeat = 60
+
+    def __init__( self, path, staleTime ):
+        """ Constructor
+        """
+        self.path = path
+        self.staleTime = staleTime
+        self.file = None
+        self.toucher = None
+        self.stopped = threading.Event()
+
+    def holder( self ):
+        """ (host, pid, start time) read from the lock file, None if unreadable
+        """
+        try:
+            with open(self.path) as f:
+                host, pid, started = f.read().split()
+            return host, int(pid), float(started)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def isStale( self ):
+        """ True if the process recorded in the lock file is gone
+        """
+        try:
+            touched = os.stat(self.path).st_mtime
+        except OSError:
+            return False
+        if time.time() - touched > self.staleTime:
+            return True
+        holder = self.holder()
+        if holder is None or holder[0] != socket.gethostname():
+            return False
+        try:
+            os.kill(holder[1], 0)
+        except OSError, e:
+            return e.errno == errno.ESRCH
+        return False
+
+    def acquire( self ):
+        """ acquire
+
+        Takes the lock, replacing it if stale. False if another live
+        process holds it.
+        """
+        import fcntl
+        while True:
+            f = open(self.path, "a+")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                f.close()
+                if e.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+                if not self.isStale():
+                    return False
+                print("Removing the stale lock " + self.path + " of " + str(self.holder()))
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+                continue
+            # The file may have been replaced as stale between open and flock
+            try:
+                current = os.stat(self.path)
+            except OSError:
+                current = None
+            opened = os.fstat(f.fileno())
+            if current is None or (current.st_dev, current.st_ino) != (opened.st_dev, opened.st_ino):
+                f.close()
+                continue
+            f.seek(0)
+            f.truncate()
+            f.write("%s %d %f\n" % (socket.gethostname(), os.getpid(), time.time()))
+            f.flush()
+            self.file = f
+            break
+        self.toucher = threading.Thread(target=self.touch)
+        self.toucher.daemon = True
+        self.toucher.start()
+        return True
+
+    def touch( self ):
+        """ Refreshes the lock file's mtime while the lock is held
+        """
+        while not self.stopped.wait(self.heartbeat):
+            try:
+                os.utime(self.path, None)
+            except OSError:
+                pass
+
+    def release( self ):
+        if self.file is not None:
+            self.stopped.set()
+            self.toucher.join()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.file.close()
+            self.file = None
+
+class UploadScheduler:
+    """ UploadScheduler class
+
+    Hands the files to upload to the upload threads by priority class, in
+    the order of UploadScheduler.classes. Within a class the file with the
+    earliest deadline goes first. A class never has more files being
+    uploaded at once than its share, so that a long backlog of low
+    priority uploads leaves threads free for the files of a higher class
+    that turn up while it is being worked on.
+    """
+
+    classes = ("fresh", "replace", "backfill")
+
+    def __init__( self, shares ):
+        """ Constructor
+
+        shares maps a class to the most files of it uploaded at once; a
+        class missing from it gets one.
+        """
+        self.shares = dict((name, max(1, shares.get(name, 1))) for name in self.classes)
+        self.queues = dict((name, []) for name in self.classes)
+        self.running = dict((name, 0) for name in self.classes)
+        self.order = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def put( self, item, name, deadline ):
+        """ Queues an item of class name, due by the unix time deadline
+        """
+        with self.condition:
+            # The counter keeps items of equal deadline in arrival order
+            self.order += 1
+            heapq.heappush(self.queues[name], (deadline, self.order, item))
+            self.condition.notify()
+
+    def get( self ):
+        """ get
+
+        Waits for an item that may be started, and returns it as
+        (class, deadline, item), or None once closed and drained.
+        """
+        with self.condition:
+            while True:
+                for name in self.classes:
+                    if self.queues[name] and self.running[name] < self.shares[name]:
+                        deadline, order, item = heapq.heappop(self.queues[name])
+                        self.running[name] += 1
+                        return name, deadline, item
+                if self.closed and not any(self.queues.values()):
+                    return None
+                # A timeout keeps the wait interruptible by Ctrl-C
+                self.condition.wait(60)
+
+    def done( self, name ):
+        """ Marks an item of class name returned by get() as finished
+        """
+        with self.condition:
+            self.running[name] -= 1
+            self.condition.notify_all()
+
+    def close( self ):
+        """ No more items will be put: get() returns None once all are taken
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def depths( self ):
+        """ Number of items waiting, by class
+        """
+        with self.condition:
+            return dict((name, len(self.queues[name])) for name in self.classes)
+
+class ChangeTracker:
+    """ ChangeTracker class
+
+    Lets a run skip the phases whose inputs did not change since they last
+    completed. The inputs are the watched tree, fingerprinted by the mtimes
+    of its directories (adding, removing or renaming a file changes its
+    directory's), and summaries of the DB tables. After a phase completes
+    with nothing left to retry, the fingerprint of its inputs is kept in
+    the run_state table; when they have the same fingerprint at the next
+    run, the phase is skipped. The directory mtimes are kept in the
+    tree_state table, so an unchanged tree is told by a stat of each
+    directory, without listing any.
+
+    Editing a file in place does not change its directory's mtime, nor do
+    changes made on Flickr show here, so a phase is run anyway once its
+    last run is maxAge seconds old.
+    """
+
+    # The fingerprinted inputs of each phase
+    phaseInputs = {
+        "removeUselessSetsTable"  : ("fileSets", "duplicates", "sets"),
+        "convertRawFiles"         : ("tree", "rawFiles"),
+        "upload"                  : ("tree", "files", "duplicates"),
+        "removeDeletedMedia"      : ("tree", "files", "duplicates"),
+        "createSets"              : ("files", "fileSets", "duplicates"),
+        "addTagsToUploadedPhotos" : ("files", "fileTags"),
+    }
+
+    # Summaries of the DB tables, crc() being zlib.crc32 of a value
+    tableQueries = {
+        "files"    : "SELECT count(*), total(files_id), total(crc(path)), total(last_modified) FROM files",
+        "fileSets" : "SELECT count(set_id), total(set_id) FROM files",
+        "fileTags" : "SELECT count(*), total(files_id) FROM files WHERE tagged = 1",
+        "sets"     : "SELECT count(*), total(set_id), total(crc(name)) FROM sets",
+        "rawFiles" : "SELECT count(*), total(crc(path)), total(jpg_converted), total(tags_copied) FROM raw_files",
+        "duplicates" : "SELECT count(*), total(crc(path)), total(files_id), count(set_id), total(set_id) FROM duplicates",
+    }
+
+    # Work a phase can leave undone in the DB, to retry at the next run
+    pendingQueries = {
+        "createSets"              : "SELECT (SELECT count(*) FROM files WHERE set_id IS NULL) + "
+                                    "(SELECT count(*) FROM duplicates WHERE set_id IS NULL)",
+        "addTagsToUploadedPhotos" : "SELECT count(*) FROM files WHERE tagged IS NULL OR tagged = 0",
+    }
+
+    def __init__( self, root, excludedFolders=(), maxAge=24 * 60 * 60, threads=8 ):
+        """ Constructor
+
+        A maxAge of 0 runs every phase, recording their fingerprints all the same.
+        """
+        self.root = root
+        self.excludedFolders = excludedFolders
+        self.maxAge = maxAge
+        self.threads = threads
+        self.tree = None
+        # (phase, reason) of the phases skipped by this run
+        self.skipped = []
+
+    def connect( self ):
+        con = lite.connect(DB_PATH)
+        con.text_factory = str
+        con.create_function("crc", 1, lambda value: zlib.crc32(str(value)))
+        return con
+
+    def treeFingerprint( self, con ):
+        """ treeFingerprint
+
+        Fingerprint of the directory mtimes of the watched tree, once per run.
+        Directories are only listed when one of those recorded by the last
+        listing changed or is gone; the new mtimes are recorded then.
+        """
+        if self.tree is not None:
+            return self.tree
+        cur = con.cursor()
+        cur.execute("SELECT path, mtime FROM tree_state")
+        mtimes = dict(cur.fetchall())
+        for path, mtime in mtimes.items():
+            try:
+                if os.stat(path).st_mtime != mtime:
+                    break
+            except OSError:
+                break
+        else:
+            if mtimes:
+                self.tree = self.hash(sorted(mtimes.items()))
+                return self.tree
+        start = time.time()
+        walker = TreeWalker(self.root, self.excludedFolders, threads=self.threads)
+        for file in walker.walk():
+            pass
+        # A directory changed within the mtime resolution of its file system
+        # could change again unnoticed: it is recorded so as to be listed again
+        recorded = [(path, mtime if mtime < start - 2 else -1) for path, mtime in walker.mtimes.items()]
+        with con:
+            cur.execute("DELETE FROM tree_state")
+            cur.executemany("INSERT INTO tree_state (path, mtime) VALUES (?, ?)", recorded)
+        self.tree = self.hash(sorted(walker.mtimes.items()))
+        return self.tree
+
+    def hash( self, value ):
+        return hashlib.md5(json.dumps(value)).hexdigest()
+
+    def fingerprint( self, phase, con ):
+        """ Fingerprint of the current inputs of a phase
+        """
+        values = []
+        for name in self.phaseInputs[phase]:
+            if name == "tree":
+                values.append(self.treeFingerprint(con))
+            else:
+                values.append(con.execute(self.tableQueries[name]).fetchone())
+        return self.hash(values)
+
+    def skipReason( self, phase ):
+        """ Why phase may be skipped, None when it has to run
+        """
+        if not self.maxAge:
+            return None
+        con = self.connect()
+        try:
+            row = con.execute("SELECT fingerprint, completed_at FROM run_state WHERE phase = ?", (phase,)).fetchone()
+            if row is None or time.time() - row[1] > self.maxAge:
+                return None
+            if row[0] != self.fingerprint(phase, con):
+                return None
+        finally:
+            con.close()
+        return "%s unchanged since its last run %d minutes ago" % (
+            " and ".join(self.phaseInputs[phase]), (time.time() - row[1]) // 60)
+
+    def run( self, phase, func, failures=None ):
+        """ run
+
+        Runs func, the phase, unless skipReason skips it. Its fingerprint is
+        recorded unless it left work to retry: failures() above 0, or pending
+        rows in the DB. The tree is fingerprinted before the phase runs, so
+        that files added meanwhile are found by the next run, and the DB
+        after, as the phase leaves it. Returns True if it ran.
+        """
+        reason = self.skipReason(phase)
+        if reason is not None:
+            self.skip(phase, reason)
+            return False
+        if "tree" in self.phaseInputs[phase]:
+            con = self.connect()
+            try:
+                self.treeFingerprint(con)
+            finally:
+                con.close()
+        func()
+        con = self.connect()
+        try:
+            pending = failures() if failures is not None else 0
+            if phase in self.pendingQueries:
+                pending += con.execute(self.pendingQueries[phase]).fetchone()[0]
+            with con:
+                if pending:
+                    con.execute("DELETE FROM run_state WHERE phase = ?", (phase,))
+                else:
+                    con.execute("INSERT OR REPLACE INTO run_state (phase, fingerprint, completed_at) VALUES (?, ?, ?)",
+                                (phase, self.fingerprint(phase, con), time.time()))
+        finally:
+            con.close()
+        # The phase may have changed the tree, as convertRawFiles does
+        self.tree = None
+        return True
+
+    def skip( self, phase, reason ):
+        print("*****Skipping " + phase + ": " + reason + "*****")
+        self.skipped.append((phase, reason))
+
+    def report( self ):
+        """ Prints the phases this run skipped, and why
+        """
+        if self.skipped:
+            print("Phases skipped (" + str(len(self.skipped)) + "):")
+            for phase, reason in self.skipped:
+                print("   " + phase + ": " + reason)
+
+class ExifTool:
+    """ ExifTool class
+
+    Keeps one exiftool process running in -stay_open batch mode so that many
+    commands can be sent to it without paying the perl startup every time.
+    """
+
+    sentinel = "{ready}"
+
+    def __init__( self, executable ):
+        """ Constructor
+        """
+        self.executable = executable
+        self.process = None
+
+    def start( self ):
+        import subprocess
+        self.process = subprocess.Popen([self.executable, "-stay_open", "True", "-@", "-"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def stop( self ):
+        if self.process is not None:
+            self.process.stdin.write("-stay_open\nFalse\n")
+            self.process.stdin.flush()
+            self.process.wait()
+            self.process = None
+
+    def execute( self, *args ):
+        """
+        Runs one exiftool command (one argument per line, as in an -@ file)
+        and returns everything it printed up to the {ready} marker.
+        """
+        self.process.stdin.write("\n".join(args) + "\n-execute\n")
+        self.process.stdin.flush()
+        output = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line or line.strip() == self.sentinel:
+                break
+            output.append(line)
+        return "".join(output)
+
+# exiftool instance owned by each RAW conversion worker process, or why it
+# could not be started
+rawWorkerTool = None
+rawWorkerError = None
+
+def startRawWorker():
+    """ Pool initializer: starts this worker's persistent exiftool
+    """
+    global rawWorkerTool, rawWorkerError
+    import multiprocessing.util
+    # An exception escaping a pool initializer makes the pool respawn the
+    # worker forever, so it is kept and reported per file instead
+    try:
+        rawWorkerTool = ExifTool(RAW_TOOL_PATH + "exiftool")
+        rawWorkerTool.start()
+    except Exception as e:
+        rawWorkerError = "cannot start exiftool: " + str(e)
+        return
+    multiprocessing.util.Finalize(rawWorkerTool, rawWorkerTool.stop, exitpriority=10)
+
+def convertRawFile( job ):
+    """
+    Creates the JPG for one RAW file and copies its tags over.
+    converted/tagged are the states recorded in the DB, or None when the file
+    has never been seen, in which case the JPG files left behind by older runs
+    are probed once so the DB can be seeded.
+    Returns (path, converted, tagged), with None for both when this worker has
+    no exiftool and nothing is to be recorded.
+    """
+    path, ext, converted, tagged = job
+    jpgPath = os.path.splitext(path)[0] + ".JPG"
+    if rawWorkerError is not None:
+        print("Cannot convert " + path + ": " + rawWorkerError)
+        return path, None, None
+    try:
+        if converted is None:
+            converted = os.path.exists(jpgPath)
+        if not converted:
+            print("About to create JPG from raw " + path)
+            flag = ""
+            if ext == "cr2":
+                flag = "PreviewImage"
+            else :
+                flag = "JpgFromRaw"
+            rawWorkerTool.execute("-b", "-" + flag, "-w", "%d%f.JPG", "-ext", ext, path)
+            converted = os.path.exists(jpgPath)
+
+        if tagged is None:
+            tagged = os.path.exists(jpgPath + "_original")
+        if converted and not tagged:
+            print ("About to copy tags from " + path + " to JPG.")
+            rawWorkerTool.execute("-tagsfromfile", path, "-all:all", "-ext", "JPG", jpgPath)
+            # exiftool keeps the untagged JPG as _original once it wrote the tags
+            tagged = os.path.exists(jpgPath + "_original")
+            if tagged:
+                print ("Finished copying tags.")
+            else:
+                print ("Could not copy the tags of " + path + ", they will be copied at the next run.")
+    except:
+        print(str(sys.exc_info()))
+    return path, bool(converted), bool(tagged)
+
 if __name__ == "__main__":
+    import argparse
+    print("--------- Start time: " + time.strftime("%c") + " ---------");
     parser = argparse.ArgumentParser(description='Upload files to Flickr.')
     parser.add_argument('-d', '--daemon', action='store_true',
         help='Run forever as a daemon')
@@ -985,7 +2274,21 @@ if __name__ == "__main__":
         help='Space-separated tags for uploaded files')
     parser.add_argument('-r', '--drip-feed',   action='store_true',
         help='Wait a bit between uploading individual files')
+    parser.add_argument('-s', '--shared', action='store_true',
+        help='When another uploadr is running, help it upload instead of exiting')
+    parser.add_argument('-f', '--full', action='store_true',
+        help='Run every phase, even those whose inputs did not change since their last run')
+    parser.add_argument('--metrics-port', action='store', type=int,
+        help='Serve Prometheus metrics on this local port (/metrics)')
+    parser.add_argument('--metrics-address', action='store', default='127.0.0.1',
+        help='Address to serve the metrics on, 127.0.0.1 by default (0.0.0.0 for all interfaces)')
+    parser.add_argument('--metrics-textfile', action='store',
+        help='Write Prometheus metrics to this file after every pass (node_exporter textfile collector)')
     args = parser.parse_args()
+    loadConfig()
+
+    if args.metrics_port:
+        metrics.serve(args.metrics_port, args.metrics_address)
 
     flick = Uploadr()
 
@@ -997,19 +2300,43 @@ if __name__ == "__main__":
         print("Please enter an API key and secret in the script file (see README).")
         sys.exit()
 
+    instanceLock = InstanceLock(LOCK_PATH, LOCK_STALE_TIME)
+    exclusive = instanceLock.acquire()
+    if not exclusive:
+        holder = instanceLock.holder()
+        print("Another uploadr is running" + (" (%s, pid %d)" % holder[:2] if holder else ""))
+        if not args.shared:
+            sys.exit()
+        print("Sharing its uploads: only uploading files")
+        flick.shared = True
+
     flick.setupDB()
 
     if args.daemon:
         flick.run()
+    elif not exclusive:
+        if ( not flick.hasValidToken() ):
+            flick.authenticate()
+        flick.upload()
     else:
-        if ( not flick.checkToken() ):
+        if ( not flick.hasValidToken() ):
             flick.authenticate()
         #flick.displaySets()
-        flick.removeUselessSetsTable()
-        flick.getFlickrSets()
-        flick.convertRawFiles()
-        flick.upload()
-        flick.removeDeletedMedia()
-        flick.createSets()
-        flick.addTagsToUploadedPhotos()
-print("--------- End time: " + time.strftime("%c") + " ---------");
+        tracker = ChangeTracker(FILES_DIR, EXCLUDED_FOLDERS, 0 if args.full else SKIP_UNCHANGED_FOR, WALK_THREADS)
+        tracker.run("removeUselessSetsTable", flick.removeUselessSetsTable)
+        tracker.run("convertRawFiles", flick.convertRawFiles)
+        tracker.run("upload", flick.upload, lambda: flick.uploadFailures)
+        tracker.run("removeDeletedMedia", flick.removeDeletedMedia, lambda: flick.deleteFailures)
+        # The sets on Flickr are only needed to file photos into sets
+        if tracker.skipReason("createSets") is None:
+            flick.getFlickrSets()
+        else:
+            tracker.skip("getFlickrSets", "only needed by createSets")
+        tracker.run("createSets", flick.createSets)
+        tracker.run("addTagsToUploadedPhotos", flick.addTagsToUploadedPhotos)
+        tracker.report()
+        metrics.set("uploadr_last_check_timestamp_seconds", time.time())
+        if args.metrics_textfile:
+            metrics.writeTextfile(args.metrics_textfile)
+    instanceLock.release()
+    print("--------- End time: " + time.strftime("%c") + " ---------");